@@ -0,0 +1,127 @@
+"""Binary columnar cache for the CSV logs used by partA and partB.
+
+The first time a CSV file is loaded it is parsed and each column is saved as
+its own .npy file in a .logcache directory next to the CSV.  Later loads
+memory-map those files instead of parsing the text again.  The cache is keyed
+on a hash of the CSV contents, so editing or replacing a log invalidates it.
+
+The parser turns a CSV file into a dict of 1-D arrays; logformats.py passes
+one that reads each kind of log with its schema:
+
+    from logcache import load_columns
+    from logformats import load_log
+
+    def parse_calibration(filename):
+        log = load_log(filename, 'calibration')
+        return {name: log[name] for name in log.dtype.names}
+
+    columns = load_columns('calibration.csv', parse_calibration)
+    distance = columns['range']
+
+partA and partB import the loaders through their shared_logs.py.
+
+S.W. Bain and M.C. Gardyne
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+CACHE_DIRNAME = '.logcache'
+
+# Bump this to invalidate every cache if the on-disk layout changes
+CACHE_VERSION = 1
+
+
+def file_hash(filename, block_size=1 << 20):
+    """Return the SHA-1 hex digest of the contents of a file."""
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def read_header(filename):
+    """Return the column names from the header line of a CSV file.
+
+    Blank names, such as the unnamed index column of the partA logs, are called 'index'.
+    """
+    with open(filename) as f:
+        names = f.readline().strip().split(',')
+    return [name.strip() or 'index' for name in names]
+
+
+def cache_prefix(filename, key=''):
+    """Return the path prefix shared by every cache of 'filename' made with parser 'key'."""
+    directory, basename = os.path.split(os.path.abspath(filename))
+    key_digest = hashlib.sha1(('%d:%s' % (CACHE_VERSION, key)).encode()).hexdigest()
+    return os.path.join(directory, CACHE_DIRNAME, '%s-%s-' % (basename, key_digest[:8]))
+
+
+def cache_path(filename, key=''):
+    """Return the cache directory for the current contents of 'filename'.
+
+    'key' distinguishes caches of the same file made by different parsers.
+    """
+    return cache_prefix(filename, key) + file_hash(filename)[:16]
+
+
+def write_cache(path, columns):
+    """Save each column as an .npy file in directory 'path'.
+
+    The files are written to a temporary directory that is then renamed, so
+    processes loading the same log at the same time never see a partial cache.
+    """
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+
+    tmp = tempfile.mkdtemp(dir=parent)
+    try:
+        for i, column in enumerate(columns.values()):
+            np.save(os.path.join(tmp, '%d.npy' % i), column)
+        with open(os.path.join(tmp, 'columns.json'), 'w') as f:
+            json.dump(list(columns.keys()), f)
+        os.rename(tmp, path)
+    except OSError:
+        # Another process finished writing the same cache first
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.isdir(path):
+            raise
+
+
+def read_cache(path):
+    """Return a dict of read-only memory-mapped columns from cache directory 'path'."""
+    with open(os.path.join(path, 'columns.json')) as f:
+        names = json.load(f)
+    return {name: np.load(os.path.join(path, '%d.npy' % i), mmap_mode='r') for i, name in enumerate(names)}
+
+
+def remove_stale(prefix, path):
+    """Remove caches starting with 'prefix' other than the current one at 'path'."""
+    directory, prefix = os.path.split(prefix)
+    for name in os.listdir(directory):
+        stale = os.path.join(directory, name)
+        if name.startswith(prefix) and stale != path and os.path.isdir(stale):
+            shutil.rmtree(stale, ignore_errors=True)
+
+
+def load_columns(filename, parse, key=''):
+    """Load a CSV log as a dict mapping column names to arrays, in file order.
+
+    On the first load, or after the file changes, the CSV is parsed with
+    'parse' (which must return a dict of 1-D arrays) and cached.  Otherwise the
+    columns are read-only, zero-copy memory maps of the cache.  Copy a column
+    before modifying it.  Pass a different 'key' for each parser used on the same file.
+    """
+    key = key + parse.__name__
+    path = cache_path(filename, key)
+
+    if not os.path.isdir(path):
+        write_cache(path, parse(filename))
+        remove_stale(cache_prefix(filename, key), path)
+
+    return read_cache(path)
@@ -0,0 +1,98 @@
+"""Schemas and a typed loader for the CSV logs used by partA and partB.
+
+Each kind of log has a declared schema giving the name, dtype and missing
+value of every column.  load_log reads a log in one pass straight into a
+structured array of that dtype, so nanosecond timestamps stay exact int64
+and beacon ids are ints, with -1 where no beacon was seen.
+
+    from logformats import load_log
+    log = load_log('data.csv', 'pf_log')
+    dt = np.diff(log['time_ns'])
+
+S.W. Bain and M.C. Gardyne
+"""
+
+import numpy as np
+from logcache import load_columns, read_header
+
+# The sensor columns shared by the partA logs
+_SENSOR_FIELDS = [('velocity_command', float, None),
+                  ('raw_ir1', float, None),
+                  ('raw_ir2', float, None),
+                  ('raw_ir3', float, None),
+                  ('raw_ir4', float, None),
+                  ('sonar1', float, None),
+                  ('sonar2', float, None)]
+
+_POSE_FIELDS = [('x', float, None), ('y', float, None), ('theta', float, None)]
+
+# For each kind of log, the (name, dtype, missing value) of each column in file order.
+# Empty fields are only allowed in columns with a missing value.
+SCHEMAS = {
+    'calibration': [('index', np.int64, None), ('time', float, None), ('range', float, None)] + _SENSOR_FIELDS,
+    'training': [('index', np.int64, None), ('time', float, None), ('range', float, None)] + _SENSOR_FIELDS,
+    'test': [('index', np.int64, None), ('time', float, None)] + _SENSOR_FIELDS,
+    'pf_log': [('time_ns', np.int64, None),
+               ('velocity_command', float, None),
+               ('rotation_command', float, None),
+               ('map_x', float, None), ('map_y', float, None), ('map_theta', float, None),
+               ('odom_x', float, None), ('odom_y', float, None), ('odom_theta', float, None),
+               ('beacon_id', np.int64, -1),
+               ('beacon_x', float, np.nan), ('beacon_y', float, np.nan), ('beacon_theta', float, np.nan)],
+    'beacon_map': [('id', np.int64, None)] + _POSE_FIELDS +
+                  [('c%d%d' % (i, j), float, None) for i in range(3) for j in range(3)],
+}
+
+
+def schema_dtype(kind):
+    """Return the structured dtype for a kind of log."""
+    return np.dtype([(name, dtype) for name, dtype, _ in SCHEMAS[kind]])
+
+
+def _converters(kind):
+    """Return loadtxt converters that fill empty fields in the columns that allow them."""
+    converters = {}
+    for i, (name, dtype, missing) in enumerate(SCHEMAS[kind]):
+        if missing is None:
+            continue
+        parse = int if np.dtype(dtype).kind == 'i' else float
+        converters[i] = lambda field, parse=parse, missing=missing: parse(field) if field else missing
+    return converters
+
+
+def check_header(filename, kind):
+    """Raise ValueError if the header of a CSV log does not match the schema for 'kind'."""
+    names = read_header(filename)
+    expected = [name for name, _, _ in SCHEMAS[kind]]
+    if names != expected:
+        raise ValueError('%s does not look like a %s log: expected columns %s, got %s'
+                         % (filename, kind, expected, names))
+
+
+def parse_lines(lines, kind):
+    """Parse CSV data lines (without the header) of a kind of log into a structured array."""
+    return np.loadtxt(lines, delimiter=',', dtype=schema_dtype(kind), converters=_converters(kind), ndmin=1)
+
+
+def load_log(filename, kind):
+    """Load a CSV log into a structured array with the schema for 'kind'.
+
+    Raises ValueError if the header does not match the schema.
+    """
+    check_header(filename, kind)
+    return np.loadtxt(filename, delimiter=',', skiprows=1, dtype=schema_dtype(kind),
+                      converters=_converters(kind), ndmin=1)
+
+
+def load_log_columns(filename, kind):
+    """Load a CSV log as a dict of typed columns, cached as memory-mapped binary files.
+
+    The columns have the dtypes of the schema for 'kind' and are read-only views
+    of the cache (see logcache.load_columns).
+    """
+    def parse(filename):
+        log = load_log(filename, kind)
+        return {name: log[name] for name in log.dtype.names}
+    parse.__name__ = 'parse_' + kind
+
+    return load_columns(filename, parse, key=repr(SCHEMAS[kind]))
@@ -0,0 +1,85 @@
+"""Benchmark of the Kalman filter on the shipped logs.
+
+Times KalmanBatch_t.run over training1.csv, training2.csv and test.csv
+against Data_t.run_data on each log in turn, and checks that the two give the
+same posteriors.  With --tile the batch is also run with the logs repeated, as
+parameter_sweep.py does, against run_data once per repeat.  --check exits
+with an error if the batch is not the faster:
+
+    python benchmark.py
+    python benchmark.py --tile 20 --check
+
+S.W. Bain and M.C. Gardyne
+"""
+
+import argparse
+import sys
+import time
+import numpy as np
+from sensor_fusion import Data_t, TrainingData_t, KalmanBatch_t, logKind
+
+LOGS = ['training1.csv', 'training2.csv', 'test.csv']
+
+def bestTime(func, setup, repeats):
+    """Return the shortest of 'repeats' timed calls of func(setup()), leaving setup untimed."""
+    best = np.inf
+    for repeat in range(repeats):
+        argument = setup()
+        start = time.perf_counter()
+        func(argument)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def loadData(filenames):
+    """Return a loaded Data_t (TrainingData_t for training logs) for each log."""
+    logs = [TrainingData_t(filename) if logKind(filename) == 'training' else Data_t(filename)
+            for filename in filenames]
+    for data in logs:
+        data.load_data()
+    return logs
+
+def runData(logs):
+    for data in logs:
+        data.run_data()
+
+def runBatch(batch):
+    batch.reset()
+    batch.run()
+
+def checkBatch(batch, logs):
+    """Return the largest difference between the batch and run_data posterior means."""
+    runBatch(batch)
+    runData(logs)
+    return max(np.max(np.abs(np.array([measurement.mle for measurement in data.measurements], dtype=float) -
+                             batch.posterior_mean[row, :batch.lengths[row]]))
+               for row, data in enumerate(logs))
+
+def main():
+    parser = argparse.ArgumentParser(description='Time KalmanBatch_t.run against Data_t.run_data on the logs.')
+    parser.add_argument('logs', nargs='*', default=LOGS, help='logs to filter (default the three shipped logs)')
+    parser.add_argument('--tile', type=int, default=1, help='also time the batch with the logs repeated this often')
+    parser.add_argument('--repeats', type=int, default=3, help='timed runs of each, the best is kept (default 3)')
+    parser.add_argument('--check', action='store_true', help='exit with an error if the batch is slower')
+    args = parser.parse_args()
+
+    batch = KalmanBatch_t(args.logs)
+    Nsamples = batch.lengths.sum()
+    difference = checkBatch(batch, loadData(args.logs))
+    print('%d logs, %d samples, largest posterior difference %.3g m' % (len(args.logs), Nsamples, difference))
+
+    slower = []
+    for count in sorted({1, args.tile}):
+        tiled = batch if count == 1 else batch.tile(count)
+        batch_time = bestTime(runBatch, lambda: tiled, args.repeats)
+        data_time = count*bestTime(runData, lambda: loadData(args.logs), args.repeats)
+        print('x%-3d KalmanBatch_t.run %8.4f s (%5.1f us/sample)   Data_t.run_data %8.4f s (%5.1f us/sample)'
+              '   speedup %.2f' % (count, batch_time, 1e6*batch_time/(count*Nsamples),
+                                   data_time, 1e6*data_time/(count*Nsamples), data_time/batch_time))
+        if batch_time >= data_time:
+            slower.append(count)
+
+    if args.check and slower:
+        sys.exit('KalmanBatch_t.run was slower than Data_t.run_data for x%s' % ', x'.join(map(str, slower)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""Module to tune the Kalman filter parameters against the training logs.
+
+Each configuration sets the velocity smoothing ALPHA, the motion model velocity
+variance, the gate width (in standard deviations) and the range of each
+sensor.  The configurations come from a grid or a random sample and are
+ranked by their RMSE against the true range in training1.csv and
+training2.csv.  The grid keeps the sensor ranges of the models; only the
+random samples vary them.  The logs are loaded once and put in shared memory.  Worker
+processes then run chunks of configurations, and each chunk is a single
+KalmanBatch_t with the logs repeated once per configuration.  A chunk is
+timed as a whole, so run time is reported per chunk rather than per
+configuration:
+
+    python parameter_sweep.py --grid
+    python parameter_sweep.py --samples 2000 --workers 4 --output sweep.csv
+
+plot-speeds.py smooths the velocity with ALPHA = 0.065 where sensor_fusion.py
+uses 0.035, so the default grid tries both.
+
+S.W. Bain and M.C. Gardyne
+"""
+
+import argparse
+import copy
+import itertools
+import os
+import time
+from multiprocessing import Pool, shared_memory
+import numpy as np
+from sensor_fusion import KalmanBatch_t, MotionModel_t, sensorModels, ALPHA, GATE_SIGMAS, DEFAULT_SENSORS, BATCH_INPUTS
+
+TRAINING_LOGS = ['training1.csv', 'training2.csv']
+
+#Values tried by the default grid
+GRID = {'alpha': [0.02, 0.035, 0.05, 0.065, 0.08],
+        'velocity_variance': list(MotionModel_t().velocity_variance*np.array([0.25, 0.5, 1, 2, 4])),
+        'gate': [2, 3, 4, 5, 6]}
+
+#Bounds of the random samples.  velocity_variance is sampled on a log scale and each
+#sensor range bound is moved by up to RANGE_JITTER m
+SAMPLE_BOUNDS = {'alpha': (0.01, 0.1),
+                 'velocity_variance': (MotionModel_t().velocity_variance/10, MotionModel_t().velocity_variance*10),
+                 'gate': (2, 8)}
+RANGE_JITTER = 0.1
+
+#The batch filled in by initWorker in each worker process
+worker_batch = None
+worker_memory = None
+
+
+def shareArrays(arrays):
+    """Copy a dict of arrays into one block of shared memory.
+
+    Returns the SharedMemory and a layout of (name, offset, shape, dtype) for attachArrays.
+    """
+    layout = []
+    offset = 0
+    for name, array in arrays.items():
+        layout.append((name, offset, array.shape, array.dtype.str))
+        offset += -(-array.nbytes//8)*8
+    memory = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for name, start, shape, dtype in layout:
+        np.ndarray(shape, dtype, memory.buf, start)[...] = arrays[name]
+    return memory, layout
+
+
+def attachArrays(memory, layout):
+    """Return read-only arrays viewing the shared memory laid out by shareArrays."""
+    arrays = {}
+    for name, start, shape, dtype in layout:
+        array = np.ndarray(shape, dtype, memory.buf, start)
+        array.flags.writeable = False
+        arrays[name] = array
+    return arrays
+
+
+def initWorker(memory_name, layout, template):
+    """Rebuild the training batch in a worker from the shared memory and a batch without its arrays."""
+    global worker_batch, worker_memory
+    worker_memory = shared_memory.SharedMemory(name=memory_name)
+    worker_batch = template
+    for name, array in attachArrays(worker_memory, layout).items():
+        setattr(worker_batch, name, array)
+
+
+def gridConfigs(grid, ranges):
+    """Return every combination of the values in grid, with the sensor ranges unchanged."""
+    names = list(grid)
+    return [dict(zip(names, values), ranges=ranges) for values in itertools.product(*grid.values())]
+
+
+def sampleConfigs(count, ranges, rng):
+    """Return 'count' configurations drawn uniformly from SAMPLE_BOUNDS, with jittered sensor ranges."""
+    alpha_min, alpha_max = SAMPLE_BOUNDS['alpha']
+    variance_min, variance_max = SAMPLE_BOUNDS['velocity_variance']
+    gate_min, gate_max = SAMPLE_BOUNDS['gate']
+
+    configs = []
+    for config in range(count):
+        jittered = ranges + rng.uniform(-RANGE_JITTER, RANGE_JITTER, ranges.shape)
+        configs.append({'alpha': rng.uniform(alpha_min, alpha_max),
+                        'velocity_variance': np.exp(rng.uniform(np.log(variance_min), np.log(variance_max))),
+                        'gate': rng.uniform(gate_min, gate_max),
+                        'ranges': np.maximum(jittered, 0)})
+    return configs
+
+
+def runConfigs(configs):
+    """Run a chunk of configurations as one batch in a worker.
+
+    Returns the RMSE of each configuration over every training log and per log, and
+    the run time of the chunk.
+    """
+    count = len(configs)
+    Nlogs = len(worker_batch.lengths)
+    start = time.perf_counter()
+
+    batch = worker_batch.tile(count)
+    repeat = lambda name: np.repeat([config[name] for config in configs], Nlogs, axis=0)
+    batch.run(repeat('alpha'), repeat('velocity_variance'), repeat('gate'), repeat('ranges'))
+
+    squared_errors = (batch.errors()**2).reshape(count, Nlogs, -1)
+    rmse = np.sqrt(np.nanmean(squared_errors.reshape(count, -1), axis=1))
+    log_rmse = np.sqrt(np.nanmean(squared_errors, axis=2))
+    return rmse, log_rmse, time.perf_counter() - start
+
+
+def sweep(configs, filenames=TRAINING_LOGS, sensor_names=DEFAULT_SENSORS, workers=None, chunk_size=16):
+    """Score every configuration on the training logs across a pool of worker processes.
+
+    Returns arrays of the RMSE over all the logs, the Nconfigs x Nlogs RMSE of each
+    log, and the run time of each chunk of chunk_size configurations.
+    """
+    batch = KalmanBatch_t(filenames, sensorModels(sensor_names))
+    memory, layout = shareArrays({name: getattr(batch, name) for name in BATCH_INPUTS})
+    try:
+        template = copy.copy(batch)
+        template.raw = None
+        for name in BATCH_INPUTS:
+            setattr(template, name, None)
+
+        chunks = [configs[start:start + chunk_size] for start in range(0, len(configs), chunk_size)]
+        with Pool(workers or os.cpu_count(), initWorker, (memory.name, layout, template)) as pool:
+            results = pool.map(runConfigs, chunks)
+    finally:
+        memory.close()
+        memory.unlink()
+
+    rmse, log_rmse, chunk_times = zip(*results)
+    return np.concatenate(rmse), np.concatenate(log_rmse), np.array(chunk_times)
+
+
+def rankConfigs(rmse):
+    """Return the configuration indices ordered by RMSE, with ties in their original order."""
+    return np.argsort(rmse, kind='stable')
+
+
+def saveResults(filename, configs, sensor_names, rmse, log_rmse, order):
+    """Save the ranked configurations as CSV, one row per configuration."""
+    header = ['rank', 'rmse'] + ['rmse_%d' % (log + 1) for log in range(log_rmse.shape[1])] + \
+             ['alpha', 'velocity_variance', 'gate'] + \
+             ['%s_%s' % (name, bound) for name in sensor_names for bound in ('min', 'max')]
+    with open(filename, 'w') as f:
+        f.write(','.join(header) + '\n')
+        for rank, index in enumerate(order):
+            config = configs[index]
+            values = [rank + 1, rmse[index]] + list(log_rmse[index]) + \
+                     [config['alpha'], config['velocity_variance'], config['gate']] + \
+                     list(np.ravel(config['ranges']))
+            f.write(','.join('%.6g' % value for value in values) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweep the Kalman filter parameters on the training logs.')
+    parser.add_argument('--samples', type=int, default=0,
+                        help='number of random configurations (default: the grid)')
+    parser.add_argument('--grid', action='store_true', help='sweep the grid as well as any random samples')
+    parser.add_argument('--sensors', nargs='+', default=list(DEFAULT_SENSORS), help='sensors to fuse')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per CPU)')
+    parser.add_argument('--chunk', type=int, default=16, help='configurations per batch (default 16)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default 0)')
+    parser.add_argument('--top', type=int, default=10, help='number of configurations to print (default 10)')
+    parser.add_argument('--output', default=None, help='CSV file to save every ranked configuration to')
+    args = parser.parse_args()
+
+    ranges = np.array([model.range for model in sensorModels(args.sensors).values()], dtype=float)
+    configs = [{'alpha': ALPHA, 'velocity_variance': MotionModel_t().velocity_variance, 'gate': GATE_SIGMAS,
+                'ranges': ranges}]
+    if args.grid or not args.samples:
+        configs += gridConfigs(GRID, ranges)
+    configs += sampleConfigs(args.samples, ranges, np.random.default_rng(args.seed))
+
+    start = time.perf_counter()
+    rmse, log_rmse, chunk_times = sweep(configs, sensor_names=args.sensors, workers=args.workers,
+                                        chunk_size=args.chunk)
+    elapsed = time.perf_counter() - start
+    order = rankConfigs(rmse)
+
+    print('Swept %d configurations in %.1f s' % (len(configs), elapsed))
+    print('%d chunks of up to %d configurations took %.3f s on average, %.3f s at most' %
+          (len(chunk_times), args.chunk, np.mean(chunk_times), np.max(chunk_times)))
+    print('%4s %9s %9s %9s %7s %11s %5s' % ('rank', 'rmse', 'rmse_1', 'rmse_2', 'alpha', 'vel_var', 'gate'))
+    for rank, index in enumerate(order[:args.top]):
+        config = configs[index]
+        print('%4d %9.5f %9.5f %9.5f %7.4f %11.4g %5.2f' % (rank + 1, rmse[index], log_rmse[index, 0],
+                                                        log_rmse[index, 1], config['alpha'],
+                                                        config['velocity_variance'], config['gate']))
+    current = int(np.flatnonzero(order == 0)[0])
+    print('Current parameters rank %d of %d with RMSE %.5f' % (current + 1, len(configs), rmse[0]))
+
+    if args.output:
+        saveResults(args.output, configs, args.sensors, rmse, log_rmse, order)
+        print('Saved results to', args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,35 @@ S.W. Bain and M.C. Gardyne,
 15/08/2022
 """
 
+import copy
 import numpy as np
 from matplotlib.pyplot import *
 import math
 
+from shared_logs import load_log_columns
+from sensor_models import inverseParabola
+
 ALPHA = 0.035
 
+#Sensor readings further than this many standard deviations from the prior are not used
+GATE_SIGMAS = 4
+
+#Sensors fused by default, the first giving the starting position.  sonar2 fits the
+#calibration log well but lags the robot by up to 0.2 m in the training logs
+DEFAULT_SENSORS = ('sonar1', 'raw_ir3', 'raw_ir4', 'raw_ir1', 'raw_ir2')
+ALL_SENSORS = DEFAULT_SENSORS + ('sonar2',)
+
+#Kinds of segment a PiecewiseSensorModel_t can have
+SEGMENT_TYPES = ('linear', 'hyperbole', 'parabola')
+LINEAR, HYPERBOLE, PARABOLA = range(len(SEGMENT_TYPES))
+
+#KalmanBatch_t.run steps batches of up to this many logs one log at a time on floats
+SCALAR_LOGS = 12
+
+#The KalmanBatch_t inputs that KalmanBatch_t.run uses
+BATCH_INPUTS = ('time', 'velocity_command', 'distance', 'valid', 'estimates', 'variances', 'information',
+                'deviations', 'available', 'prior_raw')
+
 class Measurement_t:
     def __init__(self, mle, variance):
         self.mle = mle
@@ -21,31 +44,395 @@ class MotionModel_t:
 
 class SensorModel_t:
     def __init__(self, parameters, variance, range, fit_type):
+        """Sensor model z = a + b*x ('linear') or z = a + b/x ('hyperbole'), with parameters [a, b].
+
+        variance is the variance of the raw reading z, and range the distances the model is used over.
+        """
         self.parameters = parameters
         self.model_variance = variance
         self.range = range
         self.fit_type = fit_type
 
+        #A single segment inverts any reading without a distance
+        self.monotonic = True
+
         self.raw_data = []
 
     def check_in_range(self, prior: Measurement_t):
         return (prior.mle > self.range[0] and prior.mle < self.range[1])
 
     def calcDist(self, index):
+        return self.measure(self.raw_data[index])
+
+    def measure(self, raw):
+        """Invert a single raw reading into a distance estimate and its variance."""
         if self.fit_type == 'linear':
-            estimate = (self.raw_data[index] - self.parameters[0])/self.parameters[1] # Invert
+            estimate = (raw - self.parameters[0])/self.parameters[1] # Invert
             variance = self.model_variance/(self.parameters[1]**2) # Derivative (linear aproximation)
         elif self.fit_type == 'hyperbole':
-            estimate = self.parameters[0]/(self.raw_data[index]-self.parameters[1])
+            estimate = self.parameters[1]/(raw-self.parameters[0])
             variance = self.model_variance/(-self.parameters[1]/estimate**2)**2
 
         return Measurement_t(estimate, variance)
 
+    def invert(self, raw, distance=None):
+        """Return arrays of the distance estimates and their variances for an array of raw readings, as calcDist.
+
+        distance is not needed, and is accepted so the model can replace a PiecewiseSensorModel_t.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.fit_type == 'linear':
+                estimate = (raw - self.parameters[0])/self.parameters[1]
+                variance = np.full(np.shape(raw), self.model_variance/(self.parameters[1]**2))
+            elif self.fit_type == 'hyperbole':
+                estimate = self.parameters[1]/(raw-self.parameters[0])
+                variance = self.model_variance/(-self.parameters[1]/estimate**2)**2
+
+        return estimate, variance
+
+class PiecewiseSensorModel_t:
+    def __init__(self, breakpoints, segment_types, parameters, variances, range):
+        """Sensor model made of segments fitted over separate distance intervals, as in modelIR4.
+
+        breakpoints are the increasing distances where one segment ends and the next
+        starts, so there is one more segment than breakpoint.  Each segment is 'linear'
+        (z = a + b*x), 'hyperbole' (z = a + b/x) or 'parabola' (z = a + b*x + c*x**2),
+        with parameters [a, b] or [a, b, c] and the variance of the raw readings.
+
+        If the model is monotonic over range, readings are inverted by finding their
+        segment among the readings at the breakpoints.  Otherwise monotonic is False:
+        the same reading can come from two segments, so invert needs the distance to
+        linearise about, and the filters use the prior.
+        """
+        self.breakpoints = np.asarray(breakpoints, dtype=float)
+        self.segment_types = np.array([SEGMENT_TYPES.index(segment_type) for segment_type in segment_types])
+        self.parameters = np.zeros((len(segment_types), 3))
+        for segment, segment_parameters in enumerate(parameters):
+            self.parameters[segment, :len(segment_parameters)] = segment_parameters
+        self.model_variances = np.asarray(variances, dtype=float)
+        self.range = range
+
+        #Parabolas are inverted on the side of their vertex their interval is on
+        a, b, c = self.parameters.T
+        edges = np.concatenate(([-np.inf], self.breakpoints, [np.inf]))
+        lower, upper = np.maximum(edges[:-1], range[0]), np.minimum(edges[1:], range[1])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vertex = -b/(2*c)
+        self.branches = np.where(vertex <= (lower + upper)/2, 1, -1)
+
+        #Readings at the ends of the segments in range, to find segments from readings
+        self.first_segment = np.searchsorted(self.breakpoints, range[0], side='right')
+        last_segment = np.searchsorted(self.breakpoints, range[1], side='right')
+        used = np.arange(self.first_segment, last_segment + 1)
+        with np.errstate(divide='ignore'):
+            starts = self.evaluate(lower[used], used)
+            ends = self.evaluate(upper[used], used)
+        inside = (vertex[used] > lower[used]) & (vertex[used] < upper[used]) & (self.segment_types[used] == PARABOLA)
+        #The readings must also not step back where the segments meet
+        directions = np.sign(np.concatenate((ends - starts, starts[1:] - ends[:-1])))
+        if directions[0] != 0 and np.all(directions == directions[0]) and not inside.any():
+            self.raw_sign = directions[0]
+            self.raw_breakpoints = self.raw_sign*(ends[:-1] + starts[1:])/2
+        else:
+            self.raw_sign = 0
+            self.raw_breakpoints = None
+        self.monotonic = self.raw_breakpoints is not None
+
+        self.raw_data = []
+
+    def check_in_range(self, prior: Measurement_t):
+        return (prior.mle > self.range[0] and prior.mle < self.range[1])
+
+    def calcDist(self, index):
+        return self.measure(self.raw_data[index])
+
+    def evaluate(self, distance, segment=None):
+        """Return the readings the model predicts at an array of distances (in the given segments)."""
+        distance = np.asarray(distance, dtype=float)
+        if segment is None:
+            segment = np.searchsorted(self.breakpoints, distance, side='right')
+        a, b, c = [self.parameters[segment, column] for column in range(3)]
+        return np.where(self.segment_types[segment] == HYPERBOLE, a + b/distance, a + (b + c*distance)*distance)
+
+    def segment(self, raw, distance=None):
+        """Return the segment of each raw reading, or of each distance if they are given."""
+        if distance is not None:
+            return np.searchsorted(self.breakpoints, distance, side='right')
+        if self.raw_breakpoints is None:
+            raise ValueError('The model is not monotonic over %s, so readings need a distance to invert'
+                             % (self.range,))
+        return self.first_segment + np.searchsorted(self.raw_breakpoints, self.raw_sign*np.asarray(raw))
+
+    def invert(self, raw, distance=None):
+        """Return arrays of the distance estimates and their variances for an array of raw readings.
+
+        Each reading is inverted with its segment, and its variance is the segment's
+        variance divided by the square of the segment's slope there.  'distance' is an
+        array of distances (e.g. the prior) choosing the segments instead.
+        """
+        raw = np.asarray(raw, dtype=float)
+        segment = self.segment(raw, distance)
+        segment_types = self.segment_types[segment]
+        a, b, c = [self.parameters[segment, column] for column in range(3)]
+        estimate = np.full(raw.shape, np.nan)
+        slope = np.full(raw.shape, np.nan)
+
+        #One pass per kind of segment, whatever the number of readings
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for segment_type in np.unique(segment_types):
+                mask = segment_types == segment_type
+                z, a_m, b_m, c_m = raw[mask], a[mask], b[mask], c[mask]
+                if segment_type == LINEAR:
+                    x = (z - a_m)/b_m
+                    slope[mask] = b_m
+                elif segment_type == HYPERBOLE:
+                    x = b_m/(z - a_m)
+                    slope[mask] = -b_m/x**2
+                else:
+                    x = inverseParabola(z, a_m, b_m, c_m, self.branches[segment[mask]])
+                    slope[mask] = b_m + 2*c_m*x
+                estimate[mask] = x
+
+            variance = self.model_variances[segment]/slope**2
+        return estimate, variance
+
+    def measure(self, raw, distance=None):
+        """Invert a single raw reading into a distance estimate and its variance."""
+        estimate, variance = self.invert(raw, distance)
+        return Measurement_t(float(estimate), float(variance))
+
+def sensorModels(names=DEFAULT_SENSORS):
+    """Return the fitted sensor models named in names, keyed by the log column they invert.
+
+    raw_ir1, raw_ir2 and sonar2 are fitted by modelIR1, modelIR2 and modelSonar2 in sensor_models.py.
+    """
+    models = {'sonar1': SensorModel_t([-0.017464, 0.99343], 0.00053022, [0, 5], 'linear'),
+              'raw_ir3': SensorModel_t([0.1361338, 0.2852434], 0.005684, [0.2, 0.7], 'hyperbole'),
+              'raw_ir4': SensorModel_t([1.25294805, 1.4931097], 0.003980, [1.5, 4], 'hyperbole'),
+              'raw_ir1': SensorModel_t([-0.06266691, 0.16454788], 0.0061847, [0.1, 0.6], 'hyperbole'),
+              'raw_ir2': SensorModel_t([-0.06853331, 0.16574862], 0.0067322, [0.1, 0.6], 'hyperbole'),
+              'sonar2': SensorModel_t([-0.01216568, 1.00606186], 0.00045068, [0.3, 3.3], 'linear')}
+    return {name: models[name] for name in names}
+
+def piecewiseModels():
+    """Return the multi-segment fits of modelIR3 and modelIR4 over the ranges of sensorModels.
+
+    They can replace raw_ir3 and raw_ir4 in sensorModels; widen their ranges to
+    use the other segments.
+    """
+    return {'raw_ir3': PiecewiseSensorModel_t([1.0755], ['hyperbole', 'linear'],
+                                              [[0.1361338, 0.2852434], [0.28991766, 0.11192217]],
+                                              [0.005684, 0.005848], [0.2, 0.7]),
+            'raw_ir4': PiecewiseSensorModel_t([0.3467, 0.6798], ['parabola', 'linear', 'hyperbole'],
+                                              [[2.19897759, -5.93744724, 27.59860168], [3.43724799, 0.02907117],
+                                               [1.25294805, 1.4931097]],
+                                              [0.0030653, 0.0062306, 0.003980], [1.5, 4])}
+
+def smoothVelocity(velocity, velocity_command, alpha=ALPHA):
+    """Move the velocity estimate towards the command as KalmanFilter_t.update_prior does, for arrays."""
+    return np.where(np.abs(velocity_command) > np.abs(velocity),
+                    velocity_command * alpha + velocity * (1 - alpha), velocity_command)
+
+def gateReadings(prior_mean, estimates, gate_widths, valid):
+    """Return the mask of the valid sensor estimates within gate_widths of the prior mean.
+
+    estimates, gate_widths and valid have a column per sensor, e.g. Nsamples x Nsensors,
+    and prior_mean one value per row.  valid marks the readings that can be used (in
+    range and not NaN).
+    """
+    return valid & (np.abs(estimates - np.asarray(prior_mean)[..., np.newaxis]) < gate_widths)
+
+def fuseInformation(prior_mean, prior_variance, estimates, information, used):
+    """Fuse a prior with sensor distance estimates in information form.
+
+    estimates, information (inverse variance) and used have a column per sensor, as in
+    gateReadings, and prior_mean and prior_variance one value per row.  Each sensor used
+    is weighted by its information, so the gains of the prior and the sensors always
+    sum to one, and sensors that are not used cost nothing but a masked column.
+
+    Returns the posterior means and variances, the prior gains and the sensor gains
+    (zero where a reading was not used).
+    """
+    information = np.where(used, information, 0.0)
+    prior_information = 1/np.asarray(prior_variance)
+    total_information = prior_information + information.sum(axis=-1)
+
+    gains = information/total_information[..., np.newaxis]
+    prior_gain = prior_information/total_information
+    posterior_mean = prior_gain*prior_mean + (gains*np.where(used, estimates, 0.0)).sum(axis=-1)
+    return posterior_mean, 1/total_information, prior_gain, gains
+
+def fuseSample(prior_mean, prior_variance, estimates, information, gate_widths):
+    """Gate and fuse the readings of one sample as gateReadings and fuseInformation do, on Python floats.
+
+    estimates, information and gate_widths are sequences with one entry per sensor in
+    range of the prior.  For a single sample, building arrays costs far more than the
+    arithmetic.  The sums are taken in sensor order, so the results can differ from
+    fuseInformation's in the last bit.
+
+    Returns the posterior mean and variance, the prior gain and a list of the sensor
+    gains (zero where a reading was gated out).
+    """
+    prior_information = 1/prior_variance
+    total_information = prior_information
+    used = []
+    for estimate, sensor_information, width in zip(estimates, information, gate_widths):
+        sensor_used = abs(estimate - prior_mean) < width
+        if sensor_used:
+            total_information += sensor_information
+        used.append(sensor_used)
+
+    prior_gain = prior_information/total_information
+    posterior_mean = prior_gain*prior_mean
+    gains = []
+    for sensor_used, estimate, sensor_information in zip(used, estimates, information):
+        if sensor_used:
+            gain = sensor_information/total_information
+            posterior_mean += gain*estimate
+        else:
+            gain = 0.0
+        gains.append(gain)
+    return posterior_mean, 1/total_information, prior_gain, gains
+
+def kalmanLoop(time, velocity_command, estimates, information, gate_widths, lower, upper, alpha, velocity_variance,
+               start, mean, variance, prior_inputs=()):
+    """Step the Kalman filter through one log on Python floats, as KalmanFilter_t.push does.
+
+    time and velocity_command are lists of the log's samples, and estimates, information
+    and gate_widths lists of per-sensor lists.  lower and upper are the sensor ranges.
+    The filter starts at sample 'start' from 'mean' and 'variance'.  prior_inputs holds
+    a (sensor, model, raw readings, gate) tuple for each model that is not monotonic;
+    those readings are inverted about the prior at each step.
+
+    Returns lists of the prior and posterior means and variances, the prior gains, the
+    per-sensor gains and the motion-only track's step at each sample (NaN or zero before
+    the start).
+    """
+    Nsamples = len(time)
+    Nsensors = len(lower)
+    prior_mean = [math.nan]*Nsamples
+    prior_variance = [math.nan]*Nsamples
+    posterior_mean = [math.nan]*Nsamples
+    posterior_variance = [math.nan]*Nsamples
+    prior_gain = [0.0]*Nsamples
+    gains = [[0.0]*Nsensors for index in range(Nsamples)]
+    motion_steps = [0.0]*Nsamples
+    all_sensors = range(Nsensors)
+
+    posterior_mean[start] = mean
+    posterior_variance[start] = variance
+    velocity = 0
+
+    for index in range(start + 1, Nsamples):
+        command = velocity_command[index]
+        time_step = time[index] - time[index-1]
+
+        #Prior from the motion model
+        if abs(command) > abs(velocity):
+            velocity = command * alpha + velocity * (1 - alpha)
+        else:
+            velocity = command
+        prior = mean + velocity*time_step
+        prior_var = variance + velocity_variance*time_step
+        prior_mean[index] = prior
+        prior_variance[index] = prior_var
+
+        #Invert the readings that need the prior
+        sample_estimates, sample_information, sample_widths = estimates[index], information[index], gate_widths[index]
+        if prior_inputs:
+            sample_estimates, sample_information, sample_widths = \
+                list(sample_estimates), list(sample_information), list(sample_widths)
+            for sensor, model, raw, gate in prior_inputs:
+                if raw[index] == raw[index] and lower[sensor] < prior < upper[sensor]:
+                    measurement = model.measure(raw[index], prior)
+                    sample_estimates[sensor] = measurement.mle
+                    sample_information[sensor] = 1/measurement.variance
+                    sample_widths[sensor] = gate*math.sqrt(measurement.variance)
+
+        #Fuse the sensors in range of the prior
+        sensors = [sensor for sensor in all_sensors if lower[sensor] < prior < upper[sensor]]
+        if len(sensors) == Nsensors:
+            mean, variance, prior_gain[index], gains[index] = fuseSample(
+                prior, prior_var, sample_estimates, sample_information, sample_widths)
+        else:
+            mean, variance, prior_gain[index], sensor_gains = fuseSample(
+                prior, prior_var, [sample_estimates[sensor] for sensor in sensors],
+                [sample_information[sensor] for sensor in sensors], [sample_widths[sensor] for sensor in sensors])
+            for sensor, gain in zip(sensors, sensor_gains):
+                gains[index][sensor] = gain
+        posterior_mean[index] = mean
+        posterior_variance[index] = variance
+
+        #The motion-only track shares the velocity
+        if abs(command) > abs(velocity):
+            velocity = command * alpha + velocity * (1 - alpha)
+        else:
+            velocity = command
+        motion_steps[index] = velocity*time_step
+
+    return prior_mean, prior_variance, posterior_mean, posterior_variance, prior_gain, gains, motion_steps
+
 class KalmanFilter_t:
-    def __init__(self):
+    def __init__(self, sensor_models=None):
+        """Kalman filter for the sensors in sensor_models (by default sensorModels()).
+
+        Samples can be pushed one at a time with push, which keeps only the latest
+        prior, posterior and motion-only estimates.
+        """
         self.current_velocity = 0
         self.motion_model = MotionModel_t()
         self.kalman_gains = []
+        self.sensor_models = sensorModels() if sensor_models is None else sensor_models
+
+        self.time = None
+        self.prior = None
+        self.posterior = None
+        self.motion = None
+
+    def push(self, time, velocity_command, readings):
+        """Filter one sample and return the posterior Measurement_t.
+
+        readings: raw sensor readings keyed by log column name, e.g. {'sonar1': 0.82,
+        'raw_ir3': 0.52, ...}.  Sensors that are missing or NaN are not used, and
+        other columns are ignored.
+
+        The starting position is the first reading of the first sensor (sonar1 by
+        default) that is finite and inverts to a distance within that sensor's range;
+        until a sample has one, the posterior is NaN.  The motion-only estimate is
+        updated too and shares the velocity estimate, as in Data_t.run_data, so
+        pushing a whole log gives the same posteriors.  Each sample takes the same
+        time and no state grows, so the filter can run live.
+        """
+        if self.posterior is None:
+            self.posterior = self.motion = self.initial_measurement(readings)
+            if self.posterior is None:
+                return Measurement_t(math.nan, math.nan)
+        else:
+            time_step = time - self.time
+            self.prior = self.update_prior(self.posterior, velocity_command, time_step)
+
+            sensor_measurements = [model.measure(readings[name]) if model.monotonic else
+                                   model.measure(readings[name], self.prior.mle)
+                                   for name, model in self.sensor_models.items()
+                                   if not math.isnan(readings.get(name, math.nan)) and model.check_in_range(self.prior)]
+            self.posterior = self.update_posterior(self.prior, sensor_measurements)
+
+            self.motion = self.update_prior(self.motion, velocity_command, time_step)
+
+        self.time = time
+        return self.posterior
+
+    def initial_measurement(self, readings):
+        """Return the measurement to start from: the first sensor's finite reading within its range, or None."""
+        for name, model in self.sensor_models.items():
+            #A model that is not monotonic needs a prior to invert a reading
+            raw = readings.get(name, math.nan)
+            if math.isnan(raw) or not model.monotonic:
+                continue
+            measurement = model.measure(raw)
+            if model.check_in_range(measurement):
+                return measurement
+        return None
 
     def update_prior(self, measurement: Measurement_t, velocity_command, time_step):
         if (abs(velocity_command) > abs(self.current_velocity)):
@@ -59,37 +446,17 @@ class KalmanFilter_t:
 
 
     def update_posterior(self, prior: Measurement_t, sensor_measurements: list[Measurement_t]):
-        
-        kalman_gains = []
-
-        kalman_gain_denom = 1/prior.variance
+        """Fuse the prior with the sensor measurements with fuseSample and return the posterior.
 
-        #Add the inverse of each variance to the denominator of the Kalman Gain
-        for sensor_measurement in sensor_measurements:
-            if abs(sensor_measurement.mle - prior.mle) < 4*math.sqrt(sensor_measurement.variance):
-                kalman_gain_denom += 1/sensor_measurement.variance
-            else:
-                sensor_measurements.remove(sensor_measurement)
-
-        #Add the motion model contribution to the position estimate
-        position_estimate = (1/prior.variance)/kalman_gain_denom * prior.mle
-        kalman_gains.append((1/prior.variance)/kalman_gain_denom)
-
-        #Add each of the sensors contribution to the position estimate
-        for sensor_measurement in sensor_measurements:
-            position_estimate += (1/sensor_measurement.variance)/kalman_gain_denom * sensor_measurement.mle
-            kalman_gains.append((1/sensor_measurement.variance)/kalman_gain_denom)
-        
-        #Find the position variance
-        position_variance = 1/kalman_gain_denom
+        The gains of the prior and each measurement are kept in kalman_gains.
+        """
+        position_estimate, position_variance, prior_gain, gains = fuseSample(
+            prior.mle, prior.variance, [measurement.mle for measurement in sensor_measurements],
+            [1/measurement.variance for measurement in sensor_measurements],
+            [GATE_SIGMAS*math.sqrt(measurement.variance) for measurement in sensor_measurements])
 
-        posterior = Measurement_t(position_estimate, position_variance)
-
-        if sum(kalman_gains) > 1:
-            #Some weird error that only occurs in 10 or so measurements, likely due to rounding
-            posterior = prior
-
-        return posterior
+        self.kalman_gains = [prior_gain] + gains
+        return Measurement_t(position_estimate, position_variance)
 
 class Data_t:
     def __init__(self, filename):
@@ -105,11 +472,12 @@ class Data_t:
         self.sonar1 = []
         self.sonar2 = []
 
-        self.sonar1_model = SensorModel_t([-0.017464, 0.99343], 0.00053022, [0, 5], 'linear')
-        self.ir3_model = SensorModel_t([0.1361338, 0.2852434], 0.005684, [0.2, 0.7], 'hyperbole')
-        self.ir4_model = SensorModel_t([1.25294805, 1.4931097], 0.003980, [1.5, 4], 'hyperbole')
+        models = sensorModels()
+        self.sonar1_model = models['sonar1']
+        self.ir3_model = models['raw_ir3']
+        self.ir4_model = models['raw_ir4']
 
-        self.filter = KalmanFilter_t()
+        self.filter = KalmanFilter_t(models)
 
         self.sensor_models = []
 
@@ -124,31 +492,32 @@ class Data_t:
         return (self.time[index]-self.time[index-1])
 
     def load_data(self):
-        np_data = np.loadtxt(self.filename, delimiter=',', skiprows=1)
-        self.index, self.time, self.velocity_command, self.raw_ir1, self.raw_ir2, self.raw_ir3, self.raw_ir4, self.sonar1, self.sonar2 = np_data.T
-        self.sonar1_model.raw_data = self.sonar1
-        self.ir3_model.raw_data = self.raw_ir3
-        self.ir4_model.raw_data = self.raw_ir4
-        self.sensor_models = [self.sonar1_model, self.ir3_model, self.ir4_model]
+        self.index, self.time, self.velocity_command, self.raw_ir1, self.raw_ir2, self.raw_ir3, self.raw_ir4, self.sonar1, self.sonar2 = load_log_columns(self.filename, 'test').values()
+        self.set_raw_data()
+
+    def set_raw_data(self):
+        for name, model in self.filter.sensor_models.items():
+            model.raw_data = getattr(self, name)
+        self.sensor_models = list(self.filter.sensor_models.values())
 
     def get_sensor_measurements(self, index):
 
         return [model.calcDist(index) for model in self.sensor_models if model.check_in_range(self.prior)]
 
     def run_data(self):
-        self.measurements.append(self.sonar1_model.calcDist(0))
-
+        #Python floats, as numpy scalars make each push several times slower
+        time = np.asarray(self.time, dtype=float).tolist()
+        velocity_command = np.asarray(self.velocity_command, dtype=float).tolist()
+        readings = {name: np.asarray(getattr(self, name), dtype=float).tolist() for name in self.filter.sensor_models}
+
+        for index in range(len(time)):
+            self.measurements.append(self.filter.push(time[index], velocity_command[index],
+                                                      {name: column[index] for name, column in readings.items()}))
+            #The motion-only track starts with the filter, so is NaN until then like the posterior
+            self.just_motion.append(Measurement_t(math.nan, math.nan) if self.filter.motion is None else self.filter.motion)
+
+        self.prior = self.filter.prior
         self.just_sensor.append(self.measurements[0])
-        self.just_motion.append(self.measurements[0])
-
-        for index in range(1, len(self.time)):
-            self.prior = self.filter.update_prior(self.measurements[-1], self.velocity_command[index], self.time_step(index))
-
-            sensor_measurements = self.get_sensor_measurements(index)
-            
-            self.measurements.append(self.filter.update_posterior(self.prior, sensor_measurements))
-
-            self.just_motion.append(self.filter.update_prior(self.just_motion[-1], self.velocity_command[index], self.time_step(index)))
 
 
     def plot_data(self):
@@ -169,12 +538,8 @@ class TrainingData_t(Data_t):
         self.distance = []
 
     def load_data(self):
-        np_data = np.loadtxt(self.filename, delimiter=',', skiprows=1)
-        self.index, self.time, self.distance, self.velocity_command, self.raw_ir1, self.raw_ir2, self.raw_ir3, self.raw_ir4, self.sonar1, self.sonar2 = np_data.T
-        self.sonar1_model.raw_data = self.sonar1
-        self.ir3_model.raw_data = self.raw_ir3
-        self.ir4_model.raw_data = self.raw_ir4
-        self.sensor_models = [self.sonar1_model, self.ir3_model, self.ir4_model]
+        self.index, self.time, self.distance, self.velocity_command, self.raw_ir1, self.raw_ir2, self.raw_ir3, self.raw_ir4, self.sonar1, self.sonar2 = load_log_columns(self.filename, 'training').values()
+        self.set_raw_data()
 
     def plot_data(self):
         fig, axes = subplots(2)
@@ -195,30 +560,285 @@ class TrainingData_t(Data_t):
 
         show()
 
-def main():
-    # data = Data_t('test.csv')
-    data1 = TrainingData_t("training1.csv")
-    data1.load_data()
-    data1.run_data()
-    data1.plot_data()
+def logKind(filename):
+    """Return the logformats schema of a partA log: 'training' if it has the true range, otherwise 'test'."""
+    with open(filename) as f:
+        return 'training' if 'range' in f.readline().split(',') else 'test'
+
+class KalmanBatch_t:
+    def __init__(self, filenames, sensor_models=None):
+        """Kalman filter run over several logs at once, with its whole state in preallocated arrays.
+
+        Each log is one row of the Nlogs x Nsamples arrays, padded with NaN to the length
+        of the longest log; valid marks the real samples.  Per-sensor arrays are
+        Nlogs x Nsamples x Nsensors, with the sensors in the order of sensor_models
+        (by default sensorModels()).  The first sensor gives the starting position.
+        The information and standard deviation of every reading are worked out up front,
+        except for models that are not monotonic: their readings are kept in prior_raw
+        and inverted at each step about the prior, as KalmanFilter_t.push does.
+        """
+        self.filenames = filenames
+        self.sensor_models = sensorModels() if sensor_models is None else sensor_models
+        self.sensor_names = list(self.sensor_models)
+
+        logs = [load_log_columns(filename, logKind(filename)) for filename in filenames]
+        self.lengths = np.array([len(log['time']) for log in logs])
+        Nlogs, Nsensors, Nsamples = len(logs), len(self.sensor_names), self.lengths.max()
+        self.valid = np.arange(Nsamples) < self.lengths[:, np.newaxis]
+
+        self.time = self.pad(logs, 'time')
+        self.velocity_command = self.pad(logs, 'velocity_command')
+        self.distance = self.pad(logs, 'range')
+        self.raw = np.stack([self.pad(logs, name) for name in self.sensor_names], axis=-1)
+
+        #Invert every sensor reading up front, except those that need the prior
+        self.estimates = np.full((Nlogs, Nsamples, Nsensors), np.nan)
+        self.variances = np.full((Nlogs, Nsamples, Nsensors), np.nan)
+        self.prior_sensors = [sensor for sensor, model in enumerate(self.sensor_models.values())
+                              if not model.monotonic]
+        for sensor, model in enumerate(self.sensor_models.values()):
+            if model.monotonic:
+                self.estimates[..., sensor], self.variances[..., sensor] = model.invert(self.raw[..., sensor])
+        self.prior_raw = self.raw[..., self.prior_sensors]
+        self.available = ~np.isnan(self.estimates)
+        self.available[..., self.prior_sensors] = ~np.isnan(self.prior_raw)
+        self.information = 1/self.variances
+        self.deviations = np.sqrt(self.variances)
+        self.ranges = np.array([model.range for model in self.sensor_models.values()], dtype=float)
+
+        self.reset()
+
+    def reset(self):
+        """Allocate the filter state.  gains holds each sensor's gain, 0 where it was not used."""
+        Nlogs, Nsamples, Nsensors = self.estimates.shape
+        self.prior_mean = np.full((Nlogs, Nsamples), np.nan)
+        self.prior_variance = np.full((Nlogs, Nsamples), np.nan)
+        self.posterior_mean = np.full((Nlogs, Nsamples), np.nan)
+        self.posterior_variance = np.full((Nlogs, Nsamples), np.nan)
+        self.motion_mean = np.full((Nlogs, Nsamples), np.nan)
+        self.motion_variance = np.full((Nlogs, Nsamples), np.nan)
+        self.prior_gain = np.zeros((Nlogs, Nsamples))
+        self.gains = np.zeros((Nlogs, Nsamples, Nsensors))
+
+    def tile(self, count):
+        """Return a batch with the logs repeated 'count' times, row config*Nlogs + log.
+
+        Each repeat can then be run with its own parameters (see run).  Only the
+        arrays run needs are copied, so raw is dropped.
+        """
+        batch = copy.copy(self)
+        batch.filenames = self.filenames*count
+        batch.lengths = np.tile(self.lengths, count)
+        batch.raw = None
+        for name in BATCH_INPUTS:
+            array = getattr(self, name)
+            setattr(batch, name, np.tile(array, (count,) + (1,)*(array.ndim - 1)))
+        batch.reset()
+        return batch
+
+    def pad(self, logs, name):
+        """Return a column of every log as one array, padded with NaN (all NaN for logs without it)."""
+        column = np.full((len(logs), self.lengths.max()), np.nan)
+        for row, log in enumerate(logs):
+            if name in log:
+                column[row, :len(log[name])] = log[name]
+        return column
+
+    def run(self, alpha=ALPHA, velocity_variance=None, gate=GATE_SIGMAS, ranges=None):
+        """Run the filter over every log, giving the same results as KalmanFilter_t.push.
+
+        Up to SCALAR_LOGS logs are stepped one at a time on floats with run_logs, which
+        matches push exactly.  Larger batches, such as tiled parameter sweeps, step every
+        log together with run_arrays, whose sums agree with push to rounding.  The
+        velocity is smoothed twice per sample because the motion-only track shares it,
+        as in KalmanFilter_t.
+
+        The velocity smoothing alpha, the motion model velocity_variance (by default
+        MotionModel_t's), the gate width in standard deviations and the Nsensors x 2
+        sensor ranges (by default the models') can each be given per log, as an
+        Nlogs array (Nlogs x Nsensors x 2 for ranges).
+
+        Models that are not monotonic are inverted at each step about the prior, in one
+        call per sensor for the logs whose readings are finite and in range of it.
+        """
+        if velocity_variance is None:
+            velocity_variance = MotionModel_t().velocity_variance
+        if ranges is None:
+            ranges = self.ranges
+        alpha = np.asarray(alpha, dtype=float)
+        ranges = np.asarray(ranges, dtype=float)
+        lower, upper = ranges[..., 0], ranges[..., 1]
+        time_steps = np.diff(self.time, axis=1)
+        variance_steps = np.reshape(velocity_variance, (-1, 1))*time_steps
+
+        estimates = self.estimates
+        gate_widths = np.reshape(gate, (-1, 1, 1))*self.deviations
+        gates = np.broadcast_to(np.reshape(gate, -1), len(self.lengths))
+        posterior_mean, posterior_variance = self.posterior_mean, self.posterior_variance
+
+        #Each log starts, as in KalmanFilter_t.push, from its first sample with a finite estimate
+        #in range, using the first such sensor.  A log without one (Nsamples) never starts
+        in_range = self.available & (estimates > np.expand_dims(lower, -2)) & (estimates < np.expand_dims(upper, -2))
+        startable = in_range.any(axis=2) & self.valid
+        rows = np.arange(len(self.lengths))
+        start = np.where(startable.any(axis=1), np.argmax(startable, axis=1), self.lengths.max())
+        started = start < self.lengths.max()
+        start_sensor = np.argmax(in_range[rows[started], start[started]], axis=1)
+        posterior_mean[rows[started], start[started]] = estimates[rows[started], start[started], start_sensor]
+        posterior_variance[rows[started], start[started]] = self.variances[rows[started], start[started],
+                                                                           start_sensor]
+        motion_steps = np.zeros_like(self.motion_mean)
+        if len(self.lengths) <= SCALAR_LOGS:
+            self.run_logs(start, alpha, velocity_variance, gate_widths, gates, lower, upper, motion_steps)
+        else:
+            self.run_arrays(start, alpha, variance_steps, gate_widths, gates, lower, upper, motion_steps)
+
+
+        #Sum the motion-only track from each log's start, with NaN before it
+        before = np.arange(self.lengths.max()) < start[:, np.newaxis]
+        at_start = np.arange(self.lengths.max()) == start[:, np.newaxis]
+        motion_steps[at_start] = posterior_mean[at_start]
+        np.cumsum(motion_steps, axis=1, out=self.motion_mean)
+        self.motion_variance[:, 1:] = variance_steps
+        self.motion_variance[at_start] = posterior_variance[at_start]
+        self.motion_variance[before] = 0
+        np.cumsum(self.motion_variance, axis=1, out=self.motion_variance)
+        self.motion_mean[before | ~self.valid] = np.nan
+        self.motion_variance[before | ~self.valid] = np.nan
+        self.prior_gain[~self.valid | before | at_start] = 0
+        self.gains[~self.valid] = 0
+
+    def run_logs(self, start, alpha, velocity_variance, gate_widths, gates, lower, upper, motion_steps):
+        """Step each log in turn with kalmanLoop, for run with few logs.
+
+        The per-sample Python work of a handful of logs on floats costs less than
+        the array calls of run_arrays.
+        """
+        Nlogs, Nsensors = len(self.lengths), len(self.sensor_names)
+        alpha = np.broadcast_to(alpha, Nlogs)
+        velocity_variance = np.broadcast_to(velocity_variance, Nlogs)
+        lower = np.broadcast_to(lower, (Nlogs, Nsensors))
+        upper = np.broadcast_to(upper, (Nlogs, Nsensors))
+        prior_models = [list(self.sensor_models.values())[sensor] for sensor in self.prior_sensors]
+
+        for row, length in enumerate(self.lengths):
+            if start[row] >= length:
+                continue
+            samples = slice(0, length)
+            prior_inputs = [(sensor, model, self.prior_raw[row, samples, raw_column].tolist(), float(gates[row]))
+                            for raw_column, (sensor, model) in enumerate(zip(self.prior_sensors, prior_models))]
+            results = kalmanLoop(self.time[row, samples].tolist(), self.velocity_command[row, samples].tolist(),
+                                 self.estimates[row, samples].tolist(), self.information[row, samples].tolist(),
+                                 gate_widths[row, samples].tolist(),
+                                 lower[row].tolist(), upper[row].tolist(), float(alpha[row]),
+                                 float(velocity_variance[row]), int(start[row]),
+                                 float(self.posterior_mean[row, start[row]]),
+                                 float(self.posterior_variance[row, start[row]]), prior_inputs)
+            for array, result in zip((self.prior_mean, self.prior_variance, self.posterior_mean,
+                                      self.posterior_variance, self.prior_gain, self.gains, motion_steps), results):
+                array[row, samples] = result
+
+    def run_arrays(self, start, alpha, variance_steps, gate_widths, gates, lower, upper, motion_steps):
+        """Step all the logs together with array operations, for run with many logs.
+
+        The Python work per sample does not depend on the number of logs or sensors.
+        Logs are masked until they start, which stops mattering once every log has.
+        """
+        time_steps = np.diff(self.time, axis=1)
+        estimates, information, available = self.estimates, self.information, self.available
+        prior_models = [list(self.sensor_models.values())[sensor] for sensor in self.prior_sensors]
+        prior_mean, prior_variance = self.prior_mean, self.prior_variance
+        posterior_mean, posterior_variance = self.posterior_mean, self.posterior_variance
+        last_start = start.max()
+        velocity = np.zeros(len(self.lengths))
+
+        for index in range(1, self.lengths.max()):
+            command = self.velocity_command[:, index]
+            time_step = time_steps[:, index-1]
+            masked = index <= last_start
+            running = index > start
+
+            #Prior from the motion model
+            velocity = smoothVelocity(velocity, command, alpha)
+            if masked:
+                velocity = np.where(running, velocity, 0)
+            prior = posterior_mean[:, index-1] + velocity*time_step
+            prior_var = posterior_variance[:, index-1] + variance_steps[:, index-1]
+            prior_mean[:, index] = prior
+            prior_variance[:, index] = prior_var
+
+            #Invert the readings that need the prior
+            step_estimates = estimates[:, index]
+            step_information = information[:, index]
+            step_widths = gate_widths[:, index]
+            if prior_models:
+                #Copies, as the inputs can be shared with other processes
+                step_estimates, step_information, step_widths = [array.copy() for array in
+                                                                 (step_estimates, step_information, step_widths)]
+            for raw_column, (sensor, model) in enumerate(zip(self.prior_sensors, prior_models)):
+                mask = available[:, index, sensor] & (prior > lower[..., sensor]) & (prior < upper[..., sensor])
+                estimate, variance = model.invert(self.prior_raw[mask, index, raw_column], prior[mask])
+                step_estimates[mask, sensor] = estimate
+                step_information[mask, sensor] = 1/variance
+                step_widths[mask, sensor] = gates[mask]*np.sqrt(variance)
+
+            #Fuse the sensors in range of the prior
+            column = prior[:, np.newaxis]
+            used = gateReadings(prior, step_estimates, step_widths,
+                                available[:, index] & (column > lower) & (column < upper))
+            mean, variance, self.prior_gain[:, index], self.gains[:, index] = fuseInformation(
+                prior, prior_var, step_estimates, step_information, used)
+            if masked:
+                mean = np.where(running, mean, posterior_mean[:, index])
+                variance = np.where(running, variance, posterior_variance[:, index])
+            posterior_mean[:, index] = mean
+            posterior_variance[:, index] = variance
+
+            #The motion-only track only needs its velocity here; it is summed after the loop
+            velocity = smoothVelocity(velocity, command, alpha)
+            if masked:
+                velocity = np.where(running, velocity, 0)
+            motion_steps[:, index] = velocity*time_step
+
+    def errors(self):
+        """Return the error of the posterior mean against the true range (NaN for test logs and padding)."""
+        return self.distance - self.posterior_mean
+
+    def plot_data(self):
+        """Plot each training log as TrainingData_t.plot_data does."""
+        for row, length in enumerate(self.lengths):
+            if np.isnan(self.distance[row, 0]):
+                continue
+            time = self.time[row, :length]
 
-    data2 = TrainingData_t("training2.csv")
-    data2.load_data()
-    data2.run_data()
-    data2.plot_data()
+            fig, axes = subplots(2)
+            fig.suptitle('Kalman Filter')
+
+            axes[0].plot(time, self.distance[row, :length])
+            axes[0].plot(time, self.posterior_mean[row, :length])
+            axes[0].legend(['Actual', 'Predicted', 'Just Motion'])
+
+            axes[1].set_title("Error")
+            axes[1].plot(time, self.errors()[row, :length])
+
+            print(np.mean(self.errors()[row, :length]))
+
+            show()
+
+def main():
+    # Both training logs are filtered together; add 'test.csv' to filter it too
+    batch = KalmanBatch_t(["training1.csv", "training2.csv"])
+    batch.run()
+    batch.plot_data()
 
     fig, axes = subplots(1,2, figsize=(12,4))
-    axes[0].plot(data1.time, data1.distance)
-    axes[0].plot(data1.time, [measurement.mle for measurement in data1.measurements])
-    axes[0].legend(['Actual', 'Predicted', 'Just Motion'])
-    axes[0].set_ylabel('x [m]')
-    axes[0].set_xlabel('t [s]')
-
-    axes[1].plot(data2.time, data2.distance)
-    axes[1].plot(data2.time, [measurement.mle for measurement in data2.measurements])
-    axes[1].legend(['Actual', 'Predicted', 'Just Motion'])
-    axes[1].set_ylabel('x [m]')
-    axes[1].set_xlabel('t [s]')
+    for row in range(2):
+        length = batch.lengths[row]
+        axes[row].plot(batch.time[row, :length], batch.distance[row, :length])
+        axes[row].plot(batch.time[row, :length], batch.posterior_mean[row, :length])
+        axes[row].legend(['Actual', 'Predicted', 'Just Motion'])
+        axes[row].set_ylabel('x [m]')
+        axes[row].set_xlabel('t [s]')
 
     show()
 
@@ -9,6 +9,8 @@ from matplotlib.pyplot import *
 from matplotlib.ticker import PercentFormatter
 from scipy.optimize import curve_fit
 
+from shared_logs import load_log_columns
+
 class Sensor_t:
     def __init__(self):
         """Class for holding parameters relating to the sensors"""
@@ -22,9 +24,6 @@ def modelLinear(x, a, b):
 def modelParabola(x, a, b, c):
     return a + b * x + c * x * x
 
-def inverseParabola(z, a, b, c):
-    return np.roots(c, b, a - z)
-
 def modelHyperbole(x, a, b):
     return a + b / x 
 
@@ -35,7 +34,26 @@ def inverseLinear(z, m, c):
     return (z - c)/m
 
 def inverseHyperbola(z, a, b):
-    return a/(z-b)
+    return b/(z-a)
+
+def inverseParabola(z, a, b, c, branch=1):
+    """Return the x where a + b*x + c*x**2 = z, for arrays.
+
+    branch 1 gives the root right of the vertex and -1 the root left of it.  Readings
+    beyond the vertex give the vertex.
+    """
+    discriminant = np.maximum(b**2 - 4*c*(a - z), 0)
+    return (-b + branch*np.sign(c)*np.sqrt(discriminant))/(2*c)
+
+def fitRegion(curve, x, z, final_deviation=0.1):
+    """Fit a curve, refit it without the outliers and return the parameters and residual variance."""
+    params, cov = curve_fit(curve, x, z)
+    z_error = z - curve(x, *params)
+
+    x_1, z_1 = iterative_fitting(curve, final_deviation, x, z, z_error)
+    params_1, cov = curve_fit(curve, x_1, z_1)
+    var = np.var(z_1 - curve(x_1, *params_1))
+    return params_1, var
 
 def iterative_fitting(curve, final_deviation, x, z, z_error):
     deviation = np.std(z_error)
@@ -58,13 +76,10 @@ def modelIR3(plot=False):
     BREAK_POINT_1 = 1000
     final_deviation = 0.1
 
-    # Load data
+    # Load data, split into columns
     filename = 'calibration.csv'
-    data = np.loadtxt(filename, delimiter=',', skiprows=1)
-
-    # Split into columns
     index, time, distance, velocity_command, raw_ir1, raw_ir2, raw_ir3, raw_ir4, \
-        sonar1, sonar2 = data.T
+        sonar1, sonar2 = load_log_columns(filename, 'calibration').values()
 
     # Non Linear Region
     x_1 = distance[0:BREAK_POINT_1]
@@ -120,13 +135,10 @@ def modelIR4(plot=False):
     BREAK_POINT_2 = 655
     final_deviation = 0.1
 
-    # Load data
+    # Load data, split into columns
     filename = 'calibration.csv'
-    data = np.loadtxt(filename, delimiter=',', skiprows=1)
-
-    # Split into columns
     index, time, distance, velocity_command, raw_ir1, raw_ir2, raw_ir3, raw_ir4, \
-        sonar1, sonar2 = data.T
+        sonar1, sonar2 = load_log_columns(filename, 'calibration').values()
 
     # Parabolic Region
     x_1 = distance[0:BREAK_POINT_1]
@@ -203,13 +215,10 @@ def modelSonar(plot=False):
 
     final_deviation = 0.1
 
-    # Load data
+    # Load data, split into columns
     filename = 'calibration.csv'
-    data = np.loadtxt(filename, delimiter=',', skiprows=1)
-
-    # Split into columns
     index, time, distance, velocity_command, raw_ir1, raw_ir2, raw_ir3, raw_ir4, \
-        sonar1, sonar2 = data.T
+        sonar1, sonar2 = load_log_columns(filename, 'calibration').values()
 
     # Linear Region
     x_1 = distance
@@ -243,8 +252,73 @@ def modelSonar(plot=False):
         show()
     return params_1, var
 
+def modelShortIR(name, plot=False):
+    """Fit the short range IR sensor in column 'name' ('raw_ir1' or 'raw_ir2').
+
+    The readings fall with distance like a hyperbola up to about 0.6 m, then
+    flatten out into noise, so only that region is fitted.
+    """
+    BREAK_DISTANCE = 0.6
+
+    # Load data, the calibration run is not sorted by distance so split on distance
+    filename = 'calibration.csv'
+    columns = load_log_columns(filename, 'calibration')
+    distance = columns['range']
+    raw = columns[name]
+
+    # Hyperbolic region
+    region = distance < BREAK_DISTANCE
+    params, var = fitRegion(modelHyperbole, distance[region], raw[region])
+
+    if (plot == True):
+        fig, axes = subplots(2)
+        fig.suptitle(name)
+
+        axes[0].plot(distance, raw, '.', alpha=0.2)
+        axes[0].plot(distance[region], modelHyperbole(distance[region], *params), '.', alpha=0.2)
+
+        axes[1].plot(distance[region], raw[region] - modelHyperbole(distance[region], *params), '.', alpha=0.2)
+
+        show()
+    return params, var
+
+def modelIR1(plot=False):
+    return modelShortIR('raw_ir1', plot)
+
+def modelIR2(plot=False):
+    return modelShortIR('raw_ir2', plot)
+
+def modelSonar2(plot=False):
+    """Fit sonar2, ignoring the readings below 0.25 m where it drops out."""
+    MIN_DISTANCE = 0.25
+
+    # Load data
+    filename = 'calibration.csv'
+    columns = load_log_columns(filename, 'calibration')
+    distance = columns['range']
+    sonar2 = columns['sonar2']
+
+    # Linear Region
+    region = distance > MIN_DISTANCE
+    params, var = fitRegion(modelLinear, distance[region], sonar2[region])
+
+    if (plot == True):
+        fig, axes = subplots(2)
+        fig.suptitle('Sonar 2')
+
+        axes[0].plot(distance, sonar2, '.', alpha=0.2)
+        axes[0].plot(distance[region], modelLinear(distance[region], *params), '.', alpha=0.2)
+
+        axes[1].plot(distance[region], sonar2[region] - modelLinear(distance[region], *params), '.', alpha=0.2)
+
+        show()
+    return params, var
+
 
 # modelIR3(True)
 # modelIR4(True)
 # modelSonar(True)
+# modelIR1(True)
+# modelIR2(True)
+# modelSonar2(True)
 
@@ -0,0 +1,85 @@
+"""Module to run the Kalman filter live on samples streamed from the robot.
+
+The robot writes samples as CSV lines in the log format (a header line, then
+one line per sample) to a pipe or socket.  readSamples parses them from an
+asyncio StreamReader and filterStream pushes each one through a
+KalmanFilter_t as it arrives.  replayLog stands in for the robot by feeding a
+saved log into a StreamReader at a fixed interval:
+
+    python stream_fusion.py test.csv --interval 0.05
+
+S.W. Bain and M.C. Gardyne
+"""
+
+import argparse
+import asyncio
+import time
+from sensor_fusion import KalmanFilter_t
+
+def parseSample(columns, line):
+    """Return the (time, velocity_command, readings) of a CSV line with the given column names."""
+    values = dict(zip(columns, line.split(',')))
+    readings = {name: float(value) for name, value in values.items()
+                if name not in ('', 'index', 'time', 'range', 'velocity_command')}
+    return float(values['time']), float(values['velocity_command']), readings
+
+async def readSamples(reader):
+    """Yield samples from a StreamReader of CSV lines until it is closed."""
+    columns = None
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        line = line.decode().strip()
+        if not line:
+            continue
+        if columns is None:
+            columns = line.split(',')
+            continue
+        yield parseSample(columns, line)
+
+async def filterStream(kalman_filter, samples):
+    """Push each sample through the filter as it arrives and yield (time, posterior, latency in s)."""
+    async for sample_time, velocity_command, readings in samples:
+        start = time.perf_counter()
+        posterior = kalman_filter.push(sample_time, velocity_command, readings)
+        yield sample_time, posterior, time.perf_counter() - start
+
+async def replayLog(filename, reader, interval=0.0):
+    """Feed the lines of a log into a StreamReader, one sample every 'interval' seconds."""
+    with open(filename, 'rb') as f:
+        for line in f:
+            reader.feed_data(line)
+            await asyncio.sleep(interval)
+    reader.feed_eof()
+
+async def runStream(filename, interval=0.0, quiet=False):
+    """Filter a log replayed through a StreamReader, printing each posterior as it is made."""
+    reader = asyncio.StreamReader()
+    producer = asyncio.create_task(replayLog(filename, reader, interval))
+
+    Nsamples = 0
+    total_latency = 0.0
+    max_latency = 0.0
+    async for sample_time, posterior, latency in filterStream(KalmanFilter_t(), readSamples(reader)):
+        Nsamples += 1
+        total_latency += latency
+        max_latency = max(max_latency, latency)
+        if not quiet:
+            print('%.6f,%.6f,%.6g' % (sample_time, posterior.mle, posterior.variance))
+
+    await producer
+    print('Filtered %d samples, mean latency %.1f us, max %.1f us' %
+          (Nsamples, 1e6*total_latency/max(Nsamples, 1), 1e6*max_latency))
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the Kalman filter on a log replayed as a live stream.')
+    parser.add_argument('log', nargs='?', default='test.csv', help='log to replay (default test.csv)')
+    parser.add_argument('--interval', type=float, default=0.0, help='seconds between samples (default 0)')
+    parser.add_argument('--quiet', action='store_true', help='only print the latency summary')
+    args = parser.parse_args()
+
+    asyncio.run(runStream(args.log, args.interval, args.quiet))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Tests for the Kalman filter in sensor_fusion.py, run with pytest from partA.
+
+S.W. Bain and M.C. Gardyne
+"""
+
+import os
+import numpy as np
+from sensor_fusion import Data_t, TrainingData_t, KalmanBatch_t, KalmanFilter_t, PiecewiseSensorModel_t, \
+    MotionModel_t, SEGMENT_TYPES, SCALAR_LOGS, piecewiseModels, sensorModels
+from shared_logs import load_log_columns
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TRAINING_LOGS = [os.path.join(HERE, 'training1.csv'), os.path.join(HERE, 'training2.csv')]
+TEST_LOG = os.path.join(HERE, 'test.csv')
+
+
+def pushLog(filename, sensor_models):
+    """Push every sample of a training log through a KalmanFilter_t and return the posterior means and variances."""
+    log = load_log_columns(filename, 'training')
+    kalman_filter = KalmanFilter_t(sensor_models)
+    posteriors = [kalman_filter.push(log['time'][index], log['velocity_command'][index],
+                                     {name: log[name][index] for name in sensor_models})
+                  for index in range(len(log['time']))]
+    return np.array([[posterior.mle, posterior.variance] for posterior in posteriors])
+
+
+def test_batch_matches_run_data():
+    batch = KalmanBatch_t(TRAINING_LOGS + [TEST_LOG])
+    batch.run()
+
+    logs = [TrainingData_t(TRAINING_LOGS[0]), TrainingData_t(TRAINING_LOGS[1]), Data_t(TEST_LOG)]
+    for row, data in enumerate(logs):
+        data.load_data()
+        data.run_data()
+        length = batch.lengths[row]
+        np.testing.assert_array_equal([measurement.mle for measurement in data.measurements],
+                                      batch.posterior_mean[row, :length])
+        np.testing.assert_array_equal([measurement.variance for measurement in data.measurements],
+                                      batch.posterior_variance[row, :length])
+        np.testing.assert_array_equal([measurement.mle for measurement in data.just_motion],
+                                      batch.motion_mean[row, :length])
+        assert np.all(np.isnan(batch.posterior_mean[row, length:]))
+
+
+def test_tiled_batch_runs_each_configuration():
+    batch = KalmanBatch_t(TRAINING_LOGS)
+    Nlogs = len(TRAINING_LOGS)
+    alphas = np.array([0.02, 0.08])
+    gates = np.array([2.0, 6.0])
+    variances = MotionModel_t().velocity_variance*np.array([0.5, 2])
+
+    tiled = batch.tile(len(alphas))
+    tiled.run(np.repeat(alphas, Nlogs), np.repeat(variances, Nlogs), np.repeat(gates, Nlogs))
+    for config in range(len(alphas)):
+        batch.reset()
+        batch.run(alphas[config], variances[config], gates[config])
+        rows = slice(config*Nlogs, (config + 1)*Nlogs)
+        np.testing.assert_array_equal(tiled.posterior_mean[rows], batch.posterior_mean)
+        np.testing.assert_array_equal(tiled.gains[rows], batch.gains)
+
+
+def test_large_batch_matches_small_batch():
+    #Batches over SCALAR_LOGS step every log together with arrays, whose sums differ only in rounding
+    batch = KalmanBatch_t(TRAINING_LOGS + [TEST_LOG])
+    batch.run()
+    count = SCALAR_LOGS//len(batch.lengths) + 1
+    tiled = batch.tile(count)
+    tiled.run()
+    for name in ('prior_mean', 'posterior_mean', 'posterior_variance', 'motion_mean', 'motion_variance',
+                 'prior_gain', 'gains'):
+        expected = getattr(batch, name)
+        np.testing.assert_allclose(getattr(tiled, name), np.tile(expected, (count,) + (1,)*(expected.ndim - 1)),
+                                   rtol=1e-12, atol=1e-15)
+
+
+def test_wide_ir4_is_inverted_about_the_prior():
+    #Over 0.1 to 4 m the IR4 fit rises then falls, so its readings need the prior to invert
+    ir4 = piecewiseModels()['raw_ir4']
+    wide = PiecewiseSensorModel_t(ir4.breakpoints, [SEGMENT_TYPES[kind] for kind in ir4.segment_types],
+                                  ir4.parameters, ir4.model_variances, [0.1, 4])
+    assert not wide.monotonic
+
+    models = sensorModels()
+    models['raw_ir4'] = wide
+    batch = KalmanBatch_t(TRAINING_LOGS, models)
+    batch.run()
+
+    ir4_column = list(models).index('raw_ir4')
+    assert np.any(batch.gains[..., ir4_column] > 0)
+    assert np.all(np.isfinite(batch.posterior_mean[batch.valid]))
+    for row, filename in enumerate(TRAINING_LOGS):
+        posteriors = pushLog(filename, models)
+        length = batch.lengths[row]
+        np.testing.assert_array_equal(posteriors[:, 0], batch.posterior_mean[row, :length])
+        np.testing.assert_array_equal(posteriors[:, 1], batch.posterior_variance[row, :length])
+
+    tiled = batch.tile(SCALAR_LOGS//len(TRAINING_LOGS) + 1)
+    tiled.run()
+    np.testing.assert_allclose(tiled.posterior_mean[:len(TRAINING_LOGS)], batch.posterior_mean, rtol=1e-12)
+
+
+def test_push_waits_for_a_usable_reading():
+    #Blank every sensor for three samples and sonar1 for five, and leave raw_ir1 out.  At the fourth
+    #sample raw_ir3 reads below its range, so the filter starts from raw_ir4
+    models = sensorModels()
+    log = load_log_columns(TRAINING_LOGS[0], 'training')
+    raw = {name: np.array(log[name], dtype=float) for name in models}
+    for name in models:
+        raw[name][:3] = np.nan
+    raw['sonar1'][:5] = np.nan
+    del raw['raw_ir1']
+
+    kalman_filter = KalmanFilter_t(models)
+    means = [kalman_filter.push(log['time'][index], log['velocity_command'][index],
+                                {name: column[index] for name, column in raw.items()}).mle
+             for index in range(len(log['time']))]
+    assert np.all(np.isnan(means[:3]))
+    assert means[3] == models['raw_ir4'].measure(raw['raw_ir4'][3]).mle
+
+    batch = KalmanBatch_t(TRAINING_LOGS[:1], models)
+    for sensor, name in enumerate(models):
+        column = raw.get(name, np.full(len(log['time']), np.nan))
+        batch.estimates[0, :, sensor], batch.variances[0, :, sensor] = models[name].invert(column)
+    batch.available = ~np.isnan(batch.estimates)
+    batch.information = 1/batch.variances
+    batch.deviations = np.sqrt(batch.variances)
+    batch.run()
+    np.testing.assert_array_equal(means, batch.posterior_mean[0])
+
+    data = TrainingData_t(TRAINING_LOGS[0])
+    data.load_data()
+    for name in models:
+        setattr(data, name, raw.get(name, np.full(len(log['time']), np.nan)))
+    data.run_data()
+    np.testing.assert_array_equal(means, [measurement.mle for measurement in data.measurements])
+    assert np.all(np.isnan([measurement.mle for measurement in data.just_motion[:3]]))
+    np.testing.assert_array_equal([measurement.mle for measurement in data.just_motion], batch.motion_mean[0])
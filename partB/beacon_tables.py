@@ -0,0 +1,199 @@
+"""Lookup tables of the expected range and bearing to each beacon.
+
+The beacons do not move, so the range and bearing from any point to a beacon
+can be tabulated once over an (x, y) grid.  sensor_model can then interpolate
+them from the tables instead of calling sqrt and arctan2 for every particle.
+
+The tables for a beacon are built the first time it is seen, saved to disk so
+later runs can load them, and only the most recently used ones are kept in
+memory.  The grid resolution trades accuracy for memory:
+
+    tables = BeaconTables(beacon_locs, bounds, resolution=0.05)
+    weights = sensor_model(poses, beacon_pose, beacon_loc, tables=tables, beacon_ids=ids)
+
+Sam Bain/Mark Gardyne,
+Department of Electrical and Computer Engineering
+University of Canterbury
+"""
+
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+import numpy as np
+from utils import wraptopi
+
+# Bump this to invalidate saved tables if their layout changes
+TABLE_VERSION = 1
+
+
+class BeaconTables(object):
+
+    def __init__(self, beacon_locs, bounds, resolution=0.05, margin=1.0, max_bytes=256e6,
+                 cache_dir='.beacon_tables', dtype=np.float64, interpolation='bilinear'):
+        """Tables for each beacon over the region 'bounds' (Xmin, Xmax, Ymin, Ymax).
+
+        beacon_locs: an Nbeacons x 3 array of beacon poses indexed by beacon id.
+
+        resolution: grid spacing (m).  The interpolation error is largest close to
+        a beacon and shrinks with the square of the spacing.
+
+        margin: distance (m) the grid extends beyond bounds.  Points outside the
+        grid are computed exactly.
+
+        max_bytes: memory the tables kept in memory may use.  The least recently
+        used tables are dropped to stay under it.
+
+        cache_dir: directory the tables are saved in, or None to not save them.
+
+        dtype: dtype of the tables.  float32 halves their size, but lookups convert
+        the coefficients back to float64.
+
+        interpolation: 'bilinear', or 'nearest' to use the value at the nearest grid
+        point.  'nearest' tables are a quarter of the size and faster to look up,
+        but need a finer grid for the same accuracy; the range error is up to
+        resolution / sqrt(2).
+        """
+        if interpolation not in ('bilinear', 'nearest'):
+            raise ValueError('Unknown interpolation %s' % interpolation)
+        Xmin, Xmax, Ymin, Ymax = bounds
+        self.beacon_locs = beacon_locs
+        self.resolution = resolution
+        self.x0 = Xmin - margin
+        self.y0 = Ymin - margin
+        self.nx = int(np.ceil((Xmax - Xmin + 2 * margin) / resolution)) + 1
+        self.ny = int(np.ceil((Ymax - Ymin + 2 * margin) / resolution)) + 1
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.dtype = np.dtype(dtype)
+        self.interpolation = interpolation
+
+        self.tables = OrderedDict()
+        self.builds = 0
+        self.loads = 0
+
+    def table(self, beacon_id):
+        """Return the (range, bearing) tables for a beacon, building or loading them if needed.
+
+        For bilinear interpolation each table is a 4 x (nx - 1) * (ny - 1) array with a
+        column per grid cell of the coefficients (a, b, c, d) of the interpolant
+        a + b*u + c*v + d*u*v, where u, v in [0, 1) are the position within the cell.
+        The bearing coefficients are made from wrapped differences, so the
+        interpolant does not jump where the bearing wraps round.  For nearest
+        interpolation each table is the nx * ny values at the grid points.
+        """
+        if beacon_id in self.tables:
+            self.tables.move_to_end(beacon_id)
+            return self.tables[beacon_id]
+
+        filename = self.cache_filename(beacon_id)
+        if filename is not None and os.path.exists(filename):
+            with np.load(filename) as saved:
+                table = saved['range'], saved['bearing']
+            self.loads += 1
+        else:
+            table = self.build(beacon_id)
+            self.builds += 1
+            if filename is not None:
+                self.save(filename, table)
+
+        self.tables[beacon_id] = table
+        while len(self.tables) > 1 and self.nbytes() > self.max_bytes:
+            self.tables.popitem(last=False)
+        return table
+
+    def nbytes(self):
+        """Return the memory used by the tables in memory."""
+        return sum(t.nbytes for table in self.tables.values() for t in table)
+
+    def build(self, beacon_id):
+        """Tabulate the range and bearing to a beacon at the grid points and fit each cell."""
+        beacon_x, beacon_y = self.beacon_locs[beacon_id, :2]
+        x = self.x0 + self.resolution * np.arange(self.nx)[:, np.newaxis]
+        y = self.y0 + self.resolution * np.arange(self.ny)[np.newaxis, :]
+
+        r = np.sqrt((beacon_x - x)**2 + (beacon_y - y)**2)
+        bearing = np.arctan2(beacon_y - y, beacon_x - x)
+
+        if self.interpolation == 'nearest':
+            return r.ravel().astype(self.dtype), bearing.ravel().astype(self.dtype)
+
+        #Values at the four corners of each cell, bearings relative to the first corner
+        r00, r10, r01, r11 = r[:-1, :-1], r[1:, :-1], r[:-1, 1:], r[1:, 1:]
+        b00 = bearing[:-1, :-1]
+        b10 = wraptopi(bearing[1:, :-1] - b00)
+        b01 = wraptopi(bearing[:-1, 1:] - b00)
+        b11 = wraptopi(bearing[1:, 1:] - b00)
+
+        range_table = np.stack((r00, r10 - r00, r01 - r00, r11 - r10 - r01 + r00))
+        bearing_table = np.stack((b00, b10, b01, b11 - b10 - b01))
+        return (range_table.reshape(4, -1).astype(self.dtype),
+                bearing_table.reshape(4, -1).astype(self.dtype))
+
+    def cache_filename(self, beacon_id):
+        """Return the file the tables for a beacon are saved in, or None if not saving."""
+        if self.cache_dir is None:
+            return None
+        key = repr((TABLE_VERSION, tuple(self.beacon_locs[beacon_id]), self.x0, self.y0, self.nx, self.ny,
+                    self.resolution, self.dtype.str, self.interpolation))
+        return os.path.join(self.cache_dir, 'beacon%d-%s.npz' % (beacon_id, hashlib.sha1(key.encode()).hexdigest()[:16]))
+
+    def save(self, filename, table):
+        """Save tables via a temporary file, so other processes never load a partial file."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, range=table[0], bearing=table[1])
+        os.replace(tmp, filename)
+
+    def lookup(self, beacon_ids, x, y):
+        """Return the range and bearing (in the map frame) from points (x, y) to each beacon.
+
+        x and y are M element arrays and beacon_ids has K elements.  Returns two
+        M x K arrays.
+        """
+        x = np.asarray(x)
+        y = np.asarray(y)
+        M = len(x)
+        r = np.empty((M, len(beacon_ids)))
+        bearing = np.empty((M, len(beacon_ids)))
+
+        #Position (u, v) on the grid
+        u = (x - self.x0) / self.resolution
+        v = (y - self.y0) / self.resolution
+        outside = (u < 0) | (u >= self.nx - 1) | (v < 0) | (v >= self.ny - 1)
+        any_outside = outside.any()
+
+        if self.interpolation == 'nearest':
+            #Index of the nearest grid point
+            index = (u + 0.5).astype(np.intp) * self.ny + (v + 0.5).astype(np.intp)
+            if any_outside:
+                index[outside] = 0
+            for k, beacon_id in enumerate(beacon_ids):
+                range_table, bearing_table = self.table(beacon_id)
+                r[:, k] = np.take(range_table, index)
+                bearing[:, k] = np.take(bearing_table, index)
+        else:
+            #Cell containing each point and the position within it
+            i = u.astype(np.intp)
+            j = v.astype(np.intp)
+            cell = i * (self.ny - 1) + j
+            if any_outside:
+                cell[outside] = 0
+            u -= i
+            v -= j
+            uv = u * v
+            for k, beacon_id in enumerate(beacon_ids):
+                #Each coefficient is gathered from its own contiguous row of the table
+                for table, out in zip(self.table(beacon_id), (r, bearing)):
+                    a, b, c, d = [np.take(coefficients, cell) for coefficients in table]
+                    out[:, k] = a + b * u + c * v + d * uv
+
+        if any_outside:
+            #Points off the grid are computed exactly
+            for k, beacon_id in enumerate(beacon_ids):
+                beacon_x, beacon_y = self.beacon_locs[beacon_id, :2]
+                r[outside, k] = np.sqrt((beacon_x - x[outside])**2 + (beacon_y - y[outside])**2)
+                bearing[outside, k] = np.arctan2(beacon_y - y[outside], beacon_x - x[outside])
+
+        return r, bearing
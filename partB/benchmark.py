@@ -0,0 +1,241 @@
+"""Benchmarks for the particle filter hot paths.
+
+Times motion_model, sensor_model (with and without lookup tables), resample, the degeneracy test and
+transform_pose, plus the full filter step loop, over a sweep of particle
+counts.  The inputs are taken from the shipped data.csv and beacon_map.csv
+so the numbers reflect the real workload.  Results are saved as JSON so that
+two revisions can be compared:
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json
+    python benchmark.py --compare before.json after.json
+
+Sam Bain/Mark Gardyne,
+Department of Electrical and Computer Engineering
+University of Canterbury
+"""
+
+from __future__ import print_function, division
+import argparse
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+from numpy.random import uniform, seed
+
+from models import motion_model, sensor_model
+from fused import fused_step, HAVE_NUMBA
+from beacon_tables import BeaconTables
+from utils import resample, normalise_log_weights, is_degenerate
+from transform import transform_pose
+from logs import load_data, load_beacon_map
+from particle_filter import ParticleFilter, ParticleSetFilter, filter_bounds
+
+DEFAULT_COUNTS = [10**2, 10**3, 10**4, 10**5, 10**6]
+
+
+def time_kernel(func, min_time=0.2, min_repeats=3):
+    """Call func repeatedly and return the median time per call (s) and peak memory (bytes).
+
+    Calls are repeated until at least 'min_time' seconds and 'min_repeats' calls have
+    elapsed.  Peak memory is measured with tracemalloc over a separate single call, so
+    tracing does not slow down the timed calls.
+    """
+    times = []
+    total = 0.0
+    while total < min_time or len(times) < min_repeats:
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        times.append(elapsed)
+        total += elapsed
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return float(np.median(times)), peak
+
+
+def random_poses(bounds, Nparticles):
+    """Return Nparticles poses spread uniformly across 'bounds'."""
+    Xmin, Xmax, Ymin, Ymax = bounds
+    return np.column_stack((uniform(Xmin, Xmax, Nparticles),
+                            uniform(Ymin, Ymax, Nparticles),
+                            uniform(-np.pi, np.pi, Nparticles)))
+
+
+def benchmark_kernels(log, beacon_locs, Nparticles, min_time):
+    """Time each kernel on Nparticles particles and return a list of result dicts."""
+    t, commands, slam_poses, odom_poses, beacon_ids, beacon_poses = log
+    bounds = filter_bounds(slam_poses)
+
+    # A representative moving step and a step where a beacon is seen
+    n = int(np.argmax(np.hypot(*(odom_poses[1:, :2] - odom_poses[:-1, :2]).T))) + 1
+    b = int(np.flatnonzero(beacon_ids >= 0)[0])
+    dt = (t[n] - t[n - 1]) * 1e-9
+
+    poses = random_poses(bounds, Nparticles)
+    log_weights = sensor_model(poses, beacon_poses[b], beacon_locs[beacon_ids[b]], log=True)
+    normalised = log_weights.copy()
+    normalise_log_weights(normalised)
+    tf = np.array(odom_poses[n] - odom_poses[n - 1])
+    out = np.empty_like(poses)
+
+    # Build the lookup tables for the beacon before timing
+    tables = BeaconTables(beacon_locs, bounds, cache_dir=None)
+    tables.table(beacon_ids[b])
+
+    kernels = [
+        ('motion_model', lambda: motion_model(poses, commands[n - 1], odom_poses[n], odom_poses[n - 1], dt)),
+        ('sensor_model', lambda: sensor_model(poses, beacon_poses[b], beacon_locs[beacon_ids[b]], log=True)),
+        ('sensor_model_tables', lambda: sensor_model(poses, beacon_poses[b], beacon_locs[beacon_ids[b]], log=True,
+                                                     tables=tables, beacon_ids=beacon_ids[b])),
+        ('is_degenerate', lambda: is_degenerate(normalised, normalise_log_weights(log_weights.copy())[1])),
+        ('transform_pose', lambda: transform_pose(tf, poses)),
+    ]
+    for backend in ('numpy', 'numba') if HAVE_NUMBA else ('numpy',):
+        kernels.append(('fused_step_' + backend,
+                        lambda backend=backend: fused_step(poses, log_weights, commands[n - 1], odom_poses[n],
+                                                           odom_poses[n - 1], dt, beacon_poses[b],
+                                                           beacon_locs[beacon_ids[b]], backend=backend)))
+    for method in ('multinomial', 'stratified', 'systematic', 'residual'):
+        kernels.append(('resample_' + method,
+                        lambda method=method: resample(poses, normalised, Nparticles, method, out=out, log=True)))
+
+    results = []
+    for name, func in kernels:
+        time_per_call, peak = time_kernel(func, min_time)
+        results.append(result(name, Nparticles, time_per_call, peak))
+    return results
+
+
+def benchmark_step_loop(log, beacon_locs, Nparticles, Nsteps, dtype=None):
+    """Time the full filter step loop over the first Nsteps of the log with a fixed particle count.
+
+    If 'dtype' is given the particles are kept in a ParticleSet of that dtype.
+    """
+    t, commands, slam_poses, odom_poses, beacon_ids, beacon_poses = log
+    Nsteps = min(Nsteps, len(t) - 1)
+
+    if dtype is None:
+        pf = ParticleFilter(beacon_locs, filter_bounds(slam_poses), Nparticles, resample_method='systematic')
+        name = 'step_loop'
+    else:
+        pf = ParticleSetFilter(beacon_locs, filter_bounds(slam_poses), Nparticles, max_particles=Nparticles,
+                               resample_method='systematic', dtype=dtype)
+        name = 'step_loop_' + np.dtype(dtype).name
+
+    def run():
+        for n in range(1, Nsteps + 1):
+            pf.step(commands[n - 1], odom_poses[n], odom_poses[n - 1], (t[n] - t[n - 1]) * 1e-9,
+                    beacon_ids[n], beacon_poses[n])
+
+    time_per_loop, peak = time_kernel(run, min_time=0, min_repeats=1)
+    return result(name, Nparticles, time_per_loop / Nsteps, peak)
+
+
+def result(name, Nparticles, time_per_call, peak):
+    return {'kernel': name,
+            'particles': Nparticles,
+            'time_per_step': time_per_call,
+            'particles_per_second': Nparticles / time_per_call,
+            'peak_memory_bytes': peak}
+
+
+def revision():
+    """Return the git revision of the working tree, or None outside a repository."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(counts, Nsteps, min_time, data='data.csv', beacon_map='beacon_map.csv'):
+    log = load_data(data)
+    beacon_locs = load_beacon_map(beacon_map)
+
+    results = []
+    for Nparticles in counts:
+        for r in benchmark_kernels(log, beacon_locs, Nparticles, min_time) + \
+                [benchmark_step_loop(log, beacon_locs, Nparticles, Nsteps, dtype)
+                 for dtype in (None, np.float64, np.float32)]:
+            print_result(r)
+            results.append(r)
+
+    return {'revision': revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'steps': Nsteps,
+            'results': results}
+
+
+def print_result(r):
+    print('%-22s %8d  %10.3g s/step  %10.3g particles/s  %8.1f MB' %
+          (r['kernel'], r['particles'], r['time_per_step'], r['particles_per_second'],
+           r['peak_memory_bytes'] / 1e6))
+
+
+def compare(before_filename, after_filename, threshold=1.1):
+    """Print the change in time per step between two saved runs.
+
+    Returns True if any kernel slowed down by more than 'threshold' times.
+    """
+    with open(before_filename) as f:
+        before = json.load(f)
+    with open(after_filename) as f:
+        after = json.load(f)
+
+    before_times = {(r['kernel'], r['particles']): r['time_per_step'] for r in before['results']}
+
+    regressed = False
+    print('%-22s %8s  %12s %12s %8s' % ('kernel', 'particles', 'before (s)', 'after (s)', 'ratio'))
+    for r in after['results']:
+        key = (r['kernel'], r['particles'])
+        if key not in before_times:
+            continue
+        ratio = r['time_per_step'] / before_times[key]
+        flag = ''
+        if ratio > threshold:
+            flag = '  SLOWER'
+            regressed = True
+        print('%-22s %8d  %12.3g %12.3g %8.2f%s' % (key[0], key[1], before_times[key],
+                                                    r['time_per_step'], ratio, flag))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the particle filter kernels.')
+    parser.add_argument('--counts', type=int, nargs='+', default=DEFAULT_COUNTS,
+                        help='particle counts to sweep (default 1e2 to 1e6)')
+    parser.add_argument('--steps', type=int, default=50,
+                        help='number of log steps for the full step loop (default 50)')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimum time to spend timing each kernel (s)')
+    parser.add_argument('--seed', type=int, default=7, help='random seed (default 7)')
+    parser.add_argument('--output', default='benchmark.json', help='file to save results to')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare two saved runs instead of benchmarking')
+    parser.add_argument('--threshold', type=float, default=1.1,
+                        help='slowdown ratio reported as a regression when comparing (default 1.1)')
+    args = parser.parse_args()
+
+    if args.compare:
+        regressed = compare(args.compare[0], args.compare[1], args.threshold)
+        raise SystemExit(1 if regressed else 0)
+
+    seed(args.seed)
+    results = run_benchmarks(args.counts, args.steps, args.min_time)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Saved results to', args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -22,9 +22,13 @@ try:
 except:
     import matplotlib; matplotlib.use("Qt5Agg")
 
-from models import motion_model, sensor_model
+from particle_filter import ParticleFilter, filter_bounds
+from logs import load_data, load_beacon_map, time_steps
 from utils import *
 from plot import *
+from renderer import Renderer
+from telemetry import Telemetry
+from occupancy_map import load_map
 from transform import *
 from matplotlib.ticker import PercentFormatter
 import numpy as np
@@ -35,70 +39,15 @@ seed(7)
 
 # Load data
 
-# data is a (many x 13) matrix. Its columns are:
-# time_ns, velocity_command, rotation_command, map_x, map_y, map_theta, odom_x, odom_y, odom_theta,
-# beacon_ids, beacon_x, beacon_y, beacon_theta
-data = np.genfromtxt('data.csv', delimiter=',', skip_header=1)
-
-# Time in ns
-t = data[:, 0]
-
-# Velocity command in m/s, rotation command in rad/s
-commands = data[:, 1:3]
-
-# Position in map frame, from SLAM (this approximates ground truth)
-slam_poses = data[:, 3:6]
-
-# Position in odometry frame, from wheel encoders and gyro
-odom_poses = data[:, 6:9]
-
-
-# Id and measured position of beacon in camera frame
-beacon_ids = data[:, 9]
-beacon_poses = data[:, 10:13]
-# Use beacon id of -1 if no beacon detected
-beacon_ids[np.isnan(beacon_ids)] = -1
-beacon_ids = beacon_ids.astype(int)
+# t is the time in ns, commands the (v, omega) speed commands, slam_poses the position in the
+# map frame from SLAM (this approximates ground truth, with jumps replaced by NaN), odom_poses
+# the odometry poses transformed into the map frame, and beacon_ids/beacon_poses the id (-1 if
+# none) and measured position of the visible beacon in the camera frame.
+t, commands, slam_poses, odom_poses, beacon_ids, beacon_poses = load_data('data.csv')
 beacon_visible = beacon_ids >= 0
 
-# map_data is a 16x13 matrix.  Its columns are:
-# beacon_ids, x, y, theta, (9 columns of covariance)
-map_data = np.genfromtxt('beacon_map.csv', delimiter=',', skip_header=1)
-
-Nbeacons = map_data.shape[0]
-beacon_locs = np.zeros((Nbeacons, 3))
-for m in range(Nbeacons):
-    id = int(map_data[m, 0])
-    beacon_locs[id] = map_data[m, 1:4]
-
-# Remove jumps in the pose history
-slam_poses = clean_poses(slam_poses)
-
-# Transform odometry poses into map frame
-odom_to_map = find_transform(odom_poses[0], slam_poses[0])
-odom_poses = transform_pose(odom_to_map, odom_poses)
-
-plt.ion()
-fig = plt.figure(figsize=(10, 5))
-axes = fig.add_subplot(111)
-fig.canvas.mpl_connect('key_press_event', keypress_handler)
-# fig.canvas.manager.full_screen_toggle()
-
-plot_beacons(axes, beacon_locs, label='Beacons')
-plot_path(axes, slam_poses, '-', label='SLAM')
-# Uncomment to show odometry when debugging
-# plot_path(axes, odom_poses, 'b:', label='Odom')
-
-axes.legend(loc='lower right')
-
-axes.set_xlim([-6, None])
-axes.axis('equal')
-
-axes.invert_yaxis()
-axes.set_xlabel('y')
-axes.set_ylabel('x')
-axes.figure.canvas.draw()
-axes.figure.canvas.flush_events()
+# beacon_locs is an Nbeacons x 3 array of beacon poses indexed by beacon id
+beacon_locs = load_beacon_map('beacon_map.csv')
 
 start_step = 0
 
@@ -106,31 +55,42 @@ Nparticles = 2000
 
 display_steps = 10
 
-#Unknown initial position
-Xmin = min(slam_poses[:, 0])
-Xmax = max(slam_poses[:, 0])
-Ymin = min(slam_poses[:, 1])
-Ymax = max(slam_poses[:, 1])
+#If the total weight since the particles were last spread out or resampled drops below this
+#after a beacon update, the robot is lost
+LOST_LOG_WEIGHT = np.log(1e-50)
+
+#KLD-sampling: allowed KL-distance, 1 - confidence, histogram bin size and particle count limits
+KLD_EPSILON = 0.05
+KLD_DELTA = 0.01
+KLD_BIN_SIZE = (0.2, 0.2, np.radians(10))
+MIN_PARTICLES = 100
+MAX_PARTICLES = 2000
 
-Tmin = -np.pi
-Tmax = np.pi
+#Per-step timings and filter statistics are saved here, and steps in these ranges are profiled with cProfile
+TELEMETRY_FILE = 'telemetry.csv'
+PROFILE_STEPS = []
 
-weights = np.ones(Nparticles)
-poses = np.zeros((Nparticles, 3))
+#Occupancy grid used to keep particles out of walls, e.g. load_map('../lab/map.yaml').  The shipped map
+#is not aligned with the SLAM frame of data.csv, so it is not used by default
+OCCUPANCY_MAP = None
 
-for m in range(Nparticles):
-    poses[m] = (uniform(Xmin, Xmax),
-                uniform(Ymin, Ymax),
-                uniform(Tmin, Tmax))
+telemetry = Telemetry(len(t), PROFILE_STEPS)
 
-initial_rand_poses = poses
+#Unknown initial position, so spread particles across the area covered by the SLAM path.
+#Beacon 4 provided some inaccurate readings, so was removed
+pf = ParticleFilter(beacon_locs, filter_bounds(slam_poses), Nparticles, MIN_PARTICLES, MAX_PARTICLES,
+                    KLD_EPSILON, KLD_DELTA, KLD_BIN_SIZE, lost_log_weight=LOST_LOG_WEIGHT,
+                    ignored_beacons=(4,), occupancy_map=OCCUPANCY_MAP,
+                    telemetry=telemetry)
 
 Nposes = odom_poses.shape[0]
 print(Nposes)
 est_poses = np.zeros((Nposes, 3))
 
-plot_particles(axes, poses, weights)
-axes.set_title('Push space to start/stop, dot to move one step, q to quit...')
+#Draw the particles and the estimate in a separate process, so the display never slows the filter
+renderer = Renderer(beacon_locs, slam_poses)
+renderer.start()
+renderer.publish(0, pf.poses, np.exp(pf.log_weights), est_poses[:0], beacon_visible[:0])
 # wait_until_key_pressed()
 
 
@@ -150,52 +110,27 @@ exec_time_array = np.array([])
 # for n in list(range(start_step+1, robot_capture_index)) + list(range(robot_release_index, Nposes)):
 
 
-for n in range(start_step + 1, Nposes):
-
-    poses = motion_model(poses, commands[n-1], odom_poses[n], odom_poses[n - 1],
-                         t[n] - t[n - 1])
-
-    
-    
-    #Beacon 4 provided some inaccurate readings, so was removed
-    if beacon_visible[n] and beacon_ids[n] != 4:
-
-
-        beacon_id = beacon_ids[n]
-        beacon_loc = beacon_locs[beacon_id]
-        beacon_pose = beacon_poses[n]
-
-        weight_likelihoods = sensor_model(poses, beacon_pose, beacon_loc)
-
-        weights *= weight_likelihoods
+#Rows with the same timestamp are the beacons seen at that time, so apply them as one step
+#Row start_step is the starting point, but the beacons of later rows with its timestamp are still used
+for n, stop in time_steps(t):
+    n = max(n, start_step + 1)
+    if n >= stop:
+        continue
 
-        if sum(weights) < 1e-50:
-            #Robot is lost, so spread particles back out across entire area
-            weights = np.ones(Nparticles)
+    est_poses[n:stop] = pf.step(commands[n-1], odom_poses[n], odom_poses[n - 1],
+                                (t[n] - t[n - 1]) * 1e-9, beacon_ids[n:stop], beacon_poses[n:stop], row=n)
 
-            poses = initial_rand_poses
-            
-
-        if is_degenerate(weights):
-            # print('Resampling %d' % n)
-            num_of_particles = round(min(2000, 200/max(weight_likelihoods)))
-            # print(num_of_particles)     
-            poses, weights = resample(poses, weights, num_of_particles)
-
-    est_poses[n] = poses.mean(axis=0)
+    #Display up to the last row of this step
+    n = stop - 1
 
     if (n > display_step_prev + display_steps) or state == 'step':
         # print(n)
 
-        # Show particle cloud
-        plot_particles(axes, poses, weights)
-
-        # Leave breadcrumbs showing current odometry
-        # plot_path(axes, odom_poses[n], 'k.')
-
-        # Show mean estimate
-        plot_path_with_visibility(axes, est_poses[display_step_prev-1 : n+1],
-                                  '-', visibility=beacon_visible[display_step_prev-1 : n+1])
+        # Show particle cloud and mean estimate
+        render_start = time.perf_counter()
+        renderer.publish(n, pf.poses, np.exp(pf.log_weights - pf.log_weights.max()),
+                         est_poses[display_step_prev-1 : n+1], beacon_visible[display_step_prev-1 : n+1])
+        telemetry.set('render', time.perf_counter() - render_start)
         display_step_prev = n
 
         # print(state)
@@ -217,16 +152,26 @@ for n in range(start_step + 1, Nposes):
 
 # # Display final plot
 print('Done, displaying final plot')
-plt.ioff()
-plt.show()
+renderer.close()
+
+#Position error against SLAM and the viewing angle of the beacon seen (NaN if none) at each log row
+error_array = np.hypot(est_poses[:, 0] - slam_poses[:, 0], est_poses[:, 1] - slam_poses[:, 1])
+error_array[:start_step + 1] = np.nan
+viewing_angle_array = np.where(beacon_visible, beacon_poses[:, 2], np.nan)
+
+#Filter time for each step, excluding the display
+telemetry.close()
+records = telemetry.rows()
+exec_time_array = np.nansum(np.column_stack((records['motion'], records['sensor'], records['resample'])), axis=1)
+
+print('Median error %.3f m, mean step time %.3g ms' % (np.nanmedian(error_array), 1e3 * np.mean(exec_time_array)))
+print('Saving telemetry to', TELEMETRY_FILE)
+telemetry.save(TELEMETRY_FILE)
 
 # Save final plot to file
 plot_filename = 'path.pdf'
 print('Saving final plot to', plot_filename)
 
-plot_path(axes, est_poses, 'r-', label='PF')
-axes.legend(loc='lower right')
-
 fig = plt.figure(figsize=(10, 5))
 axes = fig.add_subplot(111)
 
@@ -0,0 +1,135 @@
+"""Monte Carlo evaluation of the particle filter over many random seeds.
+
+Each seed runs the headless filter over the whole log in a process pool.  The
+log is loaded once in the parent and handed to each worker when it starts,
+rather than once per seed.  The results are collected into one summary table:
+
+    python evaluate.py --seeds 200 --output seeds.csv
+
+Sam Bain/Mark Gardyne,
+Department of Electrical and Computer Engineering
+University of Canterbury
+"""
+
+from __future__ import print_function, division
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from numpy.random import seed
+
+from logs import load_data, load_beacon_map
+from particle_filter import ParticleFilter, filter_bounds, run_filter
+
+# Dtype of the per-seed summary returned by evaluate_seed
+SUMMARY_DTYPE = np.dtype([('seed', np.int64), ('rms_error', float), ('mean_error', float),
+                          ('final_error', float), ('convergence_step', np.int64), ('runtime', float),
+                          ('resamples', np.int64), ('lost', np.int64)])
+
+# The log and filter settings shared by every seed in a worker process
+_worker_state = {}
+
+
+def _init_worker(log, beacon_locs, filter_kwargs, converged_error):
+    _worker_state['log'] = log
+    _worker_state['beacon_locs'] = beacon_locs
+    _worker_state['filter_kwargs'] = filter_kwargs
+    _worker_state['converged_error'] = converged_error
+
+
+def position_errors(est_poses, slam_poses):
+    """Return the distance between each estimate and the SLAM pose (NaN where SLAM is missing)."""
+    return np.hypot(est_poses[:, 0] - slam_poses[:, 0], est_poses[:, 1] - slam_poses[:, 1])
+
+
+def convergence_step(errors, converged_error):
+    """Return the first step after which the error stays below 'converged_error', or -1 if it never does."""
+    above = np.flatnonzero(~(errors < converged_error) & ~np.isnan(errors))
+    if len(above) == 0:
+        return 0
+    if above[-1] == len(errors) - 1:
+        return -1
+    return above[-1] + 1
+
+
+def evaluate_seed(seed_value):
+    """Run the filter with one seed and return its summary row."""
+    t, commands, slam_poses, odom_poses, beacon_ids, beacon_poses = _worker_state['log']
+
+    seed(seed_value)
+    start = time.perf_counter()
+    pf = ParticleFilter(_worker_state['beacon_locs'], filter_bounds(slam_poses), **_worker_state['filter_kwargs'])
+    est_poses, stats = run_filter(pf, t, commands, odom_poses, beacon_ids, beacon_poses)
+    runtime = time.perf_counter() - start
+
+    # Step 0 is the starting point rather than an estimate
+    errors = position_errors(est_poses, slam_poses)
+    errors[0] = np.nan
+
+    return (seed_value, np.sqrt(np.nanmean(errors**2)), np.nanmean(errors),
+            errors[~np.isnan(errors)][-1], convergence_step(errors, _worker_state['converged_error']),
+            runtime, np.sum(stats['resampled']), np.sum(stats['lost']))
+
+
+def evaluate(seeds, workers=None, converged_error=0.3, data='data.csv', beacon_map='beacon_map.csv',
+             **filter_kwargs):
+    """Run the filter for each seed in a process pool and return a structured array of summaries.
+
+    Extra keyword arguments are passed on to ParticleFilter.
+    """
+    log = load_data(data)
+    beacon_locs = load_beacon_map(beacon_map)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(log, beacon_locs, filter_kwargs, converged_error)) as executor:
+        rows = list(executor.map(evaluate_seed, seeds))
+
+    return np.array(rows, dtype=SUMMARY_DTYPE)
+
+
+def print_summary(summary):
+    print('%d seeds' % len(summary))
+    print('%-18s %10s %10s %10s %10s' % ('', 'median', '5%', '95%', 'max'))
+    for name in ('rms_error', 'mean_error', 'final_error', 'convergence_step', 'runtime'):
+        values = summary[name].astype(float)
+        if name == 'convergence_step':
+            values = values[values >= 0]
+            if len(values) == 0:
+                continue
+        print('%-18s %10.4g %10.4g %10.4g %10.4g' % (name, np.median(values), np.percentile(values, 5),
+                                                   np.percentile(values, 95), np.max(values)))
+    print('never converged:   %d' % np.sum(summary['convergence_step'] < 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate the particle filter over many random seeds.')
+    parser.add_argument('--seeds', type=int, default=100, help='number of seeds to run (default 100)')
+    parser.add_argument('--first-seed', type=int, default=0, help='first seed (default 0)')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default all cores)')
+    parser.add_argument('--particles', type=int, default=2000, help='initial number of particles (default 2000)')
+    parser.add_argument('--resample', default='kld',
+                        help="'kld', 'systematic', 'stratified', 'residual' or 'multinomial' (default kld)")
+    parser.add_argument('--converged-error', type=float, default=0.3,
+                        help='position error (m) below which the filter counts as converged (default 0.3)')
+    parser.add_argument('--data', default='data.csv', help='particle filter log (default data.csv)')
+    parser.add_argument('--beacon-map', default='beacon_map.csv', help='beacon map (default beacon_map.csv)')
+    parser.add_argument('--output', default='seeds.csv', help='file to save the summary table to')
+    args = parser.parse_args()
+
+    seeds = list(range(args.first_seed, args.first_seed + args.seeds))
+
+    start = time.perf_counter()
+    summary = evaluate(seeds, args.workers, args.converged_error, args.data, args.beacon_map,
+                       Nparticles=args.particles, max_particles=max(args.particles, 2000),
+                       resample_method=args.resample)
+    elapsed = time.perf_counter() - start
+
+    np.savetxt(args.output, summary, delimiter=',', header=','.join(SUMMARY_DTYPE.names), comments='',
+               fmt=['%d', '%.6g', '%.6g', '%.6g', '%d', '%.6g', '%d', '%d'])
+
+    print_summary(summary)
+    print('Ran %d seeds in %.1f s, saved to %s' % (len(seeds), elapsed, args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Fused motion and sensor update for the particle filter.
+
+motion_model followed by sensor_model makes several passes over the particle
+array: adding noise, the turn/move/turn update, the range and bearing trig,
+the three Gaussians and the weight update.  fused_step does all of that in a
+single loop over the particles, compiled with numba if it is installed.
+Without numba it falls back to calling motion_model and sensor_model.  Both
+paths consume the same noise, so they agree to floating point rounding.
+
+Sam Bain/Mark Gardyne,
+Department of Electrical and Computer Engineering
+University of Canterbury
+"""
+
+import numpy as np
+from numpy.random import randn
+from models import motion_model, sensor_model, odometry_increments
+from models import PHI1_STD, D_STD, PHI2_STD, R_STD_BASE, PHI_STD_BASE, THETA_STD_BASE
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+HAVE_NUMBA = njit is not None
+
+
+def _fused_kernel(poses, log_weights, noise, phi1_mle, d_mle, phi2_mle,
+                  r, phi, beacon_theta, beacon_x, beacon_y, beacon_loc_theta):
+    """Move each particle and add its log-likelihood for each of the K beacons, one particle at a time.
+
+    The arithmetic follows motion_model and sensor_model operation for operation so
+    that both paths give the same results.
+    """
+    two_pi = 2 * np.pi
+    r_var2 = 2 * R_STD_BASE**2
+    phi_var2 = 2 * PHI_STD_BASE**2
+    beacon_angle_var2 = 2 * THETA_STD_BASE**2
+
+    for m in range(poses.shape[0]):
+        #initial turn
+        theta = ((poses[m, 2] + (phi1_mle + noise[m, 0] * PHI1_STD)) + np.pi) % two_pi - np.pi
+
+        #straight travel
+        d = d_mle + noise[m, 1] * D_STD
+        x = poses[m, 0] + d * np.cos(theta)
+        y = poses[m, 1] + d * np.sin(theta)
+
+        #final turn
+        theta = ((theta + (phi2_mle + noise[m, 2] * PHI2_STD)) + np.pi) % two_pi - np.pi
+
+        poses[m, 0] = x
+        poses[m, 1] = y
+        poses[m, 2] = theta
+
+        log_likelihood_sum = 0.0
+        for k in range(r.shape[0]):
+            #Find the relevant measurements given the particle pose and beacon location
+            r_particle = np.sqrt((beacon_x[k] - x)**2 + (beacon_y[k] - y)**2)
+            bearing = np.arctan2(beacon_y[k] - y, beacon_x[k] - x)
+            phi_particle = ((((bearing - theta) % two_pi) + 3 * np.pi) % two_pi) - np.pi
+            beacon_angle_particle = ((theta + beacon_theta[k]) + np.pi) % two_pi - np.pi
+
+            #Determine the log likelihood of the given measurements for the particle
+            phi_error = ((((phi_particle - phi[k]) % two_pi) + 3 * np.pi) % two_pi) - np.pi
+            beacon_angle_error = ((((beacon_angle_particle - beacon_loc_theta[k]) % two_pi) + 3 * np.pi)
+                                  % two_pi) - np.pi
+
+            log_likelihood = -(r[k] - r_particle)**2 / r_var2
+            log_likelihood += -phi_error**2 / phi_var2
+            log_likelihood += -beacon_angle_error**2 / beacon_angle_var2
+            log_likelihood_sum += log_likelihood
+
+        if r.shape[0] > 0:
+            log_weights[m] += log_likelihood_sum
+
+
+if HAVE_NUMBA:
+    _jit_fused_kernel = njit(cache=True)(_fused_kernel)
+
+
+def fused_step(particle_poses, log_weights, speed_command, odom_pose, odom_pose_prev, dt,
+               beacon_pose=None, beacon_loc=None, noise=None, backend='auto'):
+    """Apply the motion model and, if a beacon is seen, the sensor model in one pass.
+
+    particle_poses (M x 3) and log_weights (M) are updated in place.  If
+    beacon_pose and beacon_loc are given, the log-likelihood of the measurement is
+    added to log_weights, as for sensor_model(..., log=True).  Like sensor_model,
+    they can be K x 3 arrays for K beacons seen at once.  The other arguments are
+    as for motion_model.
+
+    backend: 'numba' to use the compiled kernel, 'numpy' to call motion_model and
+    sensor_model, or 'auto' to use numba when it is installed.
+
+    Returns the updated particle_poses and log_weights.
+    """
+    M = particle_poses.shape[0]
+
+    if noise is None:
+        noise = randn(M, 3)
+
+    if backend == 'auto':
+        backend = 'numba' if HAVE_NUMBA else 'numpy'
+
+    if backend == 'numpy':
+        motion_model(particle_poses, speed_command, odom_pose, odom_pose_prev, dt, noise=noise)
+        if beacon_pose is not None:
+            log_weights += sensor_model(particle_poses, beacon_pose, beacon_loc, log=True)
+        return particle_poses, log_weights
+
+    if backend != 'numba':
+        raise ValueError('Unknown backend %s' % backend)
+    if not HAVE_NUMBA:
+        raise ImportError('The numba backend needs numba to be installed')
+
+    phi1_mle, d_mle, phi2_mle = odometry_increments(odom_pose, odom_pose_prev)
+
+    if beacon_pose is not None:
+        beacon_pose = np.atleast_2d(beacon_pose)
+        beacon_loc = np.atleast_2d(beacon_loc)
+    else:
+        beacon_pose = beacon_loc = np.zeros((0, 3))
+
+    #Measure the range and angle to each beacon using sensor measurement
+    r = np.sqrt(beacon_pose[:, 0]**2 + beacon_pose[:, 1]**2)
+    phi = np.arctan2(beacon_pose[:, 1], beacon_pose[:, 0])
+
+    _jit_fused_kernel(particle_poses, log_weights, noise, float(phi1_mle), float(d_mle), float(phi2_mle),
+                      r, phi, np.ascontiguousarray(beacon_pose[:, 2]), np.ascontiguousarray(beacon_loc[:, 0]),
+                      np.ascontiguousarray(beacon_loc[:, 1]), np.ascontiguousarray(beacon_loc[:, 2]))
+    return particle_poses, log_weights
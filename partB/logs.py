@@ -0,0 +1,172 @@
+"""Loaders for the particle filter log and beacon map.
+
+Sam Bain/Mark Gardyne,
+Department of Electrical and Computer Engineering
+University of Canterbury
+"""
+
+from itertools import islice
+import numpy as np
+from utils import clean_poses
+from transform import find_transform, transform_pose
+
+from shared_logs import check_header, load_log_columns, parse_lines
+
+
+def load_data(filename='data.csv'):
+    """Load a particle filter log.
+
+    The log has one row per beacon seen at each time step and the columns
+    time_ns, velocity_command, rotation_command, map_x, map_y, map_theta, odom_x, odom_y, odom_theta,
+    beacon_id, beacon_x, beacon_y, beacon_theta
+    (see the 'pf_log' schema in logformats.py).  The parsed columns are cached in
+    binary form, so only the first load of a given log parses the text.
+
+    Returns the tuple (t, commands, slam_poses, odom_poses, beacon_ids, beacon_poses) where
+    t is the int64 time in ns, commands the (v, omega) speed commands, slam_poses the SLAM poses
+    with jumps replaced by NaN, odom_poses the odometry poses transformed into the map frame,
+    beacon_ids the id of the visible beacon (-1 if none) and beacon_poses the measured beacon
+    pose in the camera frame.
+    """
+    return _log_arrays(load_log_columns(filename, 'pf_log'))
+
+
+def _log_arrays(log):
+    """Split the columns of a particle filter log into time, command, pose and beacon arrays."""
+
+    # Time in ns
+    t = log['time_ns']
+
+    # Velocity command in m/s, rotation command in rad/s
+    commands = np.column_stack((log['velocity_command'], log['rotation_command']))
+
+    # Position in map frame, from SLAM (this approximates ground truth)
+    slam_poses = np.column_stack((log['map_x'], log['map_y'], log['map_theta']))
+
+    # Position in odometry frame, from wheel encoders and gyro
+    odom_poses = np.column_stack((log['odom_x'], log['odom_y'], log['odom_theta']))
+
+    # Id (-1 if no beacon detected) and measured position of beacon in camera frame
+    beacon_ids = log['beacon_id']
+    beacon_poses = np.column_stack((log['beacon_x'], log['beacon_y'], log['beacon_theta']))
+
+    # Remove jumps in the pose history
+    slam_poses = clean_poses(slam_poses)
+
+    # Transform odometry poses into map frame
+    odom_to_map = find_transform(odom_poses[0], slam_poses[0])
+    odom_poses = transform_pose(odom_to_map, odom_poses)
+
+    return t, commands, slam_poses, odom_poses, beacon_ids, beacon_poses
+
+
+def load_beacon_map(filename='beacon_map.csv'):
+    """Load the beacon map and return an Nbeacons x 3 array of beacon poses indexed by id.
+
+    The map columns are beacon_ids, x, y, theta, (9 columns of covariance).
+    """
+    beacon_map = load_log_columns(filename, 'beacon_map')
+
+    beacon_locs = np.zeros((len(beacon_map['id']), 3))
+    beacon_locs[beacon_map['id']] = np.column_stack((beacon_map['x'], beacon_map['y'], beacon_map['theta']))
+    return beacon_locs
+
+
+def time_steps(t):
+    """Return (start, stop) row ranges of the log rows that share a timestamp.
+
+    The log has one row per beacon seen, so several rows can have the same time.
+    """
+    starts = np.flatnonzero(np.diff(t) != 0) + 1
+    return zip(np.concatenate(([0], starts)), np.concatenate((starts, [len(t)])))
+
+
+def iter_log_chunks(filename='data.csv', chunk_size=1024):
+    """Yield the rows of a particle filter log as structured arrays of up to chunk_size rows.
+
+    Only one chunk is parsed and held in memory at a time, so the first rows are
+    available as soon as the file is opened.  The fields are as for the 'pf_log'
+    schema in logformats.py.
+    """
+    check_header(filename, 'pf_log')
+    with open(filename) as f:
+        # Skip the header
+        f.readline()
+        while True:
+            lines = list(islice(f, chunk_size))
+            if not lines:
+                return
+            yield parse_lines(lines, 'pf_log')
+
+
+def iter_steps(filename='data.csv', chunk_size=1024):
+    """Yield the time steps of a particle filter log one at a time, reading it in chunks.
+
+    Each step is the tuple (t, command, slam_pose, odom_pose, beacon_ids, beacon_poses)
+    where the first four are as for a row of load_data, and beacon_ids and beacon_poses
+    are arrays of the K beacons seen at that time (K may be zero).  SLAM jumps are
+    replaced by NaN and odometry is transformed into the map frame as the log is read,
+    so memory use does not grow with the length of the log.
+
+    The first row is a step of its own, as it is the filter's starting point.  The
+    other rows with its timestamp follow as a second step with the same time.
+    """
+    odom_to_map = None
+    last_good = None
+    carry = None
+    first = True
+
+    for chunk in iter_log_chunks(filename, chunk_size):
+        t = chunk['time_ns']
+        commands = np.column_stack((chunk['velocity_command'], chunk['rotation_command']))
+        slam_poses = np.column_stack((chunk['map_x'], chunk['map_y'], chunk['map_theta']))
+        odom_poses = np.column_stack((chunk['odom_x'], chunk['odom_y'], chunk['odom_theta']))
+        beacon_poses = np.column_stack((chunk['beacon_x'], chunk['beacon_y'], chunk['beacon_theta']))
+
+        if odom_to_map is None:
+            odom_to_map = find_transform(odom_poses[0], slam_poses[0])
+            last_good = slam_poses[0]
+
+        # Transform odometry poses into map frame
+        odom_poses = transform_pose(odom_to_map, odom_poses)
+
+        # Remove jumps in the pose history
+        for i in range(len(slam_poses)):
+            if np.sqrt(np.sum((slam_poses[i, :2] - last_good[:2])**2)) > 2:
+                slam_poses[i] = np.nan
+            else:
+                last_good = slam_poses[i]
+
+        arrays = (t, commands, slam_poses, odom_poses, chunk['beacon_id'], beacon_poses)
+
+        # The last step of the previous chunk may continue into this one
+        if carry is not None:
+            arrays = tuple(np.concatenate((a, b)) for a, b in zip(carry, arrays))
+
+        steps = list(time_steps(arrays[0]))
+        if first and len(steps) > 1:
+            #The first step is complete, so split off the starting row
+            first = False
+            start, stop = steps[0]
+            if stop - start > 1:
+                steps[0:1] = [(start, start + 1), (start + 1, stop)]
+        for start, stop in steps[:-1]:
+            yield _make_step(arrays, start, stop)
+
+        start, stop = steps[-1]
+        carry = tuple(a[start:stop] for a in arrays)
+
+    if carry is not None:
+        if first and len(carry[0]) > 1:
+            yield _make_step(carry, 0, 1)
+            yield _make_step(carry, 1, len(carry[0]))
+        else:
+            yield _make_step(carry, 0, len(carry[0]))
+
+
+def _make_step(arrays, start, stop):
+    """Return the step tuple for iter_steps made from rows start:stop of the log arrays."""
+    t, commands, slam_poses, odom_poses, beacon_ids, beacon_poses = arrays
+    seen = beacon_ids[start:stop] >= 0
+    return (t[start], commands[start], slam_poses[start], odom_poses[start],
+            beacon_ids[start:stop][seen], beacon_poses[start:stop][seen])
@@ -23,7 +23,21 @@ R_STD_BASE = 0.06
 PHI_STD_BASE = 0.1
 THETA_STD_BASE = 0.15
 
-def motion_model(particle_poses, speed_command, odom_pose, odom_pose_prev, dt):
+def odometry_increments(odom_pose, odom_pose_prev):
+    """Return the (phi1, d, phi2) turn/move/turn decomposition of the change in odometry pose."""
+
+    #Find the distance travelled since the last measurement
+    dx = odom_pose[0] - odom_pose_prev[0]
+    dy = odom_pose[1] - odom_pose_prev[1]
+    
+    #Convert dx and dy to find the most likely estimators for distance d, and angles phi1 and phi2
+    phi1_mle = wraptopi(arctan2(dy, dx) - odom_pose_prev[2]) 
+    d_mle = np.sqrt(dx**2 + dy**2)
+    phi2_mle = angle_difference(arctan2(dy, dx), odom_pose[2])
+
+    return phi1_mle, d_mle, phi2_mle
+
+def motion_model(particle_poses, speed_command, odom_pose, odom_pose_prev, dt, noise=None):
     """Apply motion model and return updated array of particle_poses.
 
     Parameters
@@ -43,6 +57,10 @@ def motion_model(particle_poses, speed_command, odom_pose, odom_pose_prev, dt):
 
     dt is the time step (s).
 
+    noise: an optional M x 3 array of standard normal samples for the
+    (phi1, d, phi2) errors of each particle.  If None, they are drawn
+    with randn.
+
     Returns
     -------
     An M x 3 array of updated particle_poses.
@@ -50,42 +68,38 @@ def motion_model(particle_poses, speed_command, odom_pose, odom_pose_prev, dt):
     """
 
     M = particle_poses.shape[0]
-    
-    #Find the distance travelled since the last measurement
-    dx = odom_pose[0] - odom_pose_prev[0]
-    dy = odom_pose[1] - odom_pose_prev[1]
-    
-    #Convert dx and dy to find the most likely estimators for distance d, and angles phi1 and phi2
-    phi1_mle = wraptopi(arctan2(dy, dx) - odom_pose_prev[2]) 
-    d_mle = np.sqrt(dx**2 + dy**2)
-    phi2_mle = angle_difference(arctan2(dy, dx), odom_pose[2])
 
+    phi1_mle, d_mle, phi2_mle = odometry_increments(odom_pose, odom_pose_prev)
 
+    #Draw the (phi1, d, phi2) noise for every particle at once.  Row m holds the same
+    #three samples the per-particle loop drew for particle m, so results match under a fixed seed.
+    #Standard deviations found using trial and error
+    if noise is None:
+        noise = randn(M, 3)
 
-    for m in range(M):
+    phi1 = phi1_mle + noise[:, 0] * PHI1_STD
+    d = d_mle + noise[:, 1] * D_STD
+    phi2 = phi2_mle + noise[:, 2] * PHI2_STD
 
-        #Add a random value to the d, phi1 and phi2 values for each particle to approximate motion model error
-        #Standard deviations found using trial and error
-        phi1 = phi1_mle + randn(1) * PHI1_STD
-        d = d_mle + randn(1) * D_STD
-        phi2 = phi2_mle + randn(1) * PHI2_STD
+    #initial turn
+    particle_poses[:, 2] = wraptopi(particle_poses[:, 2] + phi1)
 
-        #initial turn
-        particle_poses[m, 2] = wraptopi(particle_poses[m, 2] + phi1)
+    #straight travel
+    particle_poses[:, 0] += d*cos(particle_poses[:, 2])
+    particle_poses[:, 1] += d*sin(particle_poses[:, 2])
 
-        #straight travel
-        particle_poses[m, 0] += d*cos(particle_poses[m, 2])
-        particle_poses[m, 1] += d*sin(particle_poses[m, 2])
-
-        #final turn
-        particle_poses[m, 2] = wraptopi(particle_poses[m, 2] + phi2)
+    #final turn
+    particle_poses[:, 2] = wraptopi(particle_poses[:, 2] + phi2)
 
     return particle_poses
 
 def gaussian(x, mu, sig):
-    return np.exp(-np.power(x - mu, 2.) / (2 * np.power(sig, 2.)))
+    return np.exp(log_gaussian(x, mu, sig))
+
+def log_gaussian(x, mu, sig):
+    return -np.power(x - mu, 2.) / (2 * np.power(sig, 2.))
 
-def sensor_model(particle_poses, beacon_pose, beacon_loc):
+def sensor_model(particle_poses, beacon_pose, beacon_loc, log=False, tables=None, beacon_ids=None):
     """Apply sensor model and return particle weights.
 
     Parameters
@@ -97,24 +111,36 @@ def sensor_model(particle_poses, beacon_pose, beacon_loc):
     radians.
 
     beacon_pose: the measured pose of the beacon (x, y, theta) in the
-    robot's camera coordinate system.
+    robot's camera coordinate system.  This can also be a K x 3 array
+    of the poses of K beacons seen at the same time.
 
     beacon_loc: the pose of the currently visible beacon (x, y, theta)
-    in the map coordinate system.
+    in the map coordinate system, or a K x 3 array of the poses of the
+    K beacons in beacon_pose.
+
+    log: if True, return log-likelihoods rather than likelihoods.
+
+    tables: a beacon_tables.BeaconTables.  If given, the expected range
+    and bearing from each particle to each beacon are interpolated from
+    its tables rather than computed.
+
+    beacon_ids: the ids of the beacons in beacon_pose, needed with tables.
 
     Returns
     -------
-    An M element array of particle weights.  The weights do not need to be
+    An M element array of particle weights (or log-weights if log is
+    True), combining all K beacons.  The weights do not need to be
     normalised.
 
     """
 
-    M = particle_poses.shape[0]
-    particle_weights = np.zeros(M)
+    #Treat every measurement as a batch of K beacons, broadcast against the M particles
+    beacon_pose = np.atleast_2d(beacon_pose)
+    beacon_loc = np.atleast_2d(beacon_loc)
 
     #Measure the range and angle to the nearest beacon using sensor measurement
-    r = np.sqrt(beacon_pose[0]**2 + beacon_pose[1]**2)
-    phi = arctan2(beacon_pose[1], beacon_pose[0])
+    r = np.sqrt(beacon_pose[:, 0]**2 + beacon_pose[:, 1]**2)
+    phi = arctan2(beacon_pose[:, 1], beacon_pose[:, 0])
 
     #Define the standard deviation for the measurements (function of viewing angle) 
     r_std = R_STD_BASE #+ 0.03*(np.pi/2 + beacon_pose[2])**2
@@ -123,22 +149,29 @@ def sensor_model(particle_poses, beacon_pose, beacon_loc):
     #Experimenting with beacon angle variable wrt to particle
     beacon_angle_std = THETA_STD_BASE #+ 0.1*(np.pi/2 + beacon_pose[2])**2
 
-    for m in range(M):
-        #Get the particles pose from the list of poses
-        particle_pose = particle_poses[m, :]
+    x = particle_poses[:, 0, np.newaxis]
+    y = particle_poses[:, 1, np.newaxis]
+    theta = particle_poses[:, 2, np.newaxis]
 
-        #Find the relevant measurements given the particle pose and beacon location
-        r_particle = np.sqrt((beacon_loc[0]-particle_pose[0])**2 + (beacon_loc[1]-particle_pose[1])**2)
-        phi_particle = angle_difference(particle_pose[2], arctan2(beacon_loc[1] - particle_pose[1], beacon_loc[0] - particle_pose[0]))
-        beacon_angle_particle = wraptopi(particle_pose[2] + beacon_pose[2])
+    #Find the relevant measurements given each particle pose and each beacon location
+    if tables is not None:
+        r_particle, bearing = tables.lookup(np.atleast_1d(beacon_ids), particle_poses[:, 0], particle_poses[:, 1])
+    else:
+        r_particle = np.sqrt((beacon_loc[:, 0] - x)**2 + (beacon_loc[:, 1] - y)**2)
+        bearing = arctan2(beacon_loc[:, 1] - y, beacon_loc[:, 0] - x)
+    phi_particle = angle_difference(theta, bearing)
+    beacon_angle_particle = wraptopi(theta + beacon_pose[:, 2])
 
-        #Determine the likihood of the given measurements for the particle 
-        range_likelihood = gaussian(r - r_particle, 0, r_std)
-        phi_likelihood = gaussian(angle_difference(phi, phi_particle), 0, phi_std)
+    #Determine the log likelihood of the given measurements for every particle and beacon
+    log_likelihood = log_gaussian(r - r_particle, 0, r_std)
+    log_likelihood += log_gaussian(angle_difference(phi, phi_particle), 0, phi_std)
+    log_likelihood += log_gaussian(angle_difference(beacon_loc[:, 2], beacon_angle_particle), 0, beacon_angle_std)
 
-        beacon_angle_likelihood = gaussian(angle_difference(beacon_loc[2], beacon_angle_particle), 0, beacon_angle_std)
+    #The beacons are independent, so their log likelihoods add
+    log_likelihood = log_likelihood.sum(axis=1)
 
-        #Update the weight given the likelihoods
-        particle_weights[m] = range_likelihood * phi_likelihood * beacon_angle_likelihood
+    if log:
+        return log_likelihood
 
-    return particle_weights
+    #Update the weight given the likelihoods
+    return np.exp(log_likelihood)
@@ -0,0 +1,175 @@
+"""Occupancy grid maps, as saved by the ROS map_server (a PGM image and a YAML file).
+
+The image is memory-mapped rather than read, and cells are classified from
+the pixel values as they are looked up, so loading a map costs nothing until
+it is used.
+
+    grid = load_map('../lab/map.yaml')
+    occupied = grid.is_occupied(poses[:, 0], poses[:, 1])
+    poses = grid.sample_free(1000)
+
+Sam Bain/Mark Gardyne,
+Department of Electrical and Computer Engineering
+University of Canterbury
+"""
+
+import os
+import numpy as np
+from numpy.random import uniform, randint
+
+# Cell classes returned by OccupancyGrid.lookup
+FREE = 0
+UNKNOWN = 1
+OCCUPIED = 2
+
+
+class OccupancyGrid(object):
+
+    def __init__(self, image, resolution, origin, negate=0, occupied_thresh=0.65, free_thresh=0.196):
+        """Occupancy grid from a greyscale map image.
+
+        image: height x width array of pixel values 0-255, with the top row at
+        the largest y as in a map_server PGM.
+
+        resolution: size of each (square) cell in m.
+
+        origin: (x, y, theta) of the bottom left corner of the image in the map frame.
+        A rotated origin is not supported.
+
+        negate, occupied_thresh, free_thresh: as in the map_server YAML file.  The
+        probability a cell is occupied is (255 - pixel) / 255, or pixel / 255 if negate.
+        """
+        if origin[2] != 0:
+            raise ValueError('Maps with a rotated origin are not supported')
+
+        self.image = image
+        self.resolution = resolution
+        self.origin = origin
+        self.height, self.width = image.shape
+
+        # Pixel thresholds equivalent to the probability thresholds
+        if negate:
+            self.occupied_pixel = occupied_thresh * 255
+            self.free_pixel = free_thresh * 255
+        else:
+            self.occupied_pixel = (1 - occupied_thresh) * 255
+            self.free_pixel = (1 - free_thresh) * 255
+        self.negate = negate
+
+        self._free_cells = None
+
+    def world_to_cell(self, x, y):
+        """Return the (row, column) image indices of the cells containing points (x, y).
+
+        Indices of points outside the map are out of range; see lookup.
+        """
+        col = np.floor((np.asarray(x) - self.origin[0]) / self.resolution).astype(int)
+        row = self.height - 1 - np.floor((np.asarray(y) - self.origin[1]) / self.resolution).astype(int)
+        return row, col
+
+    def cell_to_world(self, row, col):
+        """Return the (x, y) centres of cells (row, col)."""
+        x = self.origin[0] + (np.asarray(col) + 0.5) * self.resolution
+        y = self.origin[1] + (self.height - 1 - np.asarray(row) + 0.5) * self.resolution
+        return x, y
+
+    def classify(self, pixels):
+        """Return FREE, UNKNOWN or OCCUPIED for each pixel value."""
+        pixels = np.asarray(pixels)
+        if self.negate:
+            occupied = pixels > self.occupied_pixel
+            free = pixels < self.free_pixel
+        else:
+            occupied = pixels < self.occupied_pixel
+            free = pixels > self.free_pixel
+        return np.where(occupied, OCCUPIED, np.where(free, FREE, UNKNOWN))
+
+    def lookup(self, x, y):
+        """Return the class of the cells containing points (x, y), UNKNOWN outside the map."""
+        row, col = self.world_to_cell(x, y)
+        inside = (row >= 0) & (row < self.height) & (col >= 0) & (col < self.width)
+
+        classes = np.full(row.shape, UNKNOWN)
+        classes[inside] = self.classify(self.image[row[inside], col[inside]])
+        return classes
+
+    def is_occupied(self, x, y):
+        return self.lookup(x, y) == OCCUPIED
+
+    def is_free(self, x, y):
+        return self.lookup(x, y) == FREE
+
+    def free_cells(self):
+        """Return the (row, column) indices of every free cell, found on the first call."""
+        if self._free_cells is None:
+            self._free_cells = np.nonzero(self.classify(self.image) == FREE)
+        return self._free_cells
+
+    def sample_free(self, N, bounds=None):
+        """Return N poses spread uniformly over the free cells, with uniform headings.
+
+        If 'bounds' (Xmin, Xmax, Ymin, Ymax) is given only free cells with centres
+        inside it are used.  Raises ValueError if there are none.
+        """
+        row, col = self.free_cells()
+        if bounds is not None:
+            Xmin, Xmax, Ymin, Ymax = bounds
+            x, y = self.cell_to_world(row, col)
+            inside = (x >= Xmin) & (x <= Xmax) & (y >= Ymin) & (y <= Ymax)
+            row, col = row[inside], col[inside]
+        if len(row) == 0:
+            raise ValueError('There are no free cells to sample from')
+
+        # Pick cells uniformly, then a point uniformly within each cell
+        cells = randint(0, len(row), N)
+        x, y = self.cell_to_world(row[cells], col[cells])
+        half = self.resolution / 2
+        return np.column_stack((x + uniform(-half, half, N),
+                                y + uniform(-half, half, N),
+                                uniform(-np.pi, np.pi, N)))
+
+
+def read_pgm(filename):
+    """Memory-map a binary (P5) 8-bit PGM image and return it as a height x width array."""
+    with open(filename, 'rb') as f:
+        # The header is four whitespace separated fields, with comments starting with #
+        fields = []
+        while len(fields) < 4:
+            line = f.readline()
+            if not line:
+                raise ValueError('%s: truncated PGM header' % filename)
+            fields += line.split(b'#')[0].split()
+        offset = f.tell()
+
+    magic, width, height, maxval = fields[0], int(fields[1]), int(fields[2]), int(fields[3])
+    if magic != b'P5' or maxval > 255:
+        raise ValueError('%s: only binary 8-bit PGM images are supported' % filename)
+
+    return np.memmap(filename, dtype=np.uint8, mode='r', offset=offset, shape=(height, width))
+
+
+def read_map_yaml(filename):
+    """Read the flat 'key: value' map_server YAML file into a dict."""
+    info = {}
+    with open(filename) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            key, value = [s.strip() for s in line.split(':', 1)]
+            if value.startswith('['):
+                info[key] = [float(v) for v in value.strip('[]').split(',')]
+            else:
+                try:
+                    info[key] = float(value)
+                except ValueError:
+                    info[key] = value
+    return info
+
+
+def load_map(filename='../lab/map.yaml'):
+    """Load the occupancy grid described by a map_server YAML file."""
+    info = read_map_yaml(filename)
+    image = read_pgm(os.path.join(os.path.dirname(filename), info['image']))
+    return OccupancyGrid(image, info['resolution'], info['origin'], int(info.get('negate', 0)),
+                         info.get('occupied_thresh', 0.65), info.get('free_thresh', 0.196))
@@ -0,0 +1,532 @@
+"""Headless particle filter for beacon localisation.
+
+The ParticleFilter class owns the particle poses and log-weights and applies
+the motion model, sensor model and resampling policy each step.  Nothing here
+imports matplotlib, so the filter can be run from other code or on a machine
+without a display.  Run this module to process a log from the command line:
+
+    python particle_filter.py data.csv --output-dir results
+
+With --stream the log is read in chunks and each estimate is written as soon
+as it is made, so memory use does not depend on the length of the log.
+With --dtype float32 the particles are kept in preallocated columns by a
+ParticleSetFilter (see particle_set.py).
+
+Sam Bain/Mark Gardyne,
+Department of Electrical and Computer Engineering
+University of Canterbury
+"""
+
+from __future__ import print_function, division
+import argparse
+import os
+import time
+import numpy as np
+from numpy.random import uniform, seed, randint
+
+from models import motion_model, sensor_model
+from fused import fused_step
+from utils import resample, kld_resample, normalise_log_weights, is_degenerate
+from logs import load_data, load_beacon_map, time_steps, iter_steps
+from occupancy_map import load_map
+from beacon_tables import BeaconTables
+from particle_set import ParticleSet
+from telemetry import Telemetry
+
+# Dtype of the per-step statistics recorded by run_filter
+STATS_DTYPE = np.dtype([('step', np.int64), ('Nparticles', np.int64), ('ess', float),
+                        ('log_sum', float), ('resampled', bool), ('lost', bool)])
+
+
+class ParticleFilter(object):
+
+    def __init__(self, beacon_locs, bounds, Nparticles=2000, min_particles=100, max_particles=2000,
+                 kld_epsilon=0.05, kld_delta=0.01, kld_bin_size=(0.2, 0.2, np.radians(10)),
+                 resample_method='kld', lost_log_weight=np.log(1e-50), ignored_beacons=(4,), fused=False,
+                 occupancy_map=None, beacon_tables=None, telemetry=None):
+        """Particle filter for localising against a map of beacons.
+
+        beacon_locs: an Nbeacons x 3 array of beacon poses indexed by beacon id.
+
+        bounds: (Xmin, Xmax, Ymin, Ymax) region particles are spread across when
+        the robot position is unknown.
+
+        resample_method: 'kld' to choose the particle count with KLD-sampling,
+        otherwise one of the fixed-size schemes in utils.RESAMPLERS.
+
+        lost_log_weight: if the log of the total weight drops below this after a
+        beacon update the robot is considered lost and particles are spread out again.
+        The weights are normalised at every update, so the total is the product of
+        the normalisers (log_sum) since the particles were last spread out or
+        resampled, starting from a weight of 1 per particle.  This is the sum of the
+        unnormalised weights that the original demo compared with 1e-50.
+
+        ignored_beacons: ids of beacons whose readings are not used.
+
+        fused: if True, apply the motion and sensor models together with
+        fused.fused_step, which is compiled with numba when it is installed.
+
+        occupancy_map: an occupancy_map.OccupancyGrid.  If given, particles are only
+        spread across its free cells and particles that move into occupied cells are
+        given zero weight.
+
+        beacon_tables: a beacon_tables.BeaconTables.  If given, the expected range and
+        bearing to each beacon are looked up in its tables rather than computed.
+        Not supported with fused, which computes them in its compiled loop.
+
+        telemetry: a telemetry.Telemetry.  If given, each step records the time spent
+        in the motion update, sensor update and resampling, and the filter statistics.
+        Without it nothing is timed.
+        """
+        if fused and beacon_tables is not None:
+            raise ValueError('fused does not support beacon_tables')
+
+        self.beacon_locs = beacon_locs
+        self.bounds = bounds
+        self.Nparticles = Nparticles
+        self.min_particles = min_particles
+        self.max_particles = max_particles
+        self.kld_epsilon = kld_epsilon
+        self.kld_delta = kld_delta
+        self.kld_bin_size = kld_bin_size
+        self.resample_method = resample_method
+        self.lost_log_weight = lost_log_weight
+        self.ignored_beacons = ignored_beacons
+        self.fused = fused
+        self.occupancy_map = occupancy_map
+        self.beacon_tables = beacon_tables
+        self.telemetry = telemetry
+
+        # Statistics for the most recent step
+        self.ess = Nparticles
+        self.log_sum = 0.0
+        self.log_total = 0.0
+        self.resampled = False
+        self.lost = False
+
+        self.reset()
+
+    def reset(self):
+        """Spread particles uniformly across the bounds (or its free cells, with a map) with equal weights."""
+        Xmin, Xmax, Ymin, Ymax = self.bounds
+
+        if self.occupancy_map is not None:
+            self.poses = self.occupancy_map.sample_free(self.Nparticles, self.bounds)
+        else:
+            self.poses = np.column_stack((uniform(Xmin, Xmax, self.Nparticles),
+                                          uniform(Ymin, Ymax, self.Nparticles),
+                                          uniform(-np.pi, np.pi, self.Nparticles)))
+        self.log_weights = np.zeros(self.Nparticles)
+        self.ess = self.Nparticles
+        self.log_total = 0.0
+
+    def predict(self, command, odom_pose, odom_pose_prev, dt):
+        """Move the particles by the change in odometry pose."""
+        self.poses = motion_model(self.poses, command, odom_pose, odom_pose_prev, dt)
+
+    def prune(self):
+        """Give zero weight to particles that have moved into occupied cells of the map."""
+        if self.occupancy_map is not None:
+            self.log_weights[self.occupancy_map.is_occupied(self.poses[:, 0], self.poses[:, 1])] = -np.inf
+
+    def used_beacons(self, beacon_ids, beacon_poses):
+        """Return the ids and measured poses of the beacons that should update the weights.
+
+        'beacon_ids' can be a single id or an array of the K ids seen at one time, with
+        'beacon_poses' the matching pose or K x 3 array of poses.
+        """
+        beacon_ids = np.atleast_1d(beacon_ids)
+        used = (beacon_ids >= 0) & ~np.isin(beacon_ids, self.ignored_beacons)
+        if not used.any():
+            return beacon_ids[used], None
+        return beacon_ids[used], np.atleast_2d(beacon_poses)[used]
+
+    def update(self, beacon_ids, beacon_poses):
+        """Weight the particles by all the beacons seen at one time and resample if degenerate."""
+        self.resampled = False
+        self.lost = False
+
+        beacon_ids, beacon_poses = self.used_beacons(beacon_ids, beacon_poses)
+        if len(beacon_ids) == 0:
+            return
+
+        self.weight(beacon_ids, beacon_poses)
+        self.normalise_and_resample()
+
+    def weight(self, beacon_ids, beacon_poses):
+        """Add the log-likelihood of the beacons, as returned by used_beacons, to the log-weights."""
+        self.log_weights += sensor_model(self.poses, beacon_poses, self.beacon_locs[beacon_ids], log=True,
+                                         tables=self.beacon_tables, beacon_ids=beacon_ids)
+
+    def normalise_and_resample(self):
+        """Normalise the log-weights, handle a lost robot and resample if degenerate."""
+        self.log_sum, self.ess = normalise_log_weights(self.log_weights)
+        self.log_total += self.log_sum
+
+        if self.log_total < self.lost_log_weight:
+            # Robot is lost, so spread particles back out across entire area
+            self.lost = True
+            self.reset()
+            return
+
+        if is_degenerate(self.log_weights, self.ess):
+            if self.resample_method == 'kld':
+                self.poses, self.log_weights = kld_resample(self.poses, self.log_weights, self.kld_bin_size,
+                                                            self.kld_epsilon, self.kld_delta, self.min_particles,
+                                                            self.max_particles, log=True)
+            else:
+                self.poses, self.log_weights = resample(self.poses, self.log_weights, len(self.poses),
+                                                        method=self.resample_method, log=True)
+            self.ess = len(self.poses)
+            self.log_total = 0.0
+            self.resampled = True
+
+    def step(self, command, odom_pose, odom_pose_prev, dt, beacon_ids=-1, beacon_poses=None, row=None):
+        """Apply one motion update and one joint update for the beacons seen, and return the pose estimate.
+
+        'beacon_ids' and 'beacon_poses' are as for used_beacons.  With telemetry, the
+        time taken by each stage and the filter statistics are recorded in a row for
+        log row 'row' (by default the number of steps so far).
+        """
+        telemetry = self.telemetry
+        if telemetry is not None:
+            telemetry.begin(row)
+        self.resampled = False
+        self.lost = False
+
+        start = self.clock()
+        beacon_ids, beacon_poses = self.used_beacons(beacon_ids, beacon_poses)
+        seen = len(beacon_ids) > 0
+        if self.fused:
+            #The fused update moves and weights the particles in one pass, so it is all timed as motion
+            if seen:
+                fused_step(self.poses, self.log_weights, command, odom_pose, odom_pose_prev, dt,
+                           beacon_poses, self.beacon_locs[beacon_ids])
+            else:
+                fused_step(self.poses, self.log_weights, command, odom_pose, odom_pose_prev, dt)
+            self.prune()
+            self.lap('motion', start)
+        else:
+            self.predict(command, odom_pose, odom_pose_prev, dt)
+            self.prune()
+            start = self.lap('motion', start)
+            if seen:
+                self.weight(beacon_ids, beacon_poses)
+                self.lap('sensor', start)
+
+        if seen:
+            if telemetry is not None:
+                telemetry.set('max_log_weight', np.max(self.log_weights))
+            start = self.clock()
+            self.normalise_and_resample()
+            self.lap('resample', start)
+
+        if telemetry is not None:
+            if seen:
+                telemetry.set('log_sum', self.log_sum)
+            telemetry.set('Nparticles', len(self.poses))
+            telemetry.set('ess', self.ess)
+            telemetry.set('resampled', self.resampled)
+            telemetry.set('lost', self.lost)
+        return self.estimate()
+
+    def clock(self):
+        """Return the time to measure a stage from, or None if there is no telemetry."""
+        if self.telemetry is None:
+            return None
+        return time.perf_counter()
+
+    def lap(self, stage, start):
+        """Record the time since 'start' as the time taken by 'stage', and return the time now.
+
+        Without telemetry this does nothing and returns None.
+        """
+        if self.telemetry is None:
+            return None
+        end = time.perf_counter()
+        self.telemetry.set(stage, end - start)
+        return end
+
+    def estimate(self):
+        """Return the mean particle pose."""
+        return self.poses.mean(axis=0)
+
+
+class ParticleSetFilter(ParticleFilter):
+
+    def __init__(self, beacon_locs, bounds, Nparticles=2000, min_particles=100, max_particles=2000,
+                 *args, dtype=np.float32, resample_method='systematic', **kwargs):
+        """ParticleFilter keeping its particles in a preallocated particle_set.ParticleSet.
+
+        dtype: np.float32 or np.float64 for the particle columns.  float32 halves the
+        memory traffic of each step; float64 gives the same results as ParticleFilter
+        for the same random numbers.
+
+        resample_method defaults to 'systematic', which keeps Nparticles fixed.  After
+        the particles are first spread out a step then allocates no particle-sized
+        arrays except the resampling indices.  'kld' (ParticleFilter's default), a map
+        or the 'residual' scheme each allocate on every step.  The random numbers come from a numpy Generator seeded from
+        numpy.random, so runs are repeatable with seed but differ from ParticleFilter's.
+        The poses and log_weights attributes are views of the particle set, and the
+        array returned by estimate is overwritten by the next step.
+        fused and beacon_tables are not supported.
+        """
+        self.dtype = dtype
+        self.particles = ParticleSet(max(Nparticles, max_particles), dtype)
+        self.rng = np.random.default_rng(randint(2**31))
+        super().__init__(beacon_locs, bounds, Nparticles, min_particles, max_particles, *args,
+                         resample_method=resample_method, **kwargs)
+
+        if self.fused or self.beacon_tables is not None:
+            raise ValueError('ParticleSetFilter does not support fused or beacon_tables')
+
+    @property
+    def poses(self):
+        return self.particles.poses
+
+    @property
+    def log_weights(self):
+        return self.particles.log_weights
+
+    def reset(self):
+        """Spread particles uniformly across the bounds (or its free cells, with a map) with equal weights."""
+        Xmin, Xmax, Ymin, Ymax = self.bounds
+
+        if self.occupancy_map is not None:
+            self.particles.load(self.occupancy_map.sample_free(self.Nparticles, self.bounds))
+        else:
+            self.particles.load(np.column_stack((uniform(Xmin, Xmax, self.Nparticles),
+                                                 uniform(Ymin, Ymax, self.Nparticles),
+                                                 uniform(-np.pi, np.pi, self.Nparticles))))
+        self.ess = self.Nparticles
+        self.log_total = 0.0
+
+    def predict(self, command, odom_pose, odom_pose_prev, dt):
+        """Move the particles by the change in odometry pose."""
+        self.particles.predict(odom_pose, odom_pose_prev, self.rng)
+
+    def weight(self, beacon_ids, beacon_poses):
+        """Add the log-likelihood of the beacons, as returned by used_beacons, to the log-weights."""
+        self.particles.weight(beacon_poses, self.beacon_locs[beacon_ids])
+
+    def normalise_and_resample(self):
+        """Normalise the log-weights, handle a lost robot and resample if degenerate."""
+        self.log_sum, self.ess = self.particles.normalise()
+        self.log_total += self.log_sum
+
+        if self.log_total < self.lost_log_weight:
+            # Robot is lost, so spread particles back out across entire area
+            self.lost = True
+            self.reset()
+            return
+
+        if is_degenerate(self.log_weights, self.ess):
+            if self.resample_method == 'kld':
+                self.particles.load(*kld_resample(self.poses, self.log_weights, self.kld_bin_size,
+                                                  self.kld_epsilon, self.kld_delta, self.min_particles,
+                                                  self.max_particles, log=True))
+            else:
+                self.particles.resample(self.rng, self.resample_method)
+            self.ess = self.particles.M
+            self.log_total = 0.0
+            self.resampled = True
+
+    def estimate(self):
+        """Return the mean particle pose, in an array that is reused by the next call."""
+        return self.particles.estimate()
+
+
+def run_filter(pf, t, commands, odom_poses, beacon_ids, beacon_poses, start_step=0):
+    """Run the particle filter over a whole log.
+
+    Rows with the same timestamp (one per beacon seen at that time) are applied
+    as a single step with one motion update and one joint beacon update.  Row
+    start_step is the starting point; the beacons of the later rows with its
+    timestamp are still applied.
+
+    Returns an Nposes x 3 array of pose estimates and a structured array of
+    per-step statistics (see STATS_DTYPE), with one row per log row.
+    """
+    Nposes = odom_poses.shape[0]
+    est_poses = np.zeros((Nposes, 3))
+    stats = np.zeros(Nposes, dtype=STATS_DTYPE)
+
+    for n, stop in time_steps(t):
+        n = max(n, start_step + 1)
+        if n >= stop:
+            continue
+        rows = slice(n, stop)
+        est_poses[rows] = pf.step(commands[n - 1], odom_poses[n], odom_poses[n - 1],
+                                  (t[n] - t[n - 1]) * 1e-9, beacon_ids[rows], beacon_poses[rows], row=n)
+        stats[rows] = (n, len(pf.poses), pf.ess, pf.log_sum, pf.resampled, pf.lost)
+
+    return est_poses, stats
+
+
+def run_stream(pf, steps):
+    """Run the particle filter over a stream of time steps as they arrive.
+
+    'steps' is an iterable of step tuples as yielded by logs.iter_steps.  This is a
+    generator yielding (t, est_pose) after each step, so estimates are available
+    before the whole log has been read.  The first step only sets the starting point.
+    """
+    prev = None
+    for step in steps:
+        t, command, slam_pose, odom_pose, beacon_ids, beacon_poses = step
+        if prev is not None:
+            t_prev, command_prev, _, odom_pose_prev, _, _ = prev
+            yield t, pf.step(command_prev, odom_pose, odom_pose_prev, (t - t_prev) * 1e-9,
+                             beacon_ids, beacon_poses)
+        prev = step
+
+
+def filter_bounds(slam_poses):
+    """Return the (Xmin, Xmax, Ymin, Ymax) bounding box of the SLAM path."""
+    return (np.nanmin(slam_poses[:, 0]), np.nanmax(slam_poses[:, 0]),
+            np.nanmin(slam_poses[:, 1]), np.nanmax(slam_poses[:, 1]))
+
+
+def beacon_bounds(beacon_locs, margin=0.5):
+    """Return the (Xmin, Xmax, Ymin, Ymax) bounding box of the beacons, grown by 'margin'.
+
+    This is used in place of filter_bounds when the whole log is not available up front.
+    """
+    return (beacon_locs[:, 0].min() - margin, beacon_locs[:, 0].max() + margin,
+            beacon_locs[:, 1].min() - margin, beacon_locs[:, 1].max() + margin)
+
+
+def save_stream(pf, steps, output_dir):
+    """Run the filter over a stream of steps, writing each estimate and its statistics as it is made.
+
+    Returns the number of steps processed.
+    """
+    Nsteps = 0
+    with open(os.path.join(output_dir, 'est_poses.csv'), 'w') as poses_file, \
+            open(os.path.join(output_dir, 'stats.csv'), 'w') as stats_file:
+        poses_file.write('t,x,y,theta\n')
+        stats_file.write(','.join(STATS_DTYPE.names) + '\n')
+        for t, est_pose in run_stream(pf, steps):
+            Nsteps += 1
+            poses_file.write('%d,%.18e,%.18e,%.18e\n' % (t, est_pose[0], est_pose[1], est_pose[2]))
+            stats_file.write('%d,%d,%.6g,%.6g,%d,%d\n' % (Nsteps, len(pf.poses), pf.ess, pf.log_sum,
+                                                          pf.resampled, pf.lost))
+    return Nsteps
+
+
+def make_filter(args, beacon_locs, bounds, occupancy_map, tables):
+    """Return the particle filter selected by the command line arguments."""
+    telemetry = None
+    if args.telemetry:
+        telemetry = Telemetry(args.telemetry_size, [parse_step_range(r) for r in args.profile_steps],
+                              os.path.join(args.output_dir, 'profile-%d-%d.prof'))
+    kwargs = dict(Nparticles=args.particles, max_particles=max(args.particles, 2000),
+                  fused=args.fused, occupancy_map=occupancy_map, beacon_tables=tables, telemetry=telemetry)
+    if args.resample:
+        kwargs['resample_method'] = args.resample
+    if args.dtype:
+        return ParticleSetFilter(beacon_locs, bounds, dtype=np.dtype(args.dtype), **kwargs)
+    return ParticleFilter(beacon_locs, bounds, **kwargs)
+
+
+def parse_step_range(text):
+    """Parse a 'start:stop' range of steps."""
+    start, stop = text.split(':')
+    return int(start), int(stop)
+
+
+def save_telemetry(pf, args):
+    """Save the telemetry of a run, if it was recorded, and print the mean time of each stage."""
+    if pf.telemetry is None:
+        return
+    pf.telemetry.close()
+    pf.telemetry.save(os.path.join(args.output_dir, args.telemetry))
+    print('Mean time per stage: ' + ', '.join('%s %.3g ms' % (name, 1e3 * seconds)
+                                             for name, seconds in pf.telemetry.summary().items()
+                                             if name != 'render'))
+    for filename in pf.telemetry.profiles:
+        print('Saved profile', filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the particle filter over a log without plotting.')
+    parser.add_argument('data', nargs='?', default='data.csv', help='particle filter log (default data.csv)')
+    parser.add_argument('--beacon-map', default='beacon_map.csv', help='beacon map (default beacon_map.csv)')
+    parser.add_argument('--seed', type=int, default=7, help='random seed (default 7)')
+    parser.add_argument('--particles', type=int, default=2000, help='initial number of particles (default 2000)')
+    parser.add_argument('--resample',
+                        help="'kld', 'systematic', 'stratified', 'residual' or 'multinomial' "
+                        "(default kld, or systematic with --dtype)")
+    parser.add_argument('--fused', action='store_true',
+                        help='use the fused motion and sensor update (compiled if numba is installed)')
+    parser.add_argument('--stream', action='store_true',
+                        help='read the log in chunks and write each estimate as it is made')
+    parser.add_argument('--chunk-size', type=int, default=1024, help='rows per chunk with --stream (default 1024)')
+    parser.add_argument('--map', help='occupancy grid YAML file, e.g. ../lab/map.yaml, to keep particles '
+                        'out of occupied cells (default none)')
+    parser.add_argument('--lookup-resolution', type=float,
+                        help='look up beacon ranges and bearings in tables with this grid spacing (m), '
+                        'not with --fused')
+    parser.add_argument('--lookup-interpolation', default='bilinear',
+                        help="'bilinear' or 'nearest' lookup with --lookup-resolution (default bilinear)")
+    parser.add_argument('--dtype',
+                        help="keep the particles in preallocated 'float32' or 'float64' columns, resampling "
+                        "systematically to a fixed count unless --resample is given (default off)")
+    parser.add_argument('--telemetry',
+                        help='record per-step timings and statistics and save them to this CSV or .json file '
+                        'in the output directory')
+    parser.add_argument('--telemetry-size', type=int, default=100000,
+                        help='number of most recent steps kept by --telemetry (default 100000)')
+    parser.add_argument('--profile-steps', action='append', default=[], metavar='START:STOP',
+                        help='profile the steps starting at these log rows (steps with --stream) with cProfile '
+                        '(needs --telemetry, can be repeated)')
+    parser.add_argument('--output-dir', default='.', help='directory for est_poses.csv and stats.csv')
+    args = parser.parse_args()
+    if args.fused and args.lookup_resolution:
+        parser.error('--lookup-resolution cannot be used with --fused')
+    if args.profile_steps and not args.telemetry:
+        parser.error('--profile-steps needs --telemetry')
+
+    seed(args.seed)
+
+    beacon_locs = load_beacon_map(args.beacon_map)
+    occupancy_map = load_map(args.map) if args.map else None
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    if args.stream:
+        # The SLAM path is not known up front, so spread particles around the beacons
+        bounds = beacon_bounds(beacon_locs)
+        tables = None
+        if args.lookup_resolution:
+            tables = BeaconTables(beacon_locs, bounds, args.lookup_resolution, interpolation=args.lookup_interpolation)
+        pf = make_filter(args, beacon_locs, bounds, occupancy_map, tables)
+        start = time.perf_counter()
+        Nsteps = save_stream(pf, iter_steps(args.data, args.chunk_size), args.output_dir)
+        print('Processed %d steps in %.2f s' % (Nsteps, time.perf_counter() - start))
+        save_telemetry(pf, args)
+        return
+
+    t, commands, slam_poses, odom_poses, beacon_ids, beacon_poses = load_data(args.data)
+
+    bounds = filter_bounds(slam_poses)
+    tables = None
+    if args.lookup_resolution:
+        tables = BeaconTables(beacon_locs, bounds, args.lookup_resolution, interpolation=args.lookup_interpolation)
+    pf = make_filter(args, beacon_locs, bounds, occupancy_map, tables)
+
+    start = time.perf_counter()
+    est_poses, stats = run_filter(pf, t, commands, odom_poses, beacon_ids, beacon_poses)
+    elapsed = time.perf_counter() - start
+
+    np.savetxt(os.path.join(args.output_dir, 'est_poses.csv'), est_poses, delimiter=',',
+               header='x,y,theta', comments='')
+    np.savetxt(os.path.join(args.output_dir, 'stats.csv'), stats, delimiter=',',
+               header=','.join(STATS_DTYPE.names), comments='', fmt=['%d', '%d', '%.6g', '%.6g', '%d', '%d'])
+
+    #Rows sharing a timestamp are one step; row 0 is the starting point
+    Nsteps = len(np.unique(stats['step'][1:]))
+    print('Processed %d steps (%d log rows) in %.2f s' % (Nsteps, len(est_poses) - 1, elapsed))
+    save_telemetry(pf, args)
+
+
+if __name__ == "__main__":
+    main()
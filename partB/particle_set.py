@@ -0,0 +1,266 @@
+"""Preallocated structure-of-arrays particle storage.
+
+A ParticleSet keeps the x, y, theta and log-weight of every particle in one
+row each of a preallocated 4 x capacity array, in float32 or float64.  There
+are two such arrays, so resampling copies the chosen particles from one into
+the other and swaps them.  The motion update, sensor update, normalisation
+and resampling work in place on the rows using preallocated scratch rows, so
+a step of the filter allocates no particle-sized arrays.  The one exception
+is the index array from np.searchsorted when resampling.
+
+The models are the same as motion_model and sensor_model in models.py, and
+with float64 they give the same results for the same noise.
+
+Sam Bain/Mark Gardyne,
+Department of Electrical and Computer Engineering
+University of Canterbury
+"""
+
+import numpy as np
+from models import odometry_increments
+from models import PHI1_STD, D_STD, PHI2_STD, R_STD_BASE, PHI_STD_BASE, THETA_STD_BASE
+from utils import RESAMPLERS
+
+TWO_PI = 2 * np.pi
+
+
+class ParticleSet(object):
+
+    def __init__(self, capacity, dtype=np.float64):
+        """Storage for up to 'capacity' particles with columns of type 'dtype'."""
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+
+        # Two buffers with rows x, y, theta and log-weight
+        self.buffers = np.zeros((2, 4, capacity), self.dtype)
+        self.front = 0
+        self.M = 0
+
+        # Scratch rows for the in-place updates, and noise for the motion model
+        self.scratch = np.empty((6, capacity), self.dtype)
+        self.noise = np.empty(3 * capacity, self.dtype)
+
+        # Resampling works in float64 so the cumulative weights are accurate
+        self.cum_weights = np.empty(capacity)
+        self.u = np.empty(capacity)
+        self.steps = np.arange(capacity, dtype=float)
+
+        self.estimate_buffer = np.empty(3, self.dtype)
+
+    @property
+    def columns(self):
+        """The 4 x M (x, y, theta, log-weight) rows of the current particles."""
+        return self.buffers[self.front, :, :self.M]
+
+    @property
+    def x(self):
+        return self.buffers[self.front, 0, :self.M]
+
+    @property
+    def y(self):
+        return self.buffers[self.front, 1, :self.M]
+
+    @property
+    def theta(self):
+        return self.buffers[self.front, 2, :self.M]
+
+    @property
+    def log_weights(self):
+        return self.buffers[self.front, 3, :self.M]
+
+    @property
+    def poses(self):
+        """An M x 3 view of the particle poses."""
+        return self.buffers[self.front, :3, :self.M].T
+
+    def load(self, poses, log_weights=None):
+        """Copy an M x 3 array of poses (and optionally their log-weights, otherwise zero) into the set."""
+        M = len(poses)
+        if M > self.capacity:
+            raise ValueError('%d particles do not fit in a set of capacity %d' % (M, self.capacity))
+        self.M = M
+        self.poses[:] = poses
+        if log_weights is None:
+            self.log_weights[:] = 0
+        else:
+            self.log_weights[:] = log_weights
+
+    def predict(self, odom_pose, odom_pose_prev, rng, noise=None):
+        """Apply motion_model in place, drawing the noise from the numpy Generator 'rng'.
+
+        'noise' can be given instead as a 3 x M array of standard normal (phi1, d, phi2) errors.
+        """
+        M = self.M
+        phi1_mle, d_mle, phi2_mle = [float(v) for v in odometry_increments(odom_pose, odom_pose_prev)]
+
+        if noise is None:
+            noise = self.noise[:3 * M].reshape(3, M)
+            rng.standard_normal(dtype=self.dtype, out=noise)
+
+        x, y, theta = self.x, self.y, self.theta
+        phi, d, step = self.scratch[0, :M], self.scratch[1, :M], self.scratch[2, :M]
+
+        #initial turn
+        np.multiply(noise[0], PHI1_STD, out=phi)
+        phi += phi1_mle
+        theta += phi
+        wraptopi_inplace(theta)
+
+        #straight travel
+        np.multiply(noise[1], D_STD, out=d)
+        d += d_mle
+        np.cos(theta, out=step)
+        step *= d
+        x += step
+        np.sin(theta, out=step)
+        step *= d
+        y += step
+
+        #final turn
+        np.multiply(noise[2], PHI2_STD, out=phi)
+        phi += phi2_mle
+        theta += phi
+        wraptopi_inplace(theta)
+
+    def weight(self, beacon_poses, beacon_locs):
+        """Add the sensor_model log-likelihood of the K beacons seen (K x 3 arrays) to the log-weights."""
+        M = self.M
+        x, y, theta = self.x, self.y, self.theta
+        dx, dy, total, log_likelihood, error, angle = [self.scratch[i, :M] for i in range(6)]
+
+        for k in range(len(beacon_poses)):
+            beacon_x, beacon_y, beacon_theta = [float(v) for v in beacon_poses[k]]
+            loc_x, loc_y, loc_theta = [float(v) for v in beacon_locs[k]]
+
+            #Measure the range and angle to the beacon using sensor measurement
+            r = float(np.sqrt(beacon_x**2 + beacon_y**2))
+            phi = float(np.arctan2(beacon_y, beacon_x))
+
+            #The first beacon's log likelihood goes straight into the total
+            if k > 0:
+                ll = log_likelihood
+            else:
+                ll = total
+
+            #Range error
+            np.subtract(loc_x, x, out=dx)
+            np.subtract(loc_y, y, out=dy)
+            np.multiply(dx, dx, out=error)
+            np.multiply(dy, dy, out=angle)
+            error += angle
+            np.sqrt(error, out=error)
+            np.subtract(r, error, out=error)
+            log_gaussian_inplace(error, R_STD_BASE)
+            np.negative(error, out=ll)
+
+            #Bearing error
+            np.arctan2(dy, dx, out=angle)
+            angle -= theta
+            angle_difference_inplace(angle)
+            angle -= phi
+            angle_difference_inplace(angle)
+            log_gaussian_inplace(angle, PHI_STD_BASE)
+            ll -= angle
+
+            #Beacon orientation error
+            np.add(theta, beacon_theta, out=angle)
+            wraptopi_inplace(angle)
+            angle -= loc_theta
+            angle_difference_inplace(angle)
+            log_gaussian_inplace(angle, THETA_STD_BASE)
+            ll -= angle
+
+            #The beacons are independent, so their log likelihoods add
+            if k > 0:
+                total += ll
+
+        if len(beacon_poses):
+            log_weights = self.log_weights
+            log_weights += total
+
+    def normalise(self):
+        """Normalise the log-weights in place, as utils.normalise_log_weights, and return (log_sum, ess)."""
+        log_weights = self.log_weights
+        log_max = float(np.max(log_weights))
+        if not np.isfinite(log_max):
+            return -np.inf, 0.0
+
+        w = self.scratch[0, :self.M]
+        np.subtract(log_weights, log_max, out=w)
+        np.exp(w, out=w)
+        w_sum = float(np.sum(w))
+        log_sum = log_max + float(np.log(w_sum))
+        log_weights -= log_sum
+
+        ess = w_sum**2 / float(np.dot(w, w))
+        return log_sum, ess
+
+    def resample(self, rng, method='systematic'):
+        """Resample the particles in proportion to their weights into the other buffer.
+
+        'method' is one of utils.RESAMPLERS.  'systematic', 'stratified' and 'multinomial'
+        draw from 'rng' into preallocated arrays; the others use utils.resample's own code.
+        The log-weights must be normalised.  Afterwards they are all zero.
+        """
+        M = self.M
+        cum_weights = self.cum_weights[:M]
+        np.exp(self.log_weights, out=cum_weights)
+        np.cumsum(cum_weights, out=cum_weights)
+        cum_weights /= cum_weights[-1]
+
+        #Choose which of the old particles each new particle is copied from
+        u = self.u[:M]
+        if method == 'systematic':
+            np.add(self.steps[:M], rng.random(), out=u)
+            u /= M
+        elif method == 'stratified':
+            rng.random(out=u)
+            u += self.steps[:M]
+            u /= M
+        elif method == 'multinomial':
+            rng.random(out=u)
+        elif method in RESAMPLERS:
+            u = None
+        else:
+            raise ValueError('Unknown resampling method %s' % method)
+
+        if u is not None:
+            indices = np.searchsorted(cum_weights, u, side='left')
+        else:
+            #Other schemes make their own temporaries
+            indices = RESAMPLERS[method](cum_weights, M)
+
+        #Guard against rounding in the cumulative sum leaving u just above the last bin
+        np.minimum(indices, M - 1, out=indices)
+
+        back = 1 - self.front
+        np.take(self.columns, indices, axis=1, out=self.buffers[back, :, :M], mode='clip')
+        self.front = back
+        self.log_weights[:] = 0
+
+    def estimate(self):
+        """Return the mean particle pose.  The array is reused, so it changes on the next call."""
+        np.sum(self.buffers[self.front, :3, :self.M], axis=1, out=self.estimate_buffer)
+        self.estimate_buffer /= self.M
+        return self.estimate_buffer
+
+
+def wraptopi_inplace(angle):
+    """utils.wraptopi without temporaries."""
+    angle += np.pi
+    np.mod(angle, TWO_PI, out=angle)
+    angle -= np.pi
+
+
+def angle_difference_inplace(angle):
+    """Wrap a difference of angles as utils.angle_difference does, without temporaries."""
+    np.mod(angle, TWO_PI, out=angle)
+    angle += 3 * np.pi
+    np.mod(angle, TWO_PI, out=angle)
+    angle -= np.pi
+
+
+def log_gaussian_inplace(error, sig):
+    """Replace 'error' by minus the zero-mean models.log_gaussian of it."""
+    np.square(error, out=error)
+    error /= float(2 * np.power(sig, 2.))
@@ -7,6 +7,13 @@ University of Canterbury
 
 import matplotlib.pyplot as plt
 import numpy as np
+from matplotlib.collections import LineCollection, PathCollection
+from matplotlib.colors import Normalize
+from matplotlib.lines import Line2D
+from matplotlib.path import Path
+from matplotlib.textpath import TextPath
+from matplotlib.transforms import Affine2D, IdentityTransform
+from utils import clean_poses
 
 # The last key that is pressed or None
 key = None
@@ -26,6 +33,7 @@ def get_key():
     
     
 def plot_poses(axes, poses, colour='green'):
+    """Plot poses as arrows, all in one quiver."""
     x = poses[:, 0]
     y = poses[:, 1]
     theta = poses[:, 2]
@@ -37,13 +45,103 @@ def plot_poses(axes, poses, colour='green'):
     dx, dy = dy, dx
 
     # Plot arrows representing poses
-    for m in range(len(x)):
-        axes.arrow(x[m], y[m], dx[m], dy[m], color=colour)
+    return axes.quiver(x, y, dx, dy, color=colour, angles='xy', scale_units='xy', scale=1)
+
+
+#Clouds of more than STAMP_PARTICLES are drawn by stamping one marker per heading and colour, with
+#the headings rounded to HEADING_BINS directions and the colours to COLOUR_BINS levels of the colour map
+STAMP_PARTICLES = 10000
+HEADING_BINS = 16
+COLOUR_BINS = 8
+
+
+class ParticleCloud(PathCollection):
+    """The particles drawn as a single collection of triangle markers.
+
+    Each marker is rotated to its own heading by a per-marker transform, so
+    moving, turning and recolouring the particles only replaces arrays.
+
+    Agg draws each of these markers as a path of its own, which takes about
+    0.5 s for 1e5 particles.  Larger clouds than stamp_limit are instead drawn
+    with draw_markers, which rasterises one marker and copies it to every
+    offset, for each of the quantised headings and colours.  This is about
+    five times faster.
+    """
+
+    def __init__(self, markersize=5, stamp_limit=STAMP_PARTICLES, **kwargs):
+        super().__init__([Path.unit_regular_polygon(3)], **kwargs)
+        self.markersize = markersize
+        self.stamp_limit = stamp_limit
+        self.angles = np.zeros(0)
+        self.marker_transforms = np.zeros((0, 3, 3))
+
+    def set_angles(self, angles):
+        """Set the marker rotations (rad, anticlockwise on the display)."""
+        self.angles = np.asarray(angles)
+        self.stale = True
+
+    def get_transforms(self):
+        return self.marker_transforms
+
+    def draw(self, renderer):
+        #Scale the unit triangle to markersize points, as for Line2D markers, and rotate it
+        scale = renderer.points_to_pixels(0.5 * self.markersize)
+        M = len(self.angles)
+        if M > self.stamp_limit:
+            self.draw_stamped(renderer, scale)
+            return
+
+        if self.marker_transforms.shape[0] != M:
+            self.marker_transforms = np.zeros((M, 3, 3))
+            self.marker_transforms[:, 2, 2] = 1
+        cos = scale * np.cos(self.angles)
+        sin = scale * np.sin(self.angles)
+        self.marker_transforms[:, 0, 0] = cos
+        self.marker_transforms[:, 0, 1] = -sin
+        self.marker_transforms[:, 1, 0] = sin
+        self.marker_transforms[:, 1, 1] = cos
+        super().draw(renderer)
+
+    def draw_stamped(self, renderer, scale):
+        """Draw the markers grouped by quantised heading and colour, one draw_markers call per group."""
+        if not self.get_visible():
+            return
+
+        heading = np.round(self.angles * (HEADING_BINS / (2 * np.pi))).astype(int) % HEADING_BINS
+        level = np.clip((np.asarray(self.norm(self.get_array())) * COLOUR_BINS).astype(int), 0, COLOUR_BINS - 1)
+        group = heading * COLOUR_BINS + level
+
+        #Sort the offsets (in pixels) by group, so each group is a slice
+        order = np.argsort(group, kind='stable')
+        offsets = self.get_offset_transform().transform(self.get_offsets())[order]
+        bounds = np.concatenate(([0], np.cumsum(np.bincount(group, minlength=HEADING_BINS * COLOUR_BINS))))
+        faces = self.cmap((np.arange(COLOUR_BINS) + 0.5) / COLOUR_BINS)
+
+        renderer.open_group('particles', self.get_gid())
+        gc = renderer.new_gc()
+        if self.get_clip_on():
+            gc.set_clip_rectangle(self.get_clip_box())
+            gc.set_clip_path(self.get_clip_path())
+        gc.set_alpha(self.get_alpha())
+        gc.set_linewidth(0)
+        marker = self.get_paths()[0]
+        for n in np.flatnonzero(np.diff(bounds)):
+            angle = (n // COLOUR_BINS) * 2 * np.pi / HEADING_BINS
+            renderer.draw_markers(gc, marker, Affine2D().scale(scale).rotate(angle),
+                                  Path(offsets[bounds[n]:bounds[n + 1]]), IdentityTransform(),
+                                  tuple(faces[n % COLOUR_BINS]))
+        gc.restore()
+        renderer.close_group('particles')
+        self.stale = False
 
 
 def plot_particles(axes, poses, weights, colourmap='viridis'):
-    cmap = plt.get_cmap(colourmap)
+    """Show the particles as triangles coloured by log weight.
 
+    The first call adds a ParticleCloud to the axes.  Later calls update its
+    offsets, rotations and colours and redraw only the cloud and the other
+    animated artists (see blit).
+    """
     weights = np.log(weights + 1e-4)
 
     weight_min = weights.min()
@@ -53,32 +151,64 @@ def plot_particles(axes, poses, weights, colourmap='viridis'):
         idx = weights*0 + 1
     else:
         idx = (weights - weight_min)/(weight_max - weight_min)
-    colours = cmap(idx, alpha=0.5)
 
     x = poses[:, 0]
     y = poses[:, 1]
-    theta = np.degrees(poses[:, 2])
+    theta = poses[:, 2]
 
     x, y = y, x
 
-    if hasattr(axes, 'particles'):
-        for m in range(len(x)):
-            try:
-                axes.particles[m].set_data(x[m], y[m])
-                axes.particles[m].set_marker((3, 0, theta[m] + 180))
-                axes.particles[m].set_color(colours[m])
-            except IndexError:
-                print(len(y), len(x))
+    if not hasattr(axes, 'particles'):
+        axes.particles = ParticleCloud(offsets=np.column_stack((x, y)), offset_transform=axes.transData,
+                                       transform=IdentityTransform(),
+                                       cmap=colourmap, norm=Normalize(0, 1), alpha=0.5,
+                                       linewidths=0)
+        add_animated(axes, axes.particles)
+        axes.update_datalim(axes.particles.get_offsets())
+        axes.autoscale_view()
+
+    axes.particles.set_offsets(np.column_stack((x, y)))
+    axes.particles.set_angles(theta + np.pi)
+    axes.particles.set_array(idx)
 
-        axes.figure.canvas.draw()
-        axes.figure.canvas.flush_events()
-        return
+    blit(axes)
 
-    axes.particles = []
-    for m in range(len(x)):
-        l, = axes.plot(x[m], y[m], marker=(3, 0, theta[m] + 180),
-                       color=colours[m], markersize=5, linestyle='')
-        axes.particles.append(l)
+
+def add_animated(axes, artist):
+    """Add an artist that is redrawn by blit(axes) rather than with the rest of the figure."""
+    if not hasattr(axes, 'animated'):
+        axes.animated = []
+        axes.background = None
+        axes.figure.canvas.mpl_connect('draw_event', lambda event: save_background(axes))
+
+    artist.set_animated(True)
+    axes.add_artist(artist)
+    axes.animated.append(artist)
+
+
+def blit(axes):
+    """Redraw the animated artists of the axes over a saved copy of everything else.
+
+    The whole figure is only redrawn when something else on it has changed.
+    """
+    canvas = axes.figure.canvas
+    if axes.background is None or axes.figure.stale or not canvas.supports_blit:
+        # The draw event saves the new background and draws the animated artists over it
+        canvas.draw()
+    else:
+        canvas.restore_region(axes.background)
+        for artist in axes.animated:
+            axes.draw_artist(artist)
+        canvas.blit(axes.bbox)
+    canvas.flush_events()
+
+
+def save_background(axes):
+    """Save the axes without the animated artists for blitting, then draw them."""
+    canvas = axes.figure.canvas
+    axes.background = canvas.copy_from_bbox(axes.bbox)
+    for artist in axes.animated:
+        axes.draw_artist(artist)
 
 
 def plot_path(axes, poses, fmt='-', label=None):
@@ -91,39 +221,107 @@ def plot_path(axes, poses, fmt='-', label=None):
     return
 
 
+class PathWithVisibility(object):
+    """A growing path drawn with one line per colour, with NaN gaps where the other colours are.
+
+    Each segment takes the colour of the visibility at the point it leads to.
+    The lines are animated, so extending the path only redraws it with blit.
+    The points of each line are kept in a buffer that doubles in size when it
+    is full, so extending the path only adds the new points.
+    """
+
+    def __init__(self, axes, fmt='-', colours=('red', 'green'), label=None):
+        self.buffers = [np.zeros((0, 2)) for colour in colours]
+        self.sizes = [0] * len(colours)
+        self.lines = []
+        for n, colour in enumerate(colours):
+            line = Line2D([], [], linestyle=fmt if fmt in ('-', '--', '-.', ':') else '-',
+                          color=colour, label=label if n == 0 else None)
+            add_animated(axes, line)
+            self.lines.append(line)
+
+    def extend(self, points, visibility):
+        """Add a piece of path, points (N x 2, in plot coordinates) with their visibility.
+
+        Each piece is drawn separately, as if plotted on its own, so pieces may overlap.
+        """
+        segment_colours = np.asarray(visibility[1:], dtype=int)
+
+        for n, line in enumerate(self.lines):
+            new_points = line_points(points, segment_colours, n)
+            if len(new_points) == 0:
+                continue
+
+            size = self.sizes[n] + len(new_points)
+            if size > len(self.buffers[n]):
+                buffer = np.empty((max(size, 2 * len(self.buffers[n])), 2))
+                buffer[:self.sizes[n]] = self.buffers[n][:self.sizes[n]]
+                self.buffers[n] = buffer
+            self.buffers[n][self.sizes[n]:size] = new_points
+            self.sizes[n] = size
+
+            line.set_data(self.buffers[n][:size, 0], self.buffers[n][:size, 1])
+
+
+def line_points(points, segment_colours, colour):
+    """Return the points of the segments with colour index 'colour', runs separated by NaN.
+
+    segment_colours gives the colour of the segment leading to each point after the first.
+    Every run, including the last, is ended by a NaN point.
+    """
+    ours = segment_colours == colour
+
+    #A point is on the line if the segment before or after it is ours
+    before = np.concatenate(([False], ours))
+    after = np.concatenate((ours, [False]))
+    on_line = before | after
+
+    #End each run of our segments with a NaN point to break the line
+    run_end = before & ~after
+    ends = np.where(run_end[:, np.newaxis], np.nan, points)
+    interleaved = np.column_stack((points, ends)).reshape(-1, 2)
+    keep = np.column_stack((on_line, run_end)).ravel()
+    return interleaved[keep]
+
+
 def plot_path_with_visibility(axes, poses, fmt='-', colours=('red', 'green'),
-                              label=None, visibility=None):
+                              label=None, visibility=None, path=None):
     """Plot path showing where beacons are visible.
 
     'visibility' is a boolean array to indicate where beacons are visible
     'colours' sets the path colour for invisible and visible beacons
+
+    Returns the PathWithVisibility the poses were added to.  Pass it back as
+    'path' to extend the same path with the next part of the trajectory, so the
+    number of artists does not grow.  Only the line style of 'fmt' is used.
     """
     
     if visibility is None:
-        return plot_path(axes, fmt, label)
+        return plot_path(axes, poses, fmt, label)
 
     x = poses[..., 0]
     y = poses[..., 1]
 
     if len(x) == 0:
-        return
+        return path
 
     x, y = y, x
 
-    m = 0
-    k = 0
-    for n in range(1, len(x)):
-        if visibility[n] == visibility[m]:
-            continue
-        axes.plot(x[k:n], y[k:n], fmt, label=label, color=colours[visibility[m]])
-        m = n
-        k = n - 1
+    if path is None:
+        path = PathWithVisibility(axes, fmt, colours, label)
 
-    axes.plot(x[k:n], y[k:n], fmt, label=label, color=colours[visibility[m]])
+    points = np.column_stack((x, y))
+    path.extend(points, visibility)
+    axes.update_datalim(points)
+    return path
 
 
 def plot_beacons(axes, beacons, colour='blue', label=None):
-    """Plot beacon poses."""
+    """Plot beacon poses.
+
+    The markers, the x and y axes of every beacon and the beacon numbers are
+    each drawn as one artist.
+    """
 
     x = beacons[:, 0]
     y = beacons[:, 1]
@@ -140,24 +338,18 @@ def plot_beacons(axes, beacons, colour='blue', label=None):
 
     axes.plot(x, y, 'o', color=colour, label=label)
 
-    axes.plot((x, x + xdx), (y, y + xdy), color='red')
-    axes.plot((x, x + ydx), (y, y + ydy), color='green')
-    
-    for m in range(len(x)):
-        axes.text(x[m], y[m], '%d' % m)        
-
-
-def clean_poses(poses):
-    """Null out jumps in SLAM poses by replacing with NaN."""
-    clean_poses = np.copy(poses)
-    last_good = 0
-    for i in range(1, len(clean_poses)):
-        dist = np.sqrt(np.sum((clean_poses[i, :2] - clean_poses[last_good, :2])**2))
-        if dist > 2:
-            clean_poses[i] = np.nan
-        else:
-            last_good = i
-    return clean_poses
+    # The beacon x axes in red then the y axes in green
+    origins = np.column_stack((x, y))
+    ends = np.concatenate((origins + np.column_stack((xdx, xdy)), origins + np.column_stack((ydx, ydy))))
+    axes.add_collection(LineCollection(np.stack((np.concatenate((origins, origins)), ends), axis=1),
+                                       colors=['red'] * len(x) + ['green'] * len(x)))
+
+    # Number each beacon with text outlines placed like axes.text, sized in points
+    size = plt.rcParams['font.size']
+    labels = [TextPath((0, 0), '%d' % m, size=size) for m in range(len(x))]
+    axes.add_collection(PathCollection(labels, offsets=origins, offset_transform=axes.transData,
+                                       transform=Affine2D().scale(1 / 72) + axes.figure.dpi_scale_trans,
+                                       facecolors='black', linewidths=0), autolim=False)
 
 
 def pause_if_key_pressed():
@@ -0,0 +1,153 @@
+"""Live display of the particle filter, drawn in a separate process.
+
+The filter loop publishes snapshots of the particles and the new part of the
+estimated path to a Renderer.  The snapshots go through a small bounded queue,
+and when it is full the oldest snapshot is dropped, so publishing never waits
+for the display.  The renderer process draws the latest snapshot at its own
+frame rate.
+
+    renderer = Renderer(beacon_locs, slam_poses)
+    renderer.start()
+    ...
+    renderer.publish(n, pf.poses, weights, est_poses[a:b], beacon_visible[a:b])
+    ...
+    renderer.close()
+
+The renderer process is forked where possible.  On platforms without fork the
+process re-imports the main script, which must then guard its main code with
+if __name__ == '__main__'.
+
+Sam Bain/Mark Gardyne,
+Department of Electrical and Computer Engineering
+University of Canterbury
+"""
+
+import multiprocessing
+import queue
+import time
+from collections import namedtuple
+import numpy as np
+
+# The particle poses and weights at log row 'step', and the new piece of the
+# estimated path with the beacon visibility at each of its poses
+Snapshot = namedtuple('Snapshot', 'step poses weights path visibility')
+
+
+class Renderer(object):
+
+    def __init__(self, beacon_locs, slam_poses, maxsize=2, frame_rate=20,
+                 title='Push space to start/stop, dot to move one step, q to quit...'):
+        """beacon_locs and slam_poses are drawn once as the background of the display.
+
+        maxsize: number of snapshots queued for the renderer before the oldest is dropped
+        frame_rate: maximum number of frames drawn per second
+        """
+        methods = multiprocessing.get_all_start_methods()
+        self.context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+        self.snapshots = self.context.Queue(maxsize)
+        self.process = self.context.Process(target=render, args=(self.snapshots, beacon_locs, slam_poses,
+                                                                 frame_rate, title))
+        self.process.daemon = True
+        self.published = 0
+        self.dropped = 0
+
+    def start(self):
+        self.process.start()
+
+    def publish(self, step, poses, weights, path, visibility):
+        """Queue a snapshot for display without waiting for the renderer.
+
+        If the queue is full the oldest snapshot is dropped.  Its piece of path is
+        carried over into the new snapshot, so the displayed path has no gaps.
+
+        The queue's feeder thread pickles the snapshot after publish returns, so the
+        arrays are copied here and the filter is free to change its own arrays.
+        """
+        snapshot = Snapshot(step, np.array(poses, copy=True), np.array(weights, copy=True),
+                            np.array(path, copy=True), np.array(visibility, copy=True))
+        self.published += 1
+
+        while True:
+            try:
+                self.snapshots.put_nowait(snapshot)
+                return
+            except queue.Full:
+                pass
+
+            try:
+                dropped = self.snapshots.get_nowait()
+            except queue.Empty:
+                continue
+            self.dropped += 1
+
+            if dropped is not None and len(dropped.path):
+                snapshot = snapshot._replace(path=np.concatenate((dropped.path, [[np.nan] * 3], snapshot.path)),
+                                             visibility=np.concatenate((dropped.visibility, [False],
+                                                                        snapshot.visibility)))
+
+    def close(self):
+        """Tell the renderer the run is finished and wait for its window to be closed."""
+        while self.process.is_alive():
+            try:
+                self.snapshots.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+
+        self.process.join()
+        self.snapshots.close()
+        self.snapshots.cancel_join_thread()
+
+
+def render(snapshots, beacon_locs, slam_poses, frame_rate, title):
+    """Draw snapshots from the queue until None is received, then show the final frame."""
+    import matplotlib.pyplot as plt
+    from plot import plot_beacons, plot_path, plot_path_with_visibility, plot_particles, keypress_handler
+
+    plt.ion()
+    fig = plt.figure(figsize=(10, 5))
+    axes = fig.add_subplot(111)
+    fig.canvas.mpl_connect('key_press_event', keypress_handler)
+
+    plot_beacons(axes, beacon_locs, label='Beacons')
+    plot_path(axes, slam_poses, '-', label='SLAM')
+
+    axes.legend(loc='lower right')
+
+    axes.set_xlim([-6, None])
+    axes.axis('equal')
+
+    axes.invert_yaxis()
+    axes.set_xlabel('y')
+    axes.set_ylabel('x')
+    axes.set_title(title)
+    fig.canvas.draw()
+    fig.canvas.flush_events()
+
+    interval = 1 / frame_rate
+    est_path = None
+
+    while plt.fignum_exists(fig.number):
+        start = time.perf_counter()
+        try:
+            snapshot = snapshots.get(timeout=interval)
+        except queue.Empty:
+            fig.canvas.flush_events()
+            continue
+
+        if snapshot is None:
+            break
+
+        # Show mean estimate and the particle cloud
+        est_path = plot_path_with_visibility(axes, snapshot.path, '-', visibility=snapshot.visibility,
+                                             path=est_path)
+        plot_particles(axes, snapshot.poses, snapshot.weights)
+
+        # Handle window events until the next frame is due
+        remaining = interval - (time.perf_counter() - start)
+        if remaining > 0:
+            fig.canvas.start_event_loop(remaining)
+
+    if plt.fignum_exists(fig.number):
+        plt.ioff()
+        plt.show()
@@ -0,0 +1,22 @@
+"""The log loaders shared by partA and partB.
+
+logformats.py and logcache.py live in the repository root so both parts use
+the same schemas and cache.  The modules here are run from inside partB, so
+this module puts the root on the import path once and re-exports the
+loaders; import them from here rather than editing sys.path:
+
+    from shared_logs import load_log_columns
+
+Sam Bain/Mark Gardyne,
+Department of Electrical and Computer Engineering
+University of Canterbury
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.append(ROOT)
+
+from logformats import check_header, load_log_columns, parse_lines
@@ -0,0 +1,141 @@
+"""Per-step telemetry for the particle filter.
+
+A Telemetry object keeps one row per filter step in a fixed-size ring buffer,
+so a long run keeps only the most recent rows and never allocates more
+memory.  Each row holds the wall time spent in the motion update, sensor
+update, resampling and display, with the effective sample size, particle
+count, largest log-weight and whether the step resampled or lost the robot.
+
+    telemetry = Telemetry(capacity=10000, profile_steps=[(100, 200)])
+    pf = ParticleFilter(beacon_locs, bounds, telemetry=telemetry)
+    ...
+    telemetry.to_csv('telemetry.csv')
+
+A filter without telemetry (the default) does not time anything.  Steps in
+the ranges in profile_steps are run under cProfile and the statistics for
+each range are saved to a file that can be read with pstats or snakeviz.
+
+Sam Bain/Mark Gardyne,
+Department of Electrical and Computer Engineering
+University of Canterbury
+"""
+
+import cProfile
+import json
+import numpy as np
+
+# Dtype of a telemetry row.  step is the log row the step starts at, or the number of steps before
+# it where the filter is not given the row.  Times are in seconds, and NaN where a stage did not run.
+# max_log_weight is the largest particle log-weight after a beacon update, before normalisation
+TELEMETRY_DTYPE = np.dtype([('step', np.int64), ('motion', float), ('sensor', float), ('resample', float),
+                            ('render', float), ('Nparticles', np.int64), ('ess', float),
+                            ('max_log_weight', float), ('log_sum', float), ('resampled', bool),
+                            ('lost', bool)])
+
+# Formats for each field when saving to CSV
+CSV_FORMATS = ['%d', '%.6g', '%.6g', '%.6g', '%.6g', '%d', '%.6g', '%.6g', '%.6g', '%d', '%d']
+
+
+class Telemetry(object):
+
+    def __init__(self, capacity=4096, profile_steps=(), profile_filename='profile-%d-%d.prof'):
+        """Ring buffer of the last 'capacity' steps.
+
+        profile_steps: (start, stop) ranges of steps to profile, numbered as for the
+        step field; each range includes start but not stop.
+
+        profile_filename: file the profile for each range is saved to, formatted
+        with (start, stop).
+        """
+        self.capacity = capacity
+        self.records = np.zeros(capacity, dtype=TELEMETRY_DTYPE)
+        self.count = 0
+        self.row = None
+
+        self.profile_steps = sorted(profile_steps)
+        self.profile_filename = profile_filename
+        self.profiler = None
+        self.profile_range = None
+        self.profiles = []
+
+    def begin(self, step=None):
+        """Start a new row for step 'step', usually its log row (by default the number of steps so far).
+
+        The oldest row is overwritten once the buffer is full.
+        """
+        if step is None:
+            step = self.count
+        if self.profile_steps or self.profiler is not None:
+            self.update_profiler(step)
+
+        index = self.count % self.capacity
+        self.records[index] = (step, np.nan, np.nan, np.nan, np.nan, 0, np.nan, np.nan, np.nan, False, False)
+        self.row = self.records[index]
+        self.count += 1
+
+    def set(self, field, value):
+        """Set a field of the current row."""
+        self.row[field] = value
+
+    def update_profiler(self, step):
+        """Start or stop the profiler at the start of step 'step'."""
+        if self.profiler is not None and step >= self.profile_range[1]:
+            self.stop_profiler()
+
+        if self.profiler is None:
+            while self.profile_steps and step >= self.profile_steps[0][1]:
+                self.profile_steps.pop(0)
+            if self.profile_steps and step >= self.profile_steps[0][0]:
+                self.profile_range = self.profile_steps.pop(0)
+                self.profiler = cProfile.Profile()
+                self.profiler.enable()
+
+    def stop_profiler(self):
+        """Stop the profiler, if it is running, and save its statistics."""
+        if self.profiler is None:
+            return
+        self.profiler.disable()
+        filename = self.profile_filename % self.profile_range
+        self.profiler.dump_stats(filename)
+        self.profiles.append(filename)
+        self.profiler = None
+
+    def close(self):
+        """Save the profile of a range still running at the end of the run."""
+        self.stop_profiler()
+
+    def rows(self):
+        """Return a copy of the rows in the buffer, oldest first."""
+        if self.count <= self.capacity:
+            return self.records[:self.count].copy()
+        start = self.count % self.capacity
+        return np.concatenate((self.records[start:], self.records[:start]))
+
+    def to_csv(self, filename):
+        np.savetxt(filename, self.rows(), delimiter=',', header=','.join(TELEMETRY_DTYPE.names),
+                   comments='', fmt=CSV_FORMATS)
+
+    def to_json(self, filename):
+        """Save the rows as an object of per-field lists, with NaN as null."""
+        rows = self.rows()
+        columns = {}
+        for name in TELEMETRY_DTYPE.names:
+            values = rows[name].tolist()
+            if rows[name].dtype.kind == 'f':
+                values = [None if np.isnan(v) else v for v in values]
+            columns[name] = values
+        with open(filename, 'w') as f:
+            json.dump({'steps': self.count, 'dropped': max(self.count - self.capacity, 0), 'rows': columns}, f)
+
+    def save(self, filename):
+        """Save the rows as JSON if the filename ends in .json, otherwise as CSV."""
+        if filename.endswith('.json'):
+            self.to_json(filename)
+        else:
+            self.to_csv(filename)
+
+    def summary(self):
+        """Return a dict of the mean time (s) each stage took in the steps in the buffer it ran in."""
+        rows = self.rows()
+        return {name: float(np.nanmean(rows[name])) if np.any(~np.isnan(rows[name])) else 0.0
+                for name in ('motion', 'sensor', 'resample', 'render')}
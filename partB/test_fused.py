@@ -0,0 +1,48 @@
+"""Tests for the fused motion and sensor update in fused.py, run with pytest from partB.
+
+Sam Bain/Mark Gardyne,
+Department of Electrical and Computer Engineering
+University of Canterbury
+"""
+
+import os
+import numpy as np
+import pytest
+from numpy.random import seed, randn, uniform
+from fused import fused_step
+from logs import load_data, load_beacon_map
+from particle_filter import filter_bounds
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.mark.parametrize('Nbeacons', [0, 1, 2])
+def test_numba_matches_numpy(Nbeacons):
+    pytest.importorskip('numba')
+    seed(4)
+    t, commands, slam_poses, odom_poses, beacon_ids, beacon_poses = load_data(os.path.join(HERE, 'data.csv'))
+    beacon_locs = load_beacon_map(os.path.join(HERE, 'beacon_map.csv'))
+
+    #A step where the robot moves and sees a beacon
+    n = int(np.flatnonzero((beacon_ids[1:] >= 0) & np.any(odom_poses[1:] != odom_poses[:-1], axis=1))[0]) + 1
+    dt = (t[n] - t[n - 1]) * 1e-9
+    beacon_pose = np.repeat(beacon_poses[n:n + 1], Nbeacons, axis=0)
+    beacon_loc = np.repeat(beacon_locs[beacon_ids[n]:beacon_ids[n] + 1], Nbeacons, axis=0)
+    if Nbeacons == 0:
+        beacon_pose = beacon_loc = None
+
+    Nparticles = 1000
+    Xmin, Xmax, Ymin, Ymax = filter_bounds(slam_poses)
+    poses = np.column_stack((uniform(Xmin, Xmax, Nparticles), uniform(Ymin, Ymax, Nparticles),
+                             uniform(-np.pi, np.pi, Nparticles)))
+    log_weights = np.full(Nparticles, -np.log(Nparticles))
+    noise = randn(Nparticles, 3)
+
+    results = {}
+    for backend in ('numpy', 'numba'):
+        results[backend] = fused_step(poses.copy(), log_weights.copy(), commands[n - 1], odom_poses[n],
+                                      odom_poses[n - 1], dt, beacon_pose, beacon_loc, noise=noise.copy(),
+                                      backend=backend)
+
+    np.testing.assert_allclose(results['numba'][0], results['numpy'][0], rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(results['numba'][1], results['numpy'][1], rtol=1e-9, atol=1e-9)
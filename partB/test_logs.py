@@ -0,0 +1,58 @@
+"""Tests for the chunked log reader in logs.py, run with pytest from partB.
+
+Sam Bain/Mark Gardyne,
+Department of Electrical and Computer Engineering
+University of Canterbury
+"""
+
+import os
+import numpy as np
+import pytest
+from logs import load_data, iter_steps, time_steps
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DATA = os.path.join(HERE, 'data.csv')
+
+
+def expected_steps(filename):
+    """Return the steps iter_steps should yield, made from the whole log as loaded by load_data."""
+    t, commands, slam_poses, odom_poses, beacon_ids, beacon_poses = load_data(filename)
+    ranges = list(time_steps(t))
+    start, stop = ranges[0]
+    if stop - start > 1:
+        ranges[0:1] = [(start, start + 1), (start + 1, stop)]
+
+    steps = []
+    for start, stop in ranges:
+        seen = beacon_ids[start:stop] >= 0
+        steps.append((t[start], commands[start], slam_poses[start], odom_poses[start],
+                      beacon_ids[start:stop][seen], beacon_poses[start:stop][seen]))
+    return steps
+
+
+def assert_same_steps(steps, expected):
+    assert len(steps) == len(expected)
+    for step, expected_step in zip(steps, expected):
+        assert step[0] == expected_step[0]
+        for value, expected_value in zip(step[1:], expected_step[1:]):
+            np.testing.assert_allclose(value, expected_value, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 1024, 100000])
+def test_chunks_carry_steps_over(chunk_size):
+    assert_same_steps(list(iter_steps(DATA, chunk_size)), expected_steps(DATA))
+
+
+@pytest.mark.parametrize('Nrows', [1, 2, 3, 5])
+@pytest.mark.parametrize('chunk_size', [1, 2, 4])
+def test_short_logs(tmp_path, Nrows, chunk_size):
+    #The first two rows of data.csv share a timestamp, so short logs end in the first step
+    filename = str(tmp_path / 'short.csv')
+    with open(DATA) as f:
+        lines = [f.readline() for row in range(Nrows + 1)]
+    with open(filename, 'w') as f:
+        f.writelines(lines)
+
+    steps = list(iter_steps(filename, chunk_size))
+    assert len(steps[0][4]) <= 1
+    assert_same_steps(steps, expected_steps(filename))
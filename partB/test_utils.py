@@ -0,0 +1,104 @@
+"""Tests for the resampling and weighting functions in utils.py, run with pytest from partB.
+
+Sam Bain/Mark Gardyne,
+Department of Electrical and Computer Engineering
+University of Canterbury
+"""
+
+import numpy as np
+import pytest
+from numpy.random import seed
+from utils import RESAMPLERS, resample, normalise_log_weights, kld_bound
+
+
+def random_weights(Nold, zeros=0.3):
+    """Return Nold random weights summing to one, with about a 'zeros' fraction of them zero."""
+    weights = np.random.exponential(size=Nold) * (np.random.uniform(size=Nold) > zeros)
+    weights[0] += 1e-3
+    return weights / weights.sum()
+
+
+@pytest.mark.parametrize('method', sorted(RESAMPLERS))
+def test_resample_draws_only_weighted_particles(method):
+    seed(1)
+    Nold, Nnew = 200, 500
+    particles = np.column_stack((np.arange(Nold), np.zeros(Nold), np.zeros(Nold)))
+    weights = random_weights(Nold)
+
+    new_particles, new_weights = resample(particles, weights, Nnew, method=method)
+    drawn = new_particles[:, 0].astype(int)
+    assert new_particles.shape == (Nnew, 3)
+    np.testing.assert_array_equal(new_weights, np.ones(Nnew))
+    assert np.all(weights[drawn] > 0)
+
+    #How close each particle's count is to Nnew * w depends on the scheme
+    counts = np.bincount(drawn, minlength=Nold)
+    expected = Nnew * weights
+    if method == 'systematic':
+        assert np.all(np.abs(counts - expected) < 1 + 1e-9)
+    elif method == 'stratified':
+        assert np.all(np.abs(counts - expected) < 2 + 1e-9)
+    elif method == 'residual':
+        assert np.all(counts >= np.floor(expected))
+
+
+def test_resample_log_weights_and_out():
+    seed(2)
+    Nold = 100
+    particles = np.random.uniform(size=(Nold, 3))
+    log_weights = np.log(random_weights(Nold, zeros=0))
+    out = np.full((150, 3), np.nan)
+
+    new_particles, new_weights = resample(particles, log_weights, 120, method='systematic', out=out, log=True)
+    assert np.shares_memory(new_particles, out)
+    assert np.all(np.isnan(out[120:]))
+    assert np.all(np.isin(new_particles[:, 0], particles[:, 0]))
+    np.testing.assert_array_equal(new_weights, np.zeros(120))
+
+
+def test_normalise_log_weights():
+    seed(3)
+    log_weights = np.random.normal(-500, 20, 1000)
+    log_weights[::10] = -np.inf
+    expected_log_sum = np.log(np.sum(np.exp(log_weights - log_weights.max()))) + log_weights.max()
+    weights = np.exp(log_weights - log_weights.max())
+    expected_ess = weights.sum()**2 / np.sum(weights**2)
+
+    shifted = log_weights + 123.0
+    log_sum, ess = normalise_log_weights(log_weights)
+    assert log_sum == pytest.approx(expected_log_sum)
+    assert ess == pytest.approx(expected_ess)
+    assert 1 <= ess <= len(log_weights)
+    assert np.sum(np.exp(log_weights)) == pytest.approx(1)
+
+    #Scaling every weight changes the total but not the normalised weights or the ESS
+    shifted_log_sum, shifted_ess = normalise_log_weights(shifted)
+    assert shifted_log_sum == pytest.approx(log_sum + 123.0)
+    assert shifted_ess == pytest.approx(ess)
+    np.testing.assert_allclose(np.exp(shifted), np.exp(log_weights), atol=1e-15)
+
+
+def test_normalise_log_weights_edge_cases():
+    equal = np.full(50, -3.0)
+    log_sum, ess = normalise_log_weights(equal)
+    assert log_sum == pytest.approx(-3 + np.log(50))
+    assert ess == pytest.approx(50)
+    np.testing.assert_allclose(equal, -np.log(50))
+
+    zero = np.full(10, -np.inf)
+    assert normalise_log_weights(zero) == (-np.inf, 0.0)
+
+
+def test_kld_bound():
+    z = 2.326
+    k = np.arange(1, 500)
+    bound = kld_bound(k, 0.05, z)
+    assert bound[0] == 1
+    assert np.all(np.diff(bound) >= 0)
+    assert np.all(kld_bound(k, 0.1, z) <= bound)
+    assert np.all(kld_bound(k, 0.05, 1.645) <= bound)
+
+    #The Wilson-Hilferty approximation is close to the chi-square quantile it stands for
+    stats = pytest.importorskip('scipy.stats')
+    exact = stats.chi2.ppf(stats.norm.cdf(z), k[9:] - 1) / (2 * 0.05)
+    np.testing.assert_allclose(bound[9:], np.ceil(exact), rtol=0.01)
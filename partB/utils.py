@@ -11,8 +11,8 @@ Edits by Sam Bain/Mark Gardyne:
 """
 
 import numpy as np
-import bisect
 from numpy.random import uniform
+from statistics import NormalDist
 
 
 def gauss(v, mu=0, sigma=1):
@@ -24,15 +24,68 @@ def gauss(v, mu=0, sigma=1):
 ###############################################################################
 # Particle filter functions
 
-def resample(particles, weights, Nparticles):
+def _multinomial_indices(cum_weights, Nparticles):
+    """Draw each new particle independently, as a weighted die roll."""
+    return np.searchsorted(cum_weights, uniform(0, 1, Nparticles), side='left')
+
+
+def _stratified_indices(cum_weights, Nparticles):
+    """Draw one new particle from each of Nparticles equal strata of [0, 1)."""
+    u = (np.arange(Nparticles) + uniform(0, 1, Nparticles)) / Nparticles
+    return np.searchsorted(cum_weights, u, side='left')
+
+
+def _systematic_indices(cum_weights, Nparticles):
+    """Draw new particles with a single random offset and a fixed spacing."""
+    u = (np.arange(Nparticles) + uniform(0, 1)) / Nparticles
+    return np.searchsorted(cum_weights, u, side='left')
+
+
+def _residual_indices(cum_weights, Nparticles):
+    """Copy floor(N * w) of each particle, then fill the remainder multinomially."""
+    weights = np.diff(cum_weights, prepend=0.0)
+    counts = np.floor(Nparticles * weights).astype(int)
+    Nresidual = Nparticles - counts.sum()
+
+    indices = np.repeat(np.arange(len(weights)), counts)
+    if Nresidual > 0:
+        residuals = Nparticles * weights - counts
+        cum_residuals = np.cumsum(residuals)
+        cum_residuals /= cum_residuals[-1]
+        indices = np.concatenate((indices, _multinomial_indices(cum_residuals, Nresidual)))
+    return indices
+
+
+RESAMPLERS = {
+    'multinomial': _multinomial_indices,
+    'stratified': _stratified_indices,
+    'systematic': _systematic_indices,
+    'residual': _residual_indices,
+}
+
+
+def resample(particles, weights, Nparticles, method='multinomial', out=None, log=False):
     """Resample particles in proportion to their weights.
 
     Particles and weights should be arrays. The number of particles is also specified, which
     dictates the size of the resampled array.
 
+    'method' selects the resampling scheme, one of 'multinomial', 'stratified',
+    'systematic' or 'residual'.  All are vectorised, and find the old particle of each
+    new one with a binary search, O(N log M) for M old particles.
+
+    If 'out' is given, the new particle poses are written into its first Nparticles
+    rows instead of a freshly allocated array.  It must have at least Nparticles rows.
+
+    If 'log' is True, 'weights' are log-weights normalised by normalise_log_weights
+    and the returned weights are log-weights too.
+
     Returns the new arrays of particle poses and weights.
     """
-    cum_weights = np.cumsum(weights)
+    if log:
+        cum_weights = np.cumsum(np.exp(weights))
+    else:
+        cum_weights = np.cumsum(weights)
 
     if cum_weights[-1] == 0.0:
         print('All weights are zero, giving up...')
@@ -40,27 +93,163 @@ def resample(particles, weights, Nparticles):
 
     cum_weights /= cum_weights[-1]
 
-    #Initial empty array containing with a size of the number of new particles
-    new_particles = np.zeros([Nparticles, 3])
+    #Choose which of the old particles each new particle is copied from
+    indices = RESAMPLERS[method](cum_weights, Nparticles)
 
-    for i in range(Nparticles):
-        # Copy a particle into the list of new particles, choosing based
-        # on weight
-        m = bisect.bisect_left(cum_weights, uniform(0, 1))
-        p = particles[m]
-        new_particles[i] = p
+    #Guard against rounding in the cumulative sum leaving u just above the last bin
+    np.minimum(indices, len(cum_weights) - 1, out=indices)
 
-    new_weights = np.ones(len(new_particles))
+    if out is None:
+        new_particles = particles[indices]
+    else:
+        new_particles = out[:Nparticles]
+        np.take(particles, indices, axis=0, out=new_particles)
+
+    if log:
+        new_weights = np.zeros(len(new_particles))
+    else:
+        new_weights = np.ones(len(new_particles))
 
     return new_particles, new_weights
 
 
-def is_degenerate(weights):
-    """Return true if the particles are degenerate and need resampling."""
-    
-    weights_sum = np.sum(weights)
-    w = weights / weights_sum
-    return 1.0 / np.sum(w**2) < 0.5 * len(w)
+def _bin_keys(particles, bin_size):
+    """Return an integer key identifying the (x, y, theta) histogram bin of each particle."""
+    bins = np.floor(particles / bin_size).astype(np.int64) + (1 << 20)
+    return (bins[:, 0] << 42) | (bins[:, 1] << 21) | bins[:, 2]
+
+
+def kld_bound(k, epsilon, z):
+    """Return the number of particles needed for k occupied bins.
+
+    This is the Wilson-Hilferty approximation to the chi-square quantile used by
+    KLD-sampling (Fox, 2003).  With this many particles, the KL-distance between the
+    sample-based and true posterior is below 'epsilon' with the confidence implied by
+    the standard normal quantile 'z'.
+    """
+    k = np.asarray(k, dtype=float)
+    km1 = np.maximum(k - 1, 1)
+    a = 2 / (9 * km1)
+    bound = km1 / (2 * epsilon) * (1 - a + np.sqrt(a) * z)**3
+    return np.where(k > 1, np.ceil(bound), 1)
+
+
+def kld_resample(particles, weights, bin_size=(0.2, 0.2, np.radians(10)), epsilon=0.05,
+                 delta=0.01, min_particles=100, max_particles=2000, log=False):
+    """Resample particles in proportion to their weights, choosing the particle count adaptively.
+
+    Particles are drawn in growing batches and dropped into a histogram of (x, y, theta)
+    bins of size 'bin_size'.  Drawing stops as soon as the number drawn reaches the
+    KL-distance bound for the number of occupied bins, so a tight cloud is represented
+    with few particles and a spread out one with many.  'epsilon' is the allowed
+    KL-distance and 1 - 'delta' the confidence.  The count is kept within
+    [min_particles, max_particles].
+
+    If 'log' is True, 'weights' are normalised log-weights as for resample.
+
+    Returns the new arrays of particle poses and weights.
+    """
+    if log:
+        cum_weights = np.cumsum(np.exp(weights))
+    else:
+        cum_weights = np.cumsum(weights)
+
+    if cum_weights[-1] == 0.0:
+        print('All weights are zero, giving up...')
+        return False
+
+    cum_weights /= cum_weights[-1]
+
+    bin_size = np.asarray(bin_size, dtype=float)
+    z = NormalDist().inv_cdf(1 - delta)
+
+    chunks = []
+    seen_bins = np.empty(0, dtype=np.int64)
+    Ndrawn = 0
+    Nbins = 0
+    chunk_size = min_particles
+
+    while Ndrawn < max_particles:
+        chunk_size = min(chunk_size, max_particles - Ndrawn)
+        indices = np.minimum(_multinomial_indices(cum_weights, chunk_size), len(cum_weights) - 1)
+
+        #Mark the draws that land in a bin nobody has landed in before
+        keys = _bin_keys(particles[indices], bin_size)
+        chunk_bins, first = np.unique(keys, return_index=True)
+        new_bins = ~np.isin(chunk_bins, seen_bins)
+        is_new = np.zeros(chunk_size, dtype=bool)
+        is_new[first[new_bins]] = True
+
+        #Stop at the first draw for which the bound is met
+        bins_so_far = Nbins + np.cumsum(is_new)
+        drawn_so_far = Ndrawn + np.arange(1, chunk_size + 1)
+        done = (drawn_so_far >= kld_bound(bins_so_far, epsilon, z)) & (drawn_so_far >= min_particles)
+        if done.any():
+            stop = np.argmax(done) + 1
+            chunks.append(indices[:stop])
+            break
+
+        chunks.append(indices)
+        Ndrawn += chunk_size
+        Nbins = bins_so_far[-1]
+        seen_bins = np.concatenate((seen_bins, chunk_bins[new_bins]))
+        chunk_size *= 2
+
+    new_particles = particles[np.concatenate(chunks)]
+
+    if log:
+        new_weights = np.zeros(len(new_particles))
+    else:
+        new_weights = np.ones(len(new_particles))
+
+    return new_particles, new_weights
+
+
+def normalise_log_weights(log_weights):
+    """Normalise log-weights in place using log-sum-exp.
+
+    Returns the log of the total weight before normalisation, which is -inf if
+    every weight is zero, and the effective sample size of the weights.  Both come
+    out of the same pass over the array, so callers do not need to recompute them.
+    """
+    log_max = np.max(log_weights)
+    if not np.isfinite(log_max):
+        return -np.inf, 0.0
+
+    w = np.exp(log_weights - log_max)
+    w_sum = np.sum(w)
+    log_sum = log_max + np.log(w_sum)
+    log_weights -= log_sum
+
+    ess = w_sum**2 / np.dot(w, w)
+    return log_sum, ess
+
+
+def is_degenerate(weights, ess=None):
+    """Return true if the particles are degenerate and need resampling.
+
+    If the effective sample size 'ess' is already known, for example from
+    normalise_log_weights, it is used rather than recomputed from 'weights'.
+    """
+
+    if ess is None:
+        weights_sum = np.sum(weights)
+        w = weights / weights_sum
+        ess = 1.0 / np.sum(w**2)
+    return ess < 0.5 * len(weights)
+
+
+def clean_poses(poses):
+    """Null out jumps in SLAM poses by replacing with NaN."""
+    clean_poses = np.copy(poses)
+    last_good = 0
+    for i in range(1, len(clean_poses)):
+        dist = np.sqrt(np.sum((clean_poses[i, :2] - clean_poses[last_good, :2])**2))
+        if dist > 2:
+            clean_poses[i] = np.nan
+        else:
+            last_good = i
+    return clean_poses
 
 
 ###############################################################################